@@ -20,6 +20,25 @@ Valid directives are:
    TA - Used for commands that control/query the test agent itself
    OS - Used for commands intended to be executed on the operating system 
         on which the Agent is running.
+   OS-STREAM - As OS but the output is sent as it is produced.
+   BATCH - Used to execute a list of OS commands in one message.
+   JOB - Used to run OS commands in the background and collect the results 
+         later.
+   FILE - Used to copy files to and from the system the Agent is running on.
+   SYS - Used to read the CPU, memory, disk, network and process counters 
+         of the system the Agent is running on, without running commands.
+   SUB - Used to have the Agent send SYS or OS samples at a fixed interval 
+         until told to stop.
+   SPILL - Used to read the output of a command that was too large to be 
+           sent in its reply.
+   CACHE - Used to list or clear the replies the Agent has cached.
+   PING - Used to check the Agent is up, its reply has the name, version, 
+          load and uptime. Also answered over UDP, see HEALTH PROBE.
+
+Some directives take options, these follow the directive separated by 
+semicolons:
+
+   DIRECTIVE;option=value;option=value:COMMAND
 
 Valid TA Commands are:
 
@@ -32,6 +51,11 @@ Valid TA Commands are:
    getusername - Gets the name of the user that the Agent is running as
    shutdown    - Shuts down the agent        
    localtime   - Get the localtime of server that the Agent is running on 
+   framing     - Turns message framing on or off for the session (framing=on)
+   encoding    - Sets the encoding of the replies for the session (encoding=json)
+   shell       - Runs the OS commands of the session in one shell (shell=on)
+   compress    - Turns compression of large replies on or off (compress=on)
+   stats       - Gets the counters and latency histograms of the Agent
 
 All TA directives return a Python dictionary of two key-value pairs. 
 The first key-value pair is:
@@ -72,6 +96,24 @@ Agent Return Codes:
    200 - Unknown Directive
    201 - Unknown TA Command
 	220 - Unable to process OS Command
+   221 - OS Command timed out and was killed
+   222 - Bad timeout option
+   230 - Unable to process BATCH Command
+   240 - Unable to process JOB Command
+   241 - Unknown job
+   242 - Job is not finished (JOB:result)
+   243 - Job is already finished (JOB:cancel)
+   244 - Agent holds too many jobs (JOB:submit)
+   250 - Unable to process FILE Command
+   251 - Unable to read or write the file (FILE)
+   260 - Unable to process SYS Command
+   261 - Unable to read the system counters (SYS)
+   270 - Unable to process SUB Command
+   271 - Unknown subscription (SUB:stop)
+   272 - Session has too many subscriptions (SUB:start)
+   280 - Unable to process SPILL Command
+   281 - Unknown spill, dropped or expired (SPILL)
+   290 - Unable to process CACHE Command
    255 - Invalid message format
 
 The OS directive is a command that is intended to executed on the operating 
@@ -120,6 +162,361 @@ Examples:
 	                           "OS_STDERR"         : "/bin/sh: Qwert: command not found" ,
                               "OS_RETURNCODE"     : 127                                 }    
 
+The OS-STREAM directive runs a command like the OS directive but sends its 
+output to the client as it is produced instead of all at once when the 
+command ends, so the Agent does not hold the output of long running or 
+chatty commands. OS-STREAM needs a framed session (see MESSAGE FRAMING). 
+Each piece of output is sent as a reply of the form:
+
+   { AGENT_RETURN_CODE  : 0         , 
+     AGENT_MESSAGE      : "STREAM"  ,
+     OS_COMMAND         : string    ,
+     OS_STREAM          : "OS_STDOUT" or "OS_STDERR" ,
+     OS_DATA            : string    }
+
+followed, once the command has ended, by an OS directive reply with an 
+AGENT_MESSAGE of "STREAM END", empty OS_STDOUT and OS_STDERR and the 
+OS_RETURNCODE of the command.
+
+The BATCH directive takes a list of OS commands, written as a Python list of 
+strings, and returns the OS directive reply of each command, in the order 
+of the list, in one reply. The commands are run one after the other unless 
+the parallel option asks for more of them to be run at once (at most the 
+Agent's --max-parallel setting).
+
+   tcp send from client:    BATCH;parallel=4:["uname", "df -h /", "uptime"]
+   tcp recv from agent :    { "AGENT_RETURN_CODE" : 0  , 
+                              "AGENT_MESSAGE"     : "" ,
+                              "BATCH_RESULTS"     : [ {OS reply for uname}   ,
+                                                      {OS reply for df -h /} , 
+                                                      {OS reply for uptime}  ] }
+
+A BATCH command that is not a list of strings gets an AGENT_RETURN_CODE of 230.
+
+OS, OS-STREAM and BATCH take a timeout option, the most seconds a command 
+may run for (for BATCH, each command). When the Agent is started with 
+--timeout that is the limit for commands without the option, timeout=0 
+turns the limit off. A command that runs too long is killed along with 
+everything it started, it gets an AGENT_RETURN_CODE of 221, an 
+OS_RETURNCODE of 124 and the output it produced before it was killed:
+
+   tcp send from client:    OS;timeout=5:ping 10.0.0.1
+   tcp recv from agent :    { "AGENT_RETURN_CODE" : 221                    , 
+                              "AGENT_MESSAGE"     : "OS COMMAND TIMED OUT" ,
+                              "OS_COMMAND"        : "ping 10.0.0.1"        ,
+                              "OS_STDOUT"         : "PING 10.0.0.1 ..."    ,
+                              "OS_STDERR"         : ""                     ,
+                              "OS_RETURNCODE"     : 124                    }
+
+LARGE OUTPUT
+
+The Agent keeps at most --capture-limit bytes (16M by default) of the 
+standard output, and as much of the standard error, of an OS, BATCH, JOB 
+or SUB command in memory. Past that the output is spilled to a temporary 
+file, which is deleted as soon as it is made so nothing is left behind if 
+the Agent dies. The reply then holds the first and last 64k of the output 
+with a note of the bytes left out between them, and OS_SPILL, which gives 
+the SPILL_ID and SPILL_SIZE of each spilled stream:
+
+   tcp send from client:    OS:cat /var/log/huge.log
+   tcp recv from agent :    { "AGENT_RETURN_CODE" : 0                     , 
+                              "OS_STDOUT"         : "first 64k ... 
+                                   ... 2147352576 bytes not shown, see 
+                                   SPILL:read=4 ... last 64k"             ,
+                              "OS_SPILL"          : {"OS_STDOUT" : 
+                                   {SPILL_ID:4, SPILL_SIZE:2147483648}}, 
+                              ... }
+
+The whole output is read in pieces with the SPILL directive, the Agent maps 
+the file into memory and replies with a slice of it:
+
+   SPILL;offset=N;size=M:read=4 - Replies with SPILL_ID, SPILL_SIZE, 
+                    SPILL_OFFSET and, in OS_DATA, M bytes (1M by default, 
+                    at most 4M) of the output from byte N.
+   SPILL:drop=4   - Deletes the spill once the client is done with it.
+   SPILL:list     - Replies with SPILL_LIST, the SPILL_ID, SPILL_SIZE, 
+                    OS_COMMAND and stream of each spill held.
+
+A spill belongs to the Agent, any session may read it. Spills not read for 
+10 minutes are deleted and at most 100 are held, the oldest is deleted to 
+make room. A spill stops growing at 1G, the rest of the output is lost 
+but the last 64k are still in the reply. --capture-limit=0 keeps all of 
+the output in memory, as before. bin/client.py has readSpill().
+
+JOBS
+
+The JOB directive runs an OS command in the background. JOB:submit replies 
+at once with a job ID, the session is then free for other directives and 
+the result is collected later, from this or any other session:
+
+   tcp send from client:    JOB;priority=5:submit=make -C /src all
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"JOB SUBMITTED",
+                             JOB_ID:12, JOB_STATE:"QUEUED"}
+
+   JOB:status=12  - Replies with the JOB_STATE of the job: QUEUED, RUNNING, 
+                    DONE or CANCELLED.
+   JOB:result=12  - Replies with the OS directive reply of a finished job, 
+                    plus JOB_ID and JOB_STATE, and forgets the job. A job 
+                    that is not finished gets an AGENT_RETURN_CODE of 242.
+   JOB:cancel=12  - Takes a queued job off the queue or kills a running one.
+   JOB:list       - Replies with JOB_LIST, a list of JOB_ID, JOB_STATE and 
+                    OS_COMMAND for every job held.
+
+At most --jobs jobs run at once, the others wait in submission order or, 
+with --job-queue=priority, highest priority first. The Agent holds at most 
+1000 jobs, when full a finished job that was never collected is thrown away, 
+oldest first, to make room for a new one. JOB:submit takes a timeout option 
+as OS does (see above), jobs do not get the --timeout of the Agent.
+
+SESSION SHELLS
+
+Each OS directive normally starts a shell of its own. A session can instead 
+keep one shell for all of its OS directives:
+
+   tcp send from client:    TA:shell=on
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"SHELL ON"}
+
+The shell is started by the first OS directive after TA:shell=on and ends 
+with the session or on TA:shell=off. Commands no longer pay for starting a 
+shell, and a cd or an export carries over to the commands after it:
+
+   OS:cd /var/log      then      OS:pwd      -->  OS_STDOUT : "/var/log"
+
+Commands read their standard input from /dev/null. A command that ends the 
+shell, such as "exit 3", gets the exit code of the shell as OS_RETURNCODE 
+and the next OS directive gets a new shell. Starting the Agent with the 
+--shell option turns the shell on for every session. OS-STREAM and BATCH 
+always start a shell of their own.
+
+SESSION LIMITS
+
+A client that stops talking without ending its session would otherwise 
+hold on to it for ever, and in the default serving mode keep every other 
+client out. The Agent reaps such sessions:
+
+   --idle-timeout=N  - A session that sends nothing for N seconds after its 
+                       last message or reply is closed. 
+   --max-session=N   - A session open for N seconds is closed when it next 
+                       waits for a message, a directive that is running is 
+                       finished first.
+   --keepalive=N     - TCP keepalive probes start after N seconds without 
+                       traffic, a client whose system has crashed or gone 
+                       off the network is noticed within about a minute 
+                       more. 0 turns keepalive off.
+
+Both timeouts are off (0) unless given, keepalive is on (60 seconds). Every 
+reaped session is logged as a warning and counted in SESSIONS_REAPED of 
+TA:stats. The Agent does not send a reply when it reaps a session, the 
+client sees the connection closed.
+
+FILE TRANSFERS
+
+The FILE directive copies files without holding them in memory or wrapping 
+them in a reply, as OS:cat would. It needs a framed session (see MESSAGE 
+FRAMING). The contents of a file travel as raw frames of at most 256k 
+bytes, not as replies.
+
+   FILE:get=PATH  - Replies with FILE DATA, then sends the file from 
+                    FILE_OFFSET to FILE_SIZE as raw frames, then replies 
+                    with FILE END:
+
+   tcp send from client:    FILE;offset=0;checksum=sha256:get=/var/log/messages
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"FILE DATA",
+                             FILE_PATH:"/var/log/messages", FILE_SIZE:1048576, 
+                             FILE_OFFSET:0}
+   tcp recv from agent :    1048576 bytes of raw frames 
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"FILE END",
+                             FILE_PATH:"/var/log/messages", FILE_SIZE:1048576, 
+                             FILE_CHECKSUM:"9f2c..."}
+
+   FILE;size=N:put=PATH - Replies with FILE READY, the client then sends the 
+                    N bytes of the file as raw frames of any size and the 
+                    Agent replies with FILE RECEIVED once it has written 
+                    them all. 
+   FILE:stat=PATH - Replies with the FILE_SIZE of the file. 
+
+The options are:
+
+   offset   - Where get starts reading, or put starts writing, in bytes. 
+              Everything after the offset is replaced by a put. An 
+              interrupted copy is resumed by starting again at the size the 
+              copy has reached, for a put that is the FILE_SIZE from stat.
+   checksum - md5, sha1, sha256 or sha512. The reply gives FILE_CHECKSUM, 
+              the checksum of the whole file, not just of the bytes copied, 
+              so a resumed copy can be checked end to end. 
+   size     - The bytes a put sends, needed by put.
+
+FILE_SIZE is always the size of the file on the Agent. A file that shrinks 
+while it is being sent by get is padded out with zero bytes to the size 
+given in FILE DATA and FILE END becomes an AGENT_RETURN_CODE of 251. A put 
+that fails to write carries on reading the frames of the client before 
+replying with 251. bin/client.py has getFile() and putFile().
+
+SYSTEM METRICS
+
+Polling a system with OS:cat /proc/loadavg, OS:free or OS:ps starts a shell 
+and more processes on every poll, which disturbs the system being measured. 
+The SYS directive reads the same counters from /proc and statvfs() inside 
+the Agent and replies with SYS_DATA, a dictionary:
+
+   tcp send from client:    SYS:load
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"", 
+                             SYS_DATA:{LOAD_1:0.52, LOAD_5:0.61, LOAD_15:0.4,
+                                       RUNNING:2, THREADS:412, 
+                                       UPTIME:86400.5}}
+
+   SYS:cpu        - CPUS, TOTAL and PER_CPU, the seconds spent in each CPU 
+                    state (USER, NICE, SYSTEM, IDLE, IOWAIT, IRQ, SOFTIRQ, 
+                    STEAL) since boot, and CONTEXT_SWITCHES, INTERRUPTS and 
+                    FORKS. Take two readings to work out the utilisation.
+   SYS:load       - The load averages, running and total threads and the 
+                    seconds since boot.
+   SYS:memory     - TOTAL, FREE, AVAILABLE, BUFFERS, CACHED, SHARED, USED, 
+                    SWAP_TOTAL and SWAP_FREE in bytes, as free shows them.
+   SYS:disk       - A list with the DEVICE, MOUNT, TYPE, SIZE, USED, FREE, 
+                    INODES and INODES_FREE of each mounted file system that 
+                    has any blocks, sizes in bytes. FREE is the space free 
+                    to users that are not root, as df shows it. 
+                    SYS:disk=PATH gives the file system holding PATH.
+   SYS:diskio     - Reads, writes, bytes read and written and the seconds 
+                    busy of each block device, since boot.
+   SYS:net        - The bytes, packets, errors and drops received and sent 
+                    on each network interface, since boot.
+   SYS:processes  - A list with the PID, PPID, USER, STATE, NAME, THREADS, 
+                    RSS and VSIZE in bytes, CPU_SECONDS, STARTED (seconds 
+                    since the epoch) and COMMAND of every process.
+   SYS:all        - cpu, load, memory, disk, diskio and net in one reply, 
+                    keyed CPU, LOAD, MEMORY, DISK, DISKIO and NET.
+
+SYS needs a system with /proc (Linux), elsewhere it replies with 261.
+
+SUBSCRIPTIONS
+
+Rather than poll, a client can subscribe to a SYS or OS directive. The 
+Agent then takes a sample every interval seconds and sends it on the 
+session without being asked, until the subscription is stopped or the 
+session ends. SUB needs a framed session (see MESSAGE FRAMING):
+
+   tcp send from client:    SUB;interval=5:start=SYS:load
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"SUBSCRIBED",
+                             SUB_ID:3}
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"SUB SAMPLE",
+                             SUB_ID:3, SUB_SEQ:0, SUB_TIME:1381234567.000124,
+                             SYS_DATA:{LOAD_1:0.52, ...}}
+   ... and another every 5 seconds 
+
+   SUB;interval=N:start=DIRECTIVE - Starts a subscription to a SYS or OS 
+                    directive, options of the directive may be given as 
+                    usual: SUB;interval=10:start=OS;timeout=5:uptime
+   SUB:stop=3     - Stops subscription 3, no sample of it is sent after 
+                    the reply. SUB:stop=all stops every one of the session.
+   SUB:list       - Replies with SUB_LIST, the SUB_ID, REQUEST, INTERVAL, 
+                    SAMPLES and MISSED of each subscription of the session.
+
+A sample is the reply the directive would get, with AGENT_MESSAGE 
+"SUB SAMPLE" unless it failed, plus SUB_ID, SUB_SEQ and SUB_TIME. The 
+samples are timed by a monotonic clock, which is not moved when the system 
+time is set: sample SUB_SEQ is taken SUB_SEQ intervals after the first, 
+however long each sample takes, and SUB_TIME is the system time it was 
+taken at. A sample that falls due while the one before is still being 
+taken, or while the client is behind reading them, is missed and its 
+SUB_SEQ is skipped. The interval is at least 0.1 seconds, the count 
+option ends a subscription after that many intervals and a session may 
+hold 16 subscriptions. Samples are held back during a FILE transfer. 
+Replies to the client's own directives are sent in order as usual, a 
+client tells the samples apart by their SUB_ID.
+
+RESULT CACHE
+
+Controllers ask the same questions of every Agent over and over, uname -a 
+or the release of the OS. Started with --cache=FILE the Agent keeps the 
+replies to the OS and SYS directives listed in FILE and answers repeats 
+from memory, without running anything, until they are too old. Each line 
+of FILE is the seconds a reply is kept for and the message, the command 
+may have shell wildcards, * ? and [...], blank lines and lines starting 
+with # are left out. The first line that matches a message is used:
+
+   # seconds  message
+   86400      OS:cat /etc/os-release
+   3600       OS:uname -a
+   3600       OS:rpm -q *
+   5          SYS:memory
+
+A reply is kept only if the command worked, AGENT_RETURN_CODE and 
+OS_RETURNCODE of 0 and no OS_SPILL. A reply from the cache has CACHE_AGE, 
+the seconds since the command was run. The options of a message, such as 
+timeout, are not part of what is matched, except cache=off which runs the 
+command again and keeps the new reply. At most 256 replies are kept, the 
+one used longest ago is dropped to make room. SUB samples are never taken 
+from the cache. TA replies are not cached, the Agent answers them from 
+memory already. The OS replies of a session with a shell of its own 
+(TA:shell=on) are neither kept nor answered from the cache, they depend on 
+the working directory and environment of that shell.
+
+   CACHE:list             - Replies with CACHE_LIST, the MESSAGE, AGE, 
+                            EXPIRES and HITS of each reply kept, and with 
+                            CACHE_HITS and CACHE_MISSES.
+   CACHE:invalidate       - Drops every reply kept.
+   CACHE:invalidate=MSG   - Drops the replies of the messages matching MSG, 
+                            which may have wildcards: OS:rpm -q *
+
+With --processes each worker process has its own cache, CACHE:invalidate 
+only clears the cache of the process serving the session.
+
+HEALTH PROBE
+
+Checking that an Agent is up over TCP costs a connection, a message and the 
+close of the session. Started with --udp-port=PORT the Agent also answers 
+health probes, UDP datagrams sent to PORT on its address:
+
+   udp send from monitor:   PING:TOKEN
+   udp recv from agent  :   {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"PONG", 
+                             PING_DATA:{NAME:"NO_NAME", VERSION:"1.1.0", 
+                                        LOAD_1:0.08, LOAD_5:0.03, 
+                                        LOAD_15:0.01, UPTIME:86400.5, 
+                                        AGENT_UPTIME:3600.2}, 
+                             PING_TOKEN:"TOKEN"}
+
+UPTIME is the seconds the system has been up, AGENT_UPTIME the seconds the 
+Agent has, the load averages are those of SYS:load (None where the system 
+has no load averages). The TOKEN is optional, at most 64 characters, and 
+comes back as PING_TOKEN so a monitor can probe many Agents from one socket 
+and tell the replies apart. Replies are in the repr encoding unless the 
+probe asks for another one: PING;encoding=binary:TOKEN. Datagrams that are 
+not a PING are not answered. A probe is answered by a thread of its own 
+whatever the serving mode, it never waits for a session or a command. With 
+--processes the supervisor answers the probes, NAME is the name the Agent 
+was started with. PING also works in a session, with the same reply.
+
+STATISTICS
+
+TA:stats replies with AGENT_STATS, the counters of the Agent since it 
+started:
+
+   UPTIME           - Seconds since the Agent started 
+   SESSIONS_ACTIVE  - Sessions open now 
+   SESSIONS_TOTAL   - Sessions since the Agent started 
+   SESSIONS_REAPED  - Sessions closed for being idle or open too long 
+   REQUESTS         - Messages received, by directive. Messages that are 
+                      not DIRECTIVE:COMMAND count as INVALID, directives 
+                      the Agent does not know as UNKNOWN 
+   ERRORS           - Replies sent with a non-zero AGENT_RETURN_CODE, by 
+                      return code 
+   BYTES_IN         - Bytes received from clients 
+   BYTES_OUT        - Bytes sent to clients 
+   COMPRESSION      - BYTES_BEFORE and BYTES_AFTER of the replies and file 
+                      frames that were compressed and RATIO, before over 
+                      after (see COMPRESSION)
+   LATENCY          - Latency histograms of PARSE (splitting a message 
+                      into its parts), EXEC (running an OS command) and 
+                      SEND (encoding a reply and handing it to the socket)
+                      and COMPRESS (compressing a reply or file frame)
+
+Each histogram has the COUNT, TOTAL_MS and MAX_MS of what it measured and 
+BUCKETS, a list of [upper bound in milliseconds, count] pairs. The bounds 
+double from 0.1 ms, the last bucket "inf" counts everything longer. Counts 
+are per bucket, not cumulative.
+
 To connect to an agent using the Python Programming language see the 
 example below
 
@@ -141,6 +538,104 @@ print response                             # Print the closing response
 exit(0)                                    # clean exit
 # --- PROGRAM ENDS HERE --------------------------------------------------------
 
+MESSAGE FRAMING
+
+By default each recv() by the Agent is taken as one message and each reply 
+is sent as is, so a large reply may take several reads by the client and 
+messages sent back to back may be read by the Agent as one. A session can 
+opt in to framed messages with:
+
+   tcp send from client:    TA:framing=on
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"FRAMING ON"}
+
+The reply to TA:framing=on is not framed. After it, every message in either 
+direction is a 4 byte unsigned length in network byte order followed by that 
+many bytes of message. Replies of any size arrive whole and the client may 
+send several messages without waiting for their replies, they are answered 
+in order. Wait for the reply to TA:framing=on before sending framed messages.
+
+   import struct
+   def sendFramed(tcpSocket, message):
+      tcpSocket.sendall(struct.pack("!I", len(message)) + message)
+   def recvFramed(tcpSocket):
+      header = ""
+      while len(header) < 4: header += tcpSocket.recv(4 - len(header))
+      length = struct.unpack("!I", header)[0]
+      chunks = []
+      while length > 0:
+         chunk = tcpSocket.recv(min(length, 262144))
+         chunks.append(chunk)
+         length -= len(chunk)
+      return "".join(chunks)
+
+COMPRESSION
+
+A framed session can have its larger replies compressed with zlib:
+
+   tcp send from client:    TA:compress=on
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"COMPRESS ON"}
+
+TA:compress takes on, off or a zlib level from 1 (fastest) to 9 (smallest), 
+on is level 6. After it, a reply or FILE:get frame of at least the Agent's 
+--compress-threshold bytes (1024 by default) is compressed if that makes it 
+smaller. A compressed frame has the top bit of its length header set, the 
+rest of the header is the length of the compressed bytes:
+
+   import zlib
+   length = struct.unpack("!I", header)[0]
+   ... read length & 0x7fffffff bytes into message ...
+   if length & 0x80000000: message = zlib.decompress(message)
+
+Clients may send compressed frames the same way, whether or not they have 
+turned compression on, for example the data frames of a FILE:put. A 
+compressed frame may not grow past 64M bytes once decompressed. The 
+recvFramed() and sendFramed() of bin/client.py handle compressed frames. 
+Bytes saved and time spent compressing are in TA:stats and, when a 
+session that compressed replies ends, in the log.
+
+REPLY ENCODINGS
+
+Replies are sent as the text of a Python dictionary (or, for a few TA and 
+HELP replies, of a list) unless the session asks for another encoding:
+
+   tcp send from client:    TA:encoding=json
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"ENCODING JSON"}
+
+The reply to TA:encoding is sent in the old encoding. The encodings are:
+
+   repr   - The text of the Python dictionary or list (the default).
+   json   - A JSON object. Every reply, including the ones sent as a list in 
+            the repr encoding, is an object with at least the 
+            AGENT_RETURN_CODE and AGENT_MESSAGE keys. 
+   binary - A compact tagged binary form of the same object, for framed 
+            sessions only. See encodeBinary() for the format.
+
+bin/client.py has decoders for all three encodings.
+
+SERVING MODES
+
+By default the Agent serves one client session at a time. Start the Agent 
+with the --workers=N option to serve up to N client sessions in parallel, 
+each session is handled by one of a pool of N worker threads. The 
+DIRECTIVE:COMMAND protocol is the same in both modes.
+
+On systems with poll() the Agent can instead be started with the --eventloop 
+option. All sessions are then served from a single thread: sockets and the 
+pipes of running OS commands are watched with poll() and OS commands run 
+without blocking the Agent, so one Agent can hold thousands of idle sessions 
+and dozens of running commands. Replies are the same as in the other modes.
+
+For heavy use on a system with several cores, start the Agent with the 
+--processes=N option. The Agent then forks N worker processes and each one 
+opens a listener of its own on the same address and port (SO_REUSEPORT), so 
+the kernel spreads new connections across the workers. Each worker serves 
+its sessions in the mode chosen by the other options (one at a time, 
+--workers or --eventloop). The first process stays on as a supervisor: it 
+writes the log entries of the workers to the one log file and starts a new 
+worker in place of any that dies. TA:shutdown sent to any worker stops the 
+whole group. Jobs, TA:stats and TA:setname belong to the worker that serves 
+the session, a client may reach a different worker on each connection.
+
 Any TCP AF_INET SOCKET_STREAM connections are accepted by the Agent 
 regardless of language used. Please refer to the documentation for your 
 specific language to establish a TCP AF_INET, SOCKET_STREAM connection
@@ -179,7 +674,35 @@ import socket
 import time
 import getopt
 import subprocess
+import select
+import errno
 from thread import start_new_thread
+import Queue
+import struct
+import threading
+import ast
+import json
+import atexit
+import re
+import signal
+import math
+import bisect
+import hashlib
+import zlib
+import heapq
+import mmap
+import tempfile
+import fnmatch
+from collections import OrderedDict
+try:    import resource     # Unix only, used to raise the open file limit 
+except: resource = None
+try:    import fcntl        # Unix only, keeps the sockets of the Agent from OS commands
+except: fcntl = None
+try:    import pwd          # Unix only, names the owners of processes (SYS:processes)
+except: pwd = None
+try:    import ctypes, ctypes.util  # Reads the monotonic clock, see monotonicClock()
+except: ctypes = None
+sendfile = getattr(os, "sendfile", None)  # Python 3.3 and later, else FILE:get reads and sends
 
 # ==============================================================================
 # GLOBALS
@@ -202,6 +725,13 @@ BUF_SIZE      = 14336 # 14k                    # Size of the TCP comm. buffer
 ADDRESS       = (HOST,PORT)                    # Agent socket 
 LOGGING       = False                          # Flag for logging 
 LOG_FILE      = ME + ".log"                    # Log file name 
+LOG_MAX_BYTES = 10485760 # 10M                 # Log file size that starts a new one, 0 never
+LOG_BACKUPS   = 5                              # Old log files kept (.1 to .5)
+LOG_FLUSH_INTERVAL = 1.0                       # Most seconds before log entries are on disk
+LOG_QUEUE_SIZE = 100000                        # Log entries waiting to be written
+LOG_ENTRY_LIMIT = 8192                         # Longer log messages are cut short 
+LOG_CLOSE_TIMEOUT = 10.0                       # Most seconds to write out the log at exit
+RESET_LOG     = "RESET_LOG"                    # Queued by Logger.reset() 
 PAUSE_PROMPT  = "Press <Enter> to continue."   # Pause prompt text
 EXIT_SUCCESS  = 0                              # Exit code 
 USER          = "Unknown"                      # User the agent is running as
@@ -212,7 +742,117 @@ OS_COMMAND        = "OS_COMMAND"        #  \__ Response key names used in
 OS_STDOUT         = "OS_STDOUT"         #  /   the response dictionary 
 OS_STDERR         = "OS_STDERR"         # / 
 OS_RETURNCODE     = "OS_RETURNCODE"     #/
-closeSocketPause = 3 # Time in seconds to wait for the socket to close cleanly
+OS_STREAM         = "OS_STREAM"         # \_ Extra keys in OS-STREAM output 
+OS_DATA           = "OS_DATA"           # /  replies 
+BATCH_RESULTS     = "BATCH_RESULTS"     # List of OS replies in a BATCH reply
+JOB_ID            = "JOB_ID"            # \
+JOB_STATE         = "JOB_STATE"         #  > -- Extra keys in JOB replies 
+JOB_LIST          = "JOB_LIST"          # /
+AGENT_STATS       = "AGENT_STATS"       # Counters in a TA:stats reply 
+FILE_PATH         = "FILE_PATH"         # \
+FILE_SIZE         = "FILE_SIZE"         #  \_ Extra keys in FILE replies 
+FILE_OFFSET       = "FILE_OFFSET"       #  / 
+FILE_CHECKSUM     = "FILE_CHECKSUM"     # /
+SYS_DATA          = "SYS_DATA"          # Counters in a SYS reply 
+SUB_ID            = "SUB_ID"            # \
+SUB_SEQ           = "SUB_SEQ"           #  \_ Extra keys in SUB replies 
+SUB_TIME          = "SUB_TIME"          #  /  and samples 
+SUB_LIST          = "SUB_LIST"          # /
+OS_SPILL          = "OS_SPILL"          # \
+SPILL_ID          = "SPILL_ID"          #  \
+SPILL_SIZE        = "SPILL_SIZE"        #   > -- Extra keys in OS replies with 
+SPILL_OFFSET      = "SPILL_OFFSET"      #  /     large output and SPILL replies
+SPILL_LIST        = "SPILL_LIST"        # /
+CACHE_AGE         = "CACHE_AGE"         # \
+CACHE_LIST        = "CACHE_LIST"        #  \_ Extra keys in cached replies and 
+CACHE_HITS        = "CACHE_HITS"        #  /  CACHE replies 
+CACHE_MISSES      = "CACHE_MISSES"      # /
+PING_DATA         = "PING_DATA"         # \_ Extra keys in PING replies 
+PING_TOKEN        = "PING_TOKEN"        # /
+ENCODINGS     = ("repr", "json", "binary")     # Reply encodings (TA:encoding)
+BINARY_KEYS   = [AGENT_RETURN_CODE, AGENT_MESSAGE, OS_COMMAND, OS_STDOUT, 
+                 OS_STDERR, OS_RETURNCODE, OS_STREAM, OS_DATA, BATCH_RESULTS,
+                 JOB_ID, JOB_STATE, JOB_LIST, AGENT_STATS, FILE_PATH, 
+                 FILE_SIZE, FILE_OFFSET, FILE_CHECKSUM, SYS_DATA, SUB_ID, 
+                 SUB_SEQ, SUB_TIME, SUB_LIST, OS_SPILL, SPILL_ID, SPILL_SIZE, 
+                 SPILL_OFFSET, SPILL_LIST, CACHE_AGE, CACHE_LIST, CACHE_HITS, 
+                 CACHE_MISSES, PING_DATA, PING_TOKEN]
+                               # New keys go on the end, clients index the list
+BINARY_KEY_INDEX = dict([(key, index) for index, key in enumerate(BINARY_KEYS)])
+WORKERS       = 1                              # Number of session worker threads 
+FRAME_HEADER  = "!I"                           # Length header of a framed message 
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)  # Bytes in a length header
+FRAME_RECV_SIZE   = 262144 # 256k              # Receive size for framed sessions
+MAX_FRAME     = 67108864 # 64M                 # Largest framed message accepted
+FRAME_COMPRESSED = 0x80000000                  # Length header bit of a compressed frame
+COMPRESS_LEVEL = 6                             # zlib level of TA:compress=on
+COMPRESS_THRESHOLD = 1024                      # Smallest frame compressed, in bytes
+OS_TIMEOUT    = 0                              # Seconds an OS command may run, 0 no limit
+TIMEOUT_RETURNCODE = 124                       # OS_RETURNCODE of a command that timed out
+KILL_GRACE    = 1.0                            # Seconds to wait for the pipes of a killed command
+SHELL         = "/bin/sh"                      # Shell kept by a session for OS commands
+PERSISTENT_SHELL = False                       # Sessions start with a shell (TA:shell)
+MAX_PARALLEL  = 8                              # Most BATCH commands run at once 
+JOB_WORKERS   = 4                              # Most jobs run at once 
+JOB_QUEUE     = "fifo"                         # Order jobs are run in, fifo or priority
+JOB_QUEUES    = ("fifo", "priority")           # Valid job queue orders 
+MAX_JOBS      = 1000                           # Most jobs held until collected 
+JOB_QUEUED    = "QUEUED"                       # \
+JOB_RUNNING   = "RUNNING"                      #  \_ Job states 
+JOB_DONE      = "DONE"                         #  /
+JOB_CANCELLED = "CANCELLED"                    # /
+OFFLOADED_DIRECTIVES = ("BATCH", "FILE", "SYS", "SPILL") # Run off the event loop thread 
+DIRECTIVES    = ("TA", "OS", "OS-STREAM", "BATCH", "JOB", "FILE", "SYS", "SUB", "SPILL", 
+                 "CACHE", "PING", "HELP")      # Counted by name in TA:stats
+CACHE_FILE    = None                           # Cacheable messages, see RESULT CACHE 
+CACHED_DIRECTIVES = ("OS", "SYS")              # Directives whose replies may be cached 
+CACHE_ENTRIES = 256                            # Most replies cached 
+CAPTURE_LIMIT = 16777216 # 16M                 # Output of a command kept in memory, 0 no limit
+SPILL_EXCERPT = 65536 # 64k                    # Bytes of spilled output kept for the reply, each end
+SPILL_LIMIT   = 1073741824 # 1G                # Most bytes kept in a spill file 
+SPILL_CHUNK   = 1048576 # 1M                   # Bytes of a SPILL:read without a size 
+SPILL_READ_MAX = 4194304 # 4M                  # Most bytes of one SPILL:read 
+SPILL_TTL     = 600                            # Seconds an unread spill is kept 
+MAX_SPILLS    = 100                            # Most spills held 
+PROC          = "/proc"                        # Where SYS reads the system counters 
+UDP_PORT      = 0                              # Port of the health probe (UDP), 0 off
+PROBE_BUF_SIZE = 512                           # Longest health probe datagram read
+PROBE_TOKEN_MAX = 64                           # Longest PING token sent back
+SYS_COMMANDS  = ("cpu", "load", "memory", "disk", "diskio", "net", "processes", "all")
+CPU_STATES    = ("USER", "NICE", "SYSTEM", "IDLE", "IOWAIT", "IRQ", "SOFTIRQ", "STEAL")
+SECTOR_SIZE   = 512                            # Bytes in a /proc/diskstats sector
+SYS_ERRORS    = (IOError, OSError, ValueError, IndexError)  # Raised reading system counters
+SUB_DIRECTIVES = ("SYS", "OS")                 # Directives a subscription can sample
+MIN_SUB_INTERVAL = 0.1                         # Fewest seconds between samples (SUB)
+MAX_SUBSCRIPTIONS = 16                         # Most subscriptions held by a session
+CLOCK_MONOTONIC = 1                            # clock_gettime() clock, see monotonicClock()
+FILE_CHUNK    = 262144 # 256k                  # Most bytes of a file in one frame (FILE)
+CHECKSUMS     = ("md5", "sha1", "sha256", "sha512")  # FILE checksum option values 
+LATENCY_BUCKETS = [0.0001 * 2 ** i for i in range(18)]  # Histogram bounds, 0.1 ms to 13 s
+EVENT_LOOP    = False                          # Flag for the single thread event loop
+PIPE_CHUNK    = 65536                          # Bytes read from a command pipe at once
+STREAM_BACKLOG = 16                            # Queued reply pieces that pause a stream 
+EXIT_SPIN     = 0.001                          # Most seconds the loop waits for a command to exit
+EXIT_POLL_FIRST = 0.001                        # Seconds to the first check on an exiting command
+EXIT_POLL     = 0.05                           # Most seconds between checks on exiting commands
+LISTEN_BACKLOG = 128                           # Connections waiting to be accepted
+ACCEPT_POLL   = 0.5                            # Seconds between listener shutdown checks
+PROCESSES     = 1                              # Worker processes sharing the port, 1 no fork
+REUSE_PORT    = getattr(socket, "SO_REUSEPORT", 15 if sys.platform.startswith("linux") else None)
+WORKER_POLL   = 1.0                            # Seconds between supervisor checks on the workers
+WORKER_RESTART_DELAY = 1.0                     # Seconds before restarting a worker that died young
+WORKER_STOP_TIMEOUT = 10.0                     # Seconds workers have to stop before they are killed
+RUNNING       = True                           # Flag for the listener loop 
+SESSION_CONTINUE  = 0                   #\
+SESSION_CLOSE     = 1                   # > -- Session actions returned by the 
+AGENT_SHUTDOWN    = 2                   #/     directive processors 
+CLOSE_LINGER  = 2.0 # Most seconds to wait for a client to close its end of a session
+IDLE_TIMEOUT  = 0                              # Seconds a session may send nothing, 0 no limit
+SESSION_LIFETIME = 0                           # Seconds a session may be open, 0 no limit
+KEEPALIVE_IDLE = 60                            # Seconds without traffic before keepalive probes, 0 off
+KEEPALIVE_INTERVAL = 10                        # Seconds between keepalive probes 
+KEEPALIVE_COUNT = 5                            # Unanswered probes that end a connection 
+REAP_INTERVAL = 1.0                            # Seconds between EventLoop checks for sessions to reap
 helpMessage      = """
 Agent commands must be of the form TA:command or OS:command.
 
@@ -230,12 +870,19 @@ class Command:
          _stdout
          _stderr
          command
+         process
          output
          error
+         spills
          returnCode
+         timedOut
       Methods:
          __init__()
          run()
+         stream()
+         _start()
+         _communicate()
+         kill()
          showResults()
          returnResults()			 
    """
@@ -243,26 +890,110 @@ class Command:
    def __init__(self, command):
       """ Creates an instance of an object of type Command. """
       self.command    = str(command).strip()   # The command to execute 
+      self.process    = None                   # The running command (see kill())
       self._stdout    = subprocess.PIPE        # Standard Output PIPE 
       self._stderr    = subprocess.PIPE        # Standard Error PIPE 
       self.output     = "Command not executed" # Output from command 
       self.error      = "Command not executed" # Error from command
+      self.spills     = {}                     # Spills of output too large to keep (run())
       self.returnCode = 127                    # Return code from command                
+      self.timedOut   = False                  # Killed for running too long 
    
    # ------------------------------------------------------------- Command.run()
-   def run(self): 
-      """ Executes the command in the specified shell. """
+   def run(self, timeout = None): 
+      """ Executes the command in the specified shell. If the command has not 
+          finished after timeout seconds it is killed, the output up to then 
+          is kept and timedOut is set. Output past CAPTURE_LIMIT is spilled, 
+          see Capture. """
+      if not self._start(): return 
+      captures = {OS_STDOUT : Capture(self.command, OS_STDOUT), 
+                  OS_STDERR : Capture(self.command, OS_STDERR)}
+      self._communicate(lambda key, data: captures[key].add(data), timeout)
+      self.output = captures[OS_STDOUT].text()
+      self.error  = captures[OS_STDERR].text()
+      self.spills = spillsOf(captures)
+
+   # ---------------------------------------------------------- Command.stream()
+   def stream(self, onOutput, timeout = None):
+      """ Executes the command in the specified shell and hands its output to
+          onOutput(OS_STDOUT or OS_STDERR, data) as it is produced. Nothing
+          is kept, self.output and self.error are left empty. The timeout is 
+          as for run(). """
+      if not self._start(): return 
+      self.output = ""
+      self.error  = ""
+      self._communicate(onOutput, timeout)
+
+   # ---------------------------------------------------------- Command._start()
+   def _start(self):
+      """ Starts the command in a process group of its own (see kill()), 
+          returns False if it could not be started. """
       try:
-         results = subprocess.Popen(self.command, 
-                                    stdout = self._stdout ,
-                                    shell  = True         , 
-                                    stderr = self._stderr ) # Execute the command 
-         self.output, self.error = results.communicate()    # Get output and error 
-         self.returnCode         = results.returncode       # Get Return Code
+         self.process = subprocess.Popen(self.command, 
+                                         stdout     = self._stdout ,
+                                         shell      = True         , 
+                                         stderr     = self._stderr , 
+                                         preexec_fn = os.setsid    ) # Execute the command 
+         return True
       except Exception as e:
          self.output      = str(e) 
          self.error       = "Unable to execute: \"%s\"" %self.command 
          self.returnCode  = 113
+         return False
+
+   # ---------------------------------------------------- Command._communicate()
+   def _communicate(self, onOutput, timeout):
+      """ Hands the output of the running command to onOutput() until it 
+          closes its pipes, then gets the return code. Past the timeout the 
+          command is killed and, once its pipes have closed or KILL_GRACE 
+          seconds later, the return code is TIMEOUT_RETURNCODE. """
+      started  = time.time()
+      process  = self.process
+      pipes    = {process.stdout.fileno() : OS_STDOUT ,
+                  process.stderr.fileno() : OS_STDERR }
+      poller   = select.poll()
+      for fd in pipes: poller.register(fd, select.POLLIN)
+      deadline = None
+      if timeout: deadline = time.time() + timeout
+      try:
+         while pipes:
+            wait = None 
+            if deadline is not None: wait = max(0, deadline - time.time()) * 1000
+            events = poller.poll(wait)
+            if not events and deadline is not None and time.time() >= deadline:
+               if self.timedOut: break # Something the command started has the pipes
+               self.timedOut = True
+               self.kill()
+               deadline = time.time() + KILL_GRACE
+            for fd, mask in events:
+               data = os.read(fd, PIPE_CHUNK)
+               if data: 
+                  onOutput(pipes[fd], data)
+               else:
+                  poller.unregister(fd)
+                  del pipes[fd]
+      except:
+         self.kill()   # Nobody left to hand the output to 
+         raise
+      finally:
+         process.stdout.close()
+         process.stderr.close()
+         self.returnCode = process.wait()
+         stats.executed(time.time() - started)
+      if self.timedOut: self.returnCode = TIMEOUT_RETURNCODE
+
+   # ------------------------------------------------------------ Command.kill()
+   def kill(self):
+      """ Kills the command if it is running, may be called from any thread. 
+          run() starts the command in a process group of its own, the whole 
+          group is killed so that nothing started by the command is left 
+          holding its pipes. """
+      process = self.process
+      if process is not None and process.returncode is None:
+         try:
+            os.killpg(process.pid, signal.SIGKILL)
+         except OSError:
+            pass # Already gone 
 
    # ----------------------------------------------------- Command.showResults()
    def showResults(self):
@@ -278,14 +1009,650 @@ class Command:
       results = {"command"    : self.command.strip() ,
                  "output"     : self.output.strip()  ,
                  "error"      : self.error.strip()   ,
-                 "returnCode" : self.returnCode      }
+                 "returnCode" : self.returnCode      ,
+                 "timedOut"   : self.timedOut        ,
+                 "spills"     : self.spills          }
       return results    
 
-	  
+
+# ====================================================================== Shell()
+class Shell:
+   """ 
+   Shell() --> Shell Object
+      A long lived shell that runs the OS directives of one session, so 
+      a command does not have to start a shell of its own and the working 
+      folder and environment carry over from one command to the next. Each 
+      command is followed by an end marker on stdout, with the return code, 
+      and on stderr. The output of the command is read up to the markers. 
+      If the shell dies (for example on an "exit" command) it is started 
+      again for the next command.
+      Members:
+         process
+         count
+      Methods:
+         __init__()
+         start()
+         alive()
+         run()
+         _read()
+         _died()
+         close()
+   """
+   #----------------------------------------------------------- Shell.__init__()
+   def __init__(self):
+      """ Creates an instance of an object of type Shell. """
+      self.process = None  # The running shell 
+      self.count   = 0     # Commands run, part of the end markers 
+
+   # ---------------------------------------------------------- Shell.start()
+   def start(self):
+      """ Starts the shell in a process group of its own, so a command that 
+          times out can be killed with everything it started. The shell must 
+          not hold on to the sockets of the Agent, so the file descriptors 
+          of the Agent are closed in it. """
+      self.process = subprocess.Popen([SHELL]                    ,
+                                      stdin      = subprocess.PIPE ,
+                                      stdout     = subprocess.PIPE ,
+                                      stderr     = subprocess.PIPE ,
+                                      close_fds  = True            ,
+                                      preexec_fn = os.setsid       )
+
+   # ---------------------------------------------------------- Shell.alive()
+   def alive(self):
+      """ Returns True if the shell is running. """
+      return self.process is not None and self.process.poll() is None
+
+   # ------------------------------------------------------------ Shell.run()
+   def run(self, command, timeout = None):
+      """ Executes the command in the shell and returns a dictionary like 
+          Command.returnResults(). "command eval" keeps a syntax error in 
+          the command from ending the shell. A command that runs for more 
+          than timeout seconds is killed along with the shell. """
+      command = str(command).strip()
+      started = time.time()
+      try:
+         if not self.alive(): self.start()
+         self.count += 1
+         marker = "AGENT_END_%d_%s" %(self.count, os.urandom(8).encode("hex"))
+         script = "command eval '%s' </dev/null\n"  %command.replace("'", "'\\''") + \
+                  "printf '\\n%s %%d\\n' $?\n"     %marker + \
+                  "printf '\\n%s\\n' >&2\n"        %marker 
+         self.process.stdin.write(script)
+         self.process.stdin.flush()
+         captures = {OS_STDOUT : Capture(command, OS_STDOUT), 
+                     OS_STDERR : Capture(command, OS_STDERR)}
+         returnCode, timedOut = self._read(marker, timeout, captures)
+         stats.executed(time.time() - started)
+      except Exception as e:
+         self.close()
+         return {"command"    : command                         ,
+                 "output"     : str(e)                          ,
+                 "error"      : "Unable to execute: \"%s\"" %command ,
+                 "returnCode" : 113                             ,
+                 "timedOut"   : False                           }
+      return {"command"    : command                           ,
+              "output"     : captures[OS_STDOUT].text().strip() ,
+              "error"      : captures[OS_STDERR].text().strip() ,
+              "returnCode" : returnCode                        ,
+              "timedOut"   : timedOut                          ,
+              "spills"     : spillsOf(captures)                }
+
+   # ------------------------------------------------------------ Shell._read()
+   def _read(self, marker, timeout, captures):
+      """ Reads stdout and stderr up to the end markers into the captures 
+          (see Capture) and returns the return code of the command and 
+          whether it timed out. Past the timeout the shell is killed and 
+          TIMEOUT_RETURNCODE is returned. """
+      ends   = {OS_STDOUT : re.compile("\n%s (-?\\d+)\n$" %marker) ,
+                OS_STDERR : re.compile("\n%s\n$" %marker)          }
+      pipes  = {self.process.stdout.fileno() : OS_STDOUT ,
+                self.process.stderr.fileno() : OS_STDERR }
+      tails  = {OS_STDOUT : "", OS_STDERR : ""}   # Where the markers turn up
+      found  = {}
+      poller = select.poll()
+      for fd in pipes: poller.register(fd, select.POLLIN)
+      deadline = None
+      if timeout: deadline = time.time() + timeout
+      while pipes:
+         wait = None 
+         if deadline is not None: wait = max(0, deadline - time.time()) * 1000
+         events = poller.poll(wait)
+         if not events and deadline is not None and time.time() >= deadline:
+            self.close() # Kills the shell and what it is running 
+            return TIMEOUT_RETURNCODE, True
+         for fd, mask in events:
+            key  = pipes[fd]
+            data = os.read(fd, PIPE_CHUNK)
+            if not data: # The command has ended the shell 
+               return self._died(), False
+            captures[key].add(data)
+            tails[key] = (tails[key] + data)[-(len(marker) + 16):]
+            match = ends[key].search(tails[key])
+            if match:
+               found[key] = match
+               poller.unregister(fd)
+               del pipes[fd]
+      for key in found: captures[key].cut(len(found[key].group(0)))
+      return int(found[OS_STDOUT].group(1)), False
+
+   # ------------------------------------------------------------ Shell._died()
+   def _died(self):
+      """ Cleans up after a shell that has ended and returns its exit code. """
+      process = self.process
+      self.close()
+      return process.returncode
+
+   # ------------------------------------------------------------ Shell.close()
+   def close(self):
+      """ Ends the shell. """
+      process = self.process
+      if process is None: return
+      self.process = None
+      try:
+         if process.poll() is None: os.killpg(process.pid, signal.SIGKILL)
+      except OSError:
+         pass # Already gone 
+      process.wait()
+      for pipe in (process.stdin, process.stdout, process.stderr):
+         try:
+            pipe.close()
+         except IOError:
+            pass 
+# === End of class Shell =====	  
+
+# ==================================================================== Capture()
+class Capture:
+   """ 
+   Capture() --> Capture Object
+      Collects one output stream (OS_STDOUT or OS_STDERR) of a command. Up to 
+      CAPTURE_LIMIT bytes are kept in memory. Past that the output goes to a 
+      Spill, only its first and last SPILL_EXCERPT bytes are kept for the 
+      reply and the rest is read with the SPILL directive. 
+      Members:
+         command
+         key
+         chunks
+         size
+         head
+         tail
+         spill
+         spilled
+      Methods:
+         __init__()
+         add()
+         cut()
+         text()
+         _spill()
+   """
+   #--------------------------------------------------------- Capture.__init__()
+   def __init__(self, command, key):
+      """ Creates an instance of an object of type Capture. """
+      self.command = command   # The command, for SPILL:list 
+      self.key     = key       # OS_STDOUT or OS_STDERR 
+      self.chunks  = []        # Output kept in memory, until spilled 
+      self.size    = 0         # Bytes of output 
+      self.head    = ""        # \_ First and last bytes of spilled output 
+      self.tail    = ""        # /
+      self.spill   = None      # Where the output went, None if it could not be kept
+      self.spilled = False     # Output went past CAPTURE_LIMIT 
+
+   # --------------------------------------------------------------- Capture.add()
+   def add(self, data):
+      """ Adds output of the command. """
+      self.size += len(data)
+      if not self.spilled:
+         self.chunks.append(data)
+         if CAPTURE_LIMIT and self.size > CAPTURE_LIMIT: self._spill()
+         return
+      if self.spill is not None and not self.spill.write(data): self.spill = None
+      self.tail = (self.tail + data)[-SPILL_EXCERPT:]
+
+   # --------------------------------------------------------------- Capture.cut()
+   def cut(self, length):
+      """ Takes length bytes off the end of the output, such as the end 
+          marker of a Shell. """
+      self.size -= length
+      if not self.spilled:
+         output = "".join(self.chunks)
+         self.chunks = [output[:len(output) - length]]
+         return
+      self.tail = self.tail[:max(0, len(self.tail) - length)]
+      if self.spill is not None: self.spill.cut(length)
+
+   # -------------------------------------------------------------- Capture.text()
+   def text(self):
+      """ Returns the output for the reply, for spilled output its first and 
+          last bytes and a note of what was left out. """
+      if not self.spilled: return "".join(self.chunks)
+      left = self.size - len(self.head) - len(self.tail)
+      if self.spill is None: 
+         note = "%d bytes not shown, they could not be kept" %left
+      else:                  
+         note = "%d bytes not shown, see SPILL:read=%d" %(left, self.spill.spillId)
+      return "%s\n\n... %s ...\n\n%s" %(self.head, note, self.tail)
+
+   # ----------------------------------------------------------- Capture._spill()
+   def _spill(self):
+      """ Moves the output kept so far to a Spill. """
+      output = "".join(self.chunks)
+      self.chunks  = []
+      self.spilled = True
+      self.head    = output[:SPILL_EXCERPT]
+      self.tail    = output[-SPILL_EXCERPT:]
+      self.spill   = spills.create(self.command, self.key)
+      if self.spill is not None and not self.spill.write(output): self.spill = None
+# === End of class Capture =====	  
+
+# ====================================================================== Spill()
+class Spill:
+   """ 
+   Spill() --> Spill Object
+      Output of a command spilled to a temporary file by a Capture. The file 
+      is deleted as soon as it is opened, it lasts as long as the Agent 
+      holds it open. Reads are served from a memory map of the file.
+      Members:
+         spillId
+         command
+         key
+         fd
+         size
+         lost
+         map
+         lock
+         lastUsed
+      Methods:
+         __init__()
+         write()
+         cut()
+         read()
+         describe()
+         close()
+   """
+   #----------------------------------------------------------- Spill.__init__()
+   def __init__(self, spillId, command, key):
+      """ Creates an instance of an object of type Spill, raises OSError if 
+          the file cannot be made. """
+      self.spillId  = spillId            # Number the client reads it by 
+      self.command  = command            # The command the output is from 
+      self.key      = key                # OS_STDOUT or OS_STDERR 
+      fd, path = tempfile.mkstemp(prefix = "%s_spill_" %ME)
+      os.unlink(path)
+      closeOnExec(fd)
+      self.fd       = fd                 # The open, deleted, file 
+      self.size     = 0                  # Bytes in the file 
+      self.lost     = 0                  # Bytes past SPILL_LIMIT not kept 
+      self.map      = None               # Memory map of the file, made by read()
+      self.lock     = threading.Lock()   # Guards the map 
+      self.lastUsed = time.time()        # Time of the last write or read 
+
+   # -------------------------------------------------------------- Spill.write()
+   def write(self, data):
+      """ Adds output to the file, up to SPILL_LIMIT bytes. Returns False if 
+          the file could not be written, the spill is then dropped. """
+      keep = data[:max(0, SPILL_LIMIT - self.size)]
+      self.lost += len(data) - len(keep)
+      try:
+         while keep:
+            written = os.write(self.fd, keep)
+            self.size += written
+            keep = keep[written:]
+      except OSError as e:
+         message = "Unable to spill the output of \"%s\" - %s" %(self.command, str(e))
+         showWarning(message)
+         if LOGGING: log.logit(message, WARN)
+         spills.drop(self.spillId)
+         return False
+      self.lastUsed = time.time()
+      return True
+
+   # ---------------------------------------------------------------- Spill.cut()
+   def cut(self, length):
+      """ Takes length bytes off the end of the file. """
+      length = max(0, length - self.lost)
+      self.size = max(0, self.size - length)
+      os.ftruncate(self.fd, self.size)
+      os.lseek(self.fd, self.size, os.SEEK_SET)
+
+   # --------------------------------------------------------------- Spill.read()
+   def read(self, offset, length):
+      """ Returns up to length bytes of the output from offset. """
+      with self.lock:
+         self.lastUsed = time.time()
+         if offset >= self.size: return ""
+         if self.map is None or len(self.map) != self.size:
+            if self.map is not None: self.map.close()
+            self.map = mmap.mmap(self.fd, self.size, access = mmap.ACCESS_READ)
+         return self.map[offset:offset + length]
+
+   # ----------------------------------------------------------- Spill.describe()
+   def describe(self):
+      """ Returns the dictionary used for the spill in replies. """
+      return {SPILL_ID   : self.spillId ,
+              SPILL_SIZE : self.size    }
+
+   # -------------------------------------------------------------- Spill.close()
+   def close(self):
+      """ Closes the file, which deletes it. """
+      with self.lock:
+         if self.map is not None: self.map.close()
+         self.map = None
+         if self.fd is not None: os.close(self.fd)
+         self.fd = None
+# === End of class Spill =====	  
+
+# =============================================================== SpillManager()
+class SpillManager:
+   """ 
+   SpillManager() --> SpillManager Object
+      Holds the spills of the Agent, any session may read them. Spills not 
+      read for SPILL_TTL seconds are dropped, as is the oldest spill when 
+      MAX_SPILLS are held.
+      Members:
+         spills
+         lock
+         lastId
+      Methods:
+         __init__()
+         create()
+         get()
+         drop()
+         list()
+         _expire()
+   """
+   #---------------------------------------------------- SpillManager.__init__()
+   def __init__(self):
+      """ Creates an instance of an object of type SpillManager. """
+      self.spills = {}                # Spill ID --> Spill 
+      self.lock   = threading.Lock()  # Guards the spills 
+      self.lastId = 0                 # ID of the last spill 
+
+   # ------------------------------------------------------ SpillManager.create()
+   def create(self, command, key):
+      """ Returns a new Spill for output of command, None if its file could 
+          not be made. """
+      with self.lock:
+         self._expire()
+         if len(self.spills) >= MAX_SPILLS:
+            self.spills.pop(min(self.spills)).close()
+         try:
+            spill = Spill(self.lastId + 1, command, key)
+         except (IOError, OSError) as e:
+            message = "Unable to spill the output of \"%s\" - %s" %(command, str(e))
+            showWarning(message)
+            if LOGGING: log.logit(message, WARN)
+            return None
+         self.lastId += 1
+         self.spills[spill.spillId] = spill
+         return spill
+
+   # --------------------------------------------------------- SpillManager.get()
+   def get(self, spillId):
+      """ Returns a spill, None if there is no such spill. """
+      with self.lock:
+         self._expire()
+         return self.spills.get(spillId)
+
+   # -------------------------------------------------------- SpillManager.drop()
+   def drop(self, spillId):
+      """ Deletes a spill, returns False if there is no such spill. """
+      with self.lock:
+         spill = self.spills.pop(spillId, None)
+      if spill is None: return False
+      spill.close()
+      return True
+
+   # -------------------------------------------------------- SpillManager.list()
+   def list(self):
+      """ Returns the spills held, oldest first. """
+      with self.lock:
+         self._expire()
+         return [self.spills[spillId] for spillId in sorted(self.spills)]
+
+   # ----------------------------------------------------- SpillManager._expire()
+   def _expire(self):
+      """ Drops the spills not used for SPILL_TTL seconds, with the lock 
+          held. """
+      oldest = time.time() - SPILL_TTL
+      for spillId, spill in self.spills.items():
+         if spill.lastUsed < oldest: self.spills.pop(spillId).close()
+# === End of class SpillManager =====	  
+
+# ================================================================ ResultCache()
+class ResultCache:
+   """ 
+   ResultCache() --> ResultCache Object
+      Replies to OS and SYS messages kept to answer repeats of them without 
+      running anything, see RESULT CACHE. Only the messages matching a rule 
+      are kept, each for the seconds of its rule. The reply used longest 
+      ago is dropped once CACHE_ENTRIES are kept.
+      Members:
+         rules
+         entries
+         lock
+         hits
+         misses
+      Methods:
+         __init__()
+         load()
+         get()
+         store()
+         invalidate()
+         list()
+         _shared()
+         _ttl()
+   """
+   #----------------------------------------------------- ResultCache.__init__()
+   def __init__(self):
+      """ Creates an instance of an object of type ResultCache. """
+      self.rules   = []                 # (directive, command pattern, seconds) 
+      self.entries = OrderedDict()      # "DIRECTIVE:COMMAND" --> [stored, expires, reply, hits], oldest used first
+      self.lock    = threading.Lock()   # Guards the entries 
+      self.hits    = 0                  # Replies sent from the cache 
+      self.misses  = 0                  # Replies stored in the cache 
+
+   # -------------------------------------------------------- ResultCache.load()
+   def load(self, path):
+      """ Reads the rules from a file of "SECONDS DIRECTIVE:COMMAND" lines, 
+          raises IOError if the file cannot be read and ValueError for a bad 
+          line. """
+      rules     = []
+      cacheFile = open(path)
+      try:
+         for number, line in enumerate(cacheFile):
+            line = line.strip()
+            if not line or line.startswith("#"): continue
+            try:
+               seconds, message = line.split(None, 1)
+               seconds = float(seconds)
+               directive, options, command = parseMessage(message)
+               if seconds <= 0 or directive not in CACHED_DIRECTIVES: raise ValueError()
+            except (ValueError, TypeError):
+               raise ValueError("line %d of %s must be SECONDS followed by an %s message" 
+                                %(number + 1, path, " or ".join(CACHED_DIRECTIVES)))
+            rules.append((directive, command, seconds))
+      finally:
+         cacheFile.close()
+      self.rules = rules
+
+   # --------------------------------------------------------- ResultCache.get()
+   def get(self, session, parts):
+      """ Returns the cached reply to a message of a session, parts as 
+          returned by parseMessage(), with its CACHE_AGE, or None. """
+      if not self.rules or parts is None: return None
+      directive, options, command = parts
+      if directive not in CACHED_DIRECTIVES or options.get("cache") == "off": return None
+      if not self._shared(session, directive): return None
+      key = "%s:%s" %(directive, command)
+      with self.lock:
+         entry = self.entries.pop(key, None)
+         if entry is None: return None
+         stored, expires, response, hits = entry
+         current = monotonic()
+         if current >= expires: return None
+         self.entries[key] = entry # Now the one used last 
+         entry[3]  += 1
+         self.hits += 1
+      response = dict(response)
+      response[CACHE_AGE] = round(current - stored, 3)
+      return response
+
+   # ------------------------------------------------------- ResultCache.store()
+   def store(self, session, directive, command, response):
+      """ Keeps the reply to a message of a session if a rule allows it and 
+          the command worked. """
+      if not self.rules or not self._shared(session, directive): return 
+      if response.get(AGENT_RETURN_CODE) != 0 or response.get(OS_RETURNCODE, 0) != 0 or \
+         OS_SPILL in response: return
+      seconds = self._ttl(directive, command)
+      if seconds is None: return 
+      key     = "%s:%s" %(directive, command)
+      current = monotonic()
+      with self.lock:
+         self.entries.pop(key, None)
+         self.entries[key] = [current, current + seconds, response, 0]
+         self.misses += 1
+         while len(self.entries) > CACHE_ENTRIES: self.entries.popitem(last = False)
+
+   # -------------------------------------------------- ResultCache.invalidate()
+   def invalidate(self, pattern = "*"):
+      """ Drops the replies of the messages matching pattern and returns how 
+          many were dropped. """
+      with self.lock:
+         keys = [key for key in self.entries if fnmatch.fnmatchcase(key, pattern)]
+         for key in keys: del self.entries[key]
+      return len(keys)
+
+   # -------------------------------------------------------- ResultCache.list()
+   def list(self):
+      """ Returns the replies kept, for CACHE:list, and drops the ones that 
+          are too old. """
+      current = monotonic()
+      entries = []
+      with self.lock:
+         for key, (stored, expires, response, hits) in self.entries.items():
+            if current >= expires: 
+               del self.entries[key]
+               continue
+            entries.append({"MESSAGE" : key                          ,
+                            "AGE"     : round(current - stored, 3)   ,
+                            "EXPIRES" : round(expires - current, 3)  ,
+                            "HITS"    : hits                         })
+      return entries
+
+   # ----------------------------------------------------- ResultCache._shared()
+   def _shared(self, session, directive):
+      """ Returns False for the OS messages of a session with a shell of its 
+          own (TA:shell), their replies depend on the cwd and environment of 
+          that shell and are neither given to nor taken from other sessions. """
+      return not (directive == "OS" and session.useShell)
+
+   # -------------------------------------------------------- ResultCache._ttl()
+   def _ttl(self, directive, command):
+      """ Returns the seconds the reply to a message is kept for, None if 
+          no rule matches it. """
+      for ruleDirective, pattern, seconds in self.rules:
+         if ruleDirective == directive and fnmatch.fnmatchcase(command, pattern): 
+            return seconds
+      return None
+# === End of class ResultCache =====	  
+
+# ================================================================ HealthProbe()
+class HealthProbe:
+   """ 
+   HealthProbe() --> HealthProbe Object
+      Answers the PING datagrams of monitors on a UDP port, from a thread of 
+      its own, see HEALTH PROBE. 
+      Members:
+         udpSocket
+         running
+         answered
+         ignored
+      Methods:
+         __init__()
+         start()
+         close()
+         _serve()
+         _answer()
+   """
+   #----------------------------------------------------- HealthProbe.__init__()
+   def __init__(self, address):
+      """ Creates an instance of an object of type HealthProbe bound to the 
+          (host, port) address, raises socket.error when it cannot bind. """
+      self.udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      closeOnExec(self.udpSocket.fileno())
+      try:
+         self.udpSocket.bind(address)
+      except socket.error:
+         self.udpSocket.close()
+         raise
+      # The thread polls so that close() is noticed 
+      self.udpSocket.settimeout(ACCEPT_POLL)
+      self.running  = False    # Flag for the probe thread 
+      self.answered = 0        # Probes answered 
+      self.ignored  = 0        # Datagrams that were not a PING 
+
+   # -------------------------------------------------------- HealthProbe.start()
+   def start(self):
+      """ Starts answering probes in the background. """
+      self.running = True
+      thread = threading.Thread(target = self._serve)
+      thread.daemon = True
+      thread.start()
+
+   # -------------------------------------------------------- HealthProbe.close()
+   def close(self):
+      """ Stops answering probes and closes the socket. """
+      self.running = False
+      self.udpSocket.close()
+
+   # ------------------------------------------------------- HealthProbe._serve()
+   def _serve(self):
+      """ Probe thread body, answers datagrams until closed. """
+      while self.running:
+         try:
+            data, remoteAddr = self.udpSocket.recvfrom(PROBE_BUF_SIZE)
+         except socket.timeout:
+            continue
+         except socket.error as e:
+            if not self.running: return
+            if e[FIRST] == errno.EINTR: continue
+            showWarning("Health probe failed to receive - %s" %str(e))
+            continue
+         reply = self._answer(data)
+         if reply is None: continue
+         try:
+            self.udpSocket.sendto(reply, remoteAddr)
+         except socket.error as e:
+            if DEBUG: showWarning("Unable to answer the probe of %s - %s" %(str(remoteAddr), str(e)))
+
+   # ------------------------------------------------------ HealthProbe._answer()
+   def _answer(self, data):
+      """ Returns the encoded reply to a datagram, None if it is not a PING. 
+          A PING needs no command, PING alone is a probe too. """
+      start = time.time()
+      if ':' not in data: data += ':'
+      parts = parseMessage(data)
+      encoding = "repr"
+      if parts is not None: encoding = parts[1].get("encoding", encoding).lower()
+      if parts is None or parts[FIRST] != "PING" or encoding not in ENCODINGS:
+         self.ignored += 1
+         return None
+      stats.request(parts, time.time() - start)
+      self.answered += 1
+      response = build_PING_Response(parts[LAST])
+      if encoding == "repr": return str(response)
+      return encodeResponse(response, encoding)
+# === End of class HealthProbe =====	  
+
 # ==================================================================== Logger()
 class Logger:
    """ 
    Logger() --> Logger Object
+      Log entries are handed to a background thread through a queue, so 
+      logit() never waits on the disk. The thread keeps the log file open, 
+      writes the entries in batches, flushes at least every flushInterval 
+      seconds, rotates the log file once it is larger than maxBytes and 
+      writes out what is left when the Agent exits (see close()).
       Members:
          See __init__() function 
       Methods:
@@ -294,16 +1661,27 @@ class Logger:
          _createLogFile()
          _now()
          _showError()
+         _start()
+         _writer()
+         _write()
+         _rotate()
          logit()
+         logEntries()
+         forkChild()
          reset()
+         close()
    """
    	
    #--------------------------------------------------------- Logger.__init__()
-   def __init__(self, logFile):
+   def __init__(self, logFile, maxBytes = LOG_MAX_BYTES, backups = LOG_BACKUPS, 
+                flushInterval = LOG_FLUSH_INTERVAL):
       """ Creates an instance of an object of type Logger. """
       self.logPathFile      = str(logFile).strip()                   # Log path and file name 
       self.logFile          = os.path.split(self.logPathFile)[LAST]  # Log file name only 
       self.logPath          = os.path.split(self.logPathFile)[FIRST] # Log path only
+      self.maxBytes         = maxBytes                               # Rotate the log past this size, 0 never 
+      self.backups          = backups                                # Rotated log files kept 
+      self.flushInterval    = flushInterval                          # Most seconds between flushes
       self._infoLevel       = 1                                      # Info level entry
       self._warnLevel       = 2                                      # warning level entry
       self._errorLevel      = 3                                      # error level entry
@@ -314,6 +1692,12 @@ class Logger:
       dateString = "%Y-%b-%d" 
       timeString = "%H:%M:%S"
       self._timestampFormat = dateString + self._logEntrySep + timeString # log text timestamp format 
+      self._timestamp       = (None, "")                             # (second, text) of the last time stamp
+      self._queue           = Queue.Queue(LOG_QUEUE_SIZE)            # Entries waiting for the writer
+      self._thread          = None                                   # The writer thread, once started 
+      self._lock            = threading.Lock()                       # Guards starting the writer
+      self.dropped          = 0                                      # Entries lost to a full queue
+      self._pipe            = None                                   # Entries go to the supervisor (see forkChild())
       self.valid            = False 	                              # is the log file valid
       # - - - - - - - - - - - - - - - - - - - - - - - -
       self._createLogFolder()
@@ -360,95 +1744,1715 @@ class Logger:
 
    # ------------------------------------------------------------- Logger._now()   
    def _now(self):
-      """ returns a consistent time stamp """ 
-      if DEBUG: print self._timestampFormat
-      return time.strftime(self._timestampFormat, time.localtime())		
+      """ returns a consistent time stamp, worked out once a second """ 
+      second = int(time.time())
+      if second != self._timestamp[FIRST]:
+         if DEBUG: print self._timestampFormat
+         self._timestamp = (second, time.strftime(self._timestampFormat, time.localtime(second)))
+      return self._timestamp[LAST]
+
+   # ----------------------------------------------------------- Logger._start()
+   def _start(self):
+      """ Starts the writer thread if it is not running in this process. """
+      with self._lock:
+         if self._thread is not None and self._thread.is_alive(): return
+         self._thread = threading.Thread(target = self._writer)
+         self._thread.daemon = True
+         self._thread.start()
+         atexit.register(self.close)
+
+   # ---------------------------------------------------------- Logger._writer()
+   def _writer(self):
+      """ Writer thread body, writes queued entries until given None. """
+      try:
+         if self._pipe is not None: log = os.fdopen(self._pipe, "w")
+         else:                      log = open(self.logPathFile, FOR_APPENDING)
+      except Exception as e:
+         self._showError("Unable to write to log file \"%s\"\n%s" %(self.logPathFile, str(e)))
+         self.valid = False
+         return
+      lastFlush = time.time()
+      running   = True
+      while running:
+         try:
+            entries = [self._queue.get(timeout = self.flushInterval)]
+         except Queue.Empty:
+            entries = []
+         while True: # Take everything that is waiting in one go
+            try:
+               entries.append(self._queue.get_nowait())
+            except Queue.Empty:
+               break
+         if None in entries: 
+            entries = entries[:entries.index(None)]
+            running = False
+         try:
+            log = self._write(log, entries)
+            if not running or time.time() - lastFlush >= self.flushInterval:
+               log.flush()
+               lastFlush = time.time()
+         except Exception as e:
+            self._showError("Unable to write to log file \"%s\"\n%s" %(self.logPathFile, str(e)))
+      log.close()
+
+   # ----------------------------------------------------------- Logger._write()
+   def _write(self, log, entries):
+      """ Writes entries to the open log file, returns the log file to use 
+          from now on. """
+      for entry in entries:
+         if entry is RESET_LOG:
+            log.close()
+            try:
+               os.remove(self.logPathFile)
+            except Exception as e:
+               self._showError("Unable to reset the log file \"%s\"" %self.logPathFile)
+            log = open(self.logPathFile, FOR_APPENDING)
+            entry = self._now() + self._logEntrySep + self._infoString + \
+                    self._logEntrySep + "Log file reset" + os.linesep
+         log.write(entry)
+         if self.maxBytes > 0 and log.tell() >= self.maxBytes:
+            log = self._rotate(log)
+      return log
+
+   # ---------------------------------------------------------- Logger._rotate()
+   def _rotate(self, log):
+      """ Moves the full log file to .1 (.1 to .2 and so on, dropping the 
+          oldest) and returns a new, empty log file. """
+      log.close()
+      for number in range(self.backups - 1, 0, -1):
+         older = "%s.%d" %(self.logPathFile, number)
+         if os.path.exists(older): 
+            os.rename(older, "%s.%d" %(self.logPathFile, number + 1))
+      if self.backups > 0: os.rename(self.logPathFile, self.logPathFile + ".1")
+      else:                os.remove(self.logPathFile)
+      return open(self.logPathFile, FOR_APPENDING)
 
 	# ------------------------------------------------------------ Logger.logit()
    def logit(self, message, level = 1 ):
       """logIt(message, optional level) Writes an ertry to a log file.
          Log level vaules are: 1=INFO, 2=WARNING, 3=ERROR.
-         By default all log entries are INFO. """
+         By default all log entries are INFO. The entry is written by the 
+         writer thread, if the writer is too far behind the entry is dropped 
+         rather than hold up the Agent. """
       if self.valid:
          entry = self._now() + self._logEntrySep
          if level   == self._infoLevel:  entry = entry + self._infoString + self._logEntrySep 
          elif level == self._warnLevel:  entry = entry + self._warnString + self._logEntrySep 
          elif level == self._errorLevel: entry = entry + self._errorString + self._logEntrySep
          else: entry = entry + "GOK" + self._logEntrySep  # God only knows
-         entry = entry + str(message) + os.linesep
-         try:
-            log = open(self.logFile, FOR_APPENDING)
-            log.write(entry)
-            log.close()
-         except Exception as e:
-            self.showError("Unable to write to log file \"%s\"\n%s" %(self.logPathFile), str(e)) 			
+         message = str(message)
+         if len(message) > LOG_ENTRY_LIMIT:
+            message = message[:LOG_ENTRY_LIMIT] + " ... (%d more characters)" %(len(message) - LOG_ENTRY_LIMIT)
+         self.logEntries(entry + message + os.linesep)
       else:
          self._showError("Log file \"%s\" is not valid" %self.logPathFile)		
    
-	# ------------------------------------------------------------ Logger.reset()  
-   def reset(self):
+	# ------------------------------------------------------- Logger.logEntries()
+   def logEntries(self, entries):
+      """logEntries(str entries) Queues entries that are already formatted, 
+         one or more whole lines, for the writer. Used by the supervisor for 
+         the entries sent by the worker processes. """
       if self.valid:
+         if self._thread is None: self._start()
          try:
-            os.remove(self.logPathFile)
-            self.valid = False
-         except Exceptions as e:
-            self._showError("Unable to reset the log file \"%s\"" %self.logPathFile)  
-         if self.valid: self.logit("Log file reset") 			
+            self._queue.put_nowait(entries)
+         except Queue.Full:
+            self.dropped += 1
+
+	# -------------------------------------------------------- Logger.forkChild()
+   def forkChild(self, pipe):
+      """forkChild(int pipe) Called in a worker process right after the fork. 
+         The writer thread of the supervisor does not run in the worker, so 
+         the worker starts with a queue and writer of its own which write to 
+         pipe. The supervisor reads the pipe and puts the entries in the log 
+         file, it alone rotates the log. """
+      self._queue    = Queue.Queue(LOG_QUEUE_SIZE)
+      self._thread   = None
+      self._lock     = threading.Lock()
+      self._pipe     = pipe
+      self.maxBytes  = 0
+      self.dropped   = 0
+      if pipe is None: self.valid = False
+   
+	# ------------------------------------------------------------ Logger.reset()  
+   def reset(self):
+      """ Empties the log file once the entries before this are written. """
+      if self.valid and self._pipe is None:
+         if self._thread is None: self._start()
+         self._queue.put(RESET_LOG)
+
+	# ------------------------------------------------------------ Logger.close()  
+   def close(self):
+      """ Writes out the queued entries and stops the writer thread. Called 
+          when the Agent exits. """
+      with self._lock:
+         thread = self._thread
+         if thread is None or not thread.is_alive(): return
+         self._queue.put(None)
+      thread.join(LOG_CLOSE_TIMEOUT)
+      if self.dropped:
+         self._showError("%d log entries were dropped, the log could not keep up" %self.dropped)
 # === End of class Logger =====	  
 	  
 	  
-# ==============================================================================
-# FUNCTIONS
-#    This section holds all of the functions used by the script. The first line 
-#    of the function is a comment that describes the fuunction. This comment 
-#    is read and usd by many IDEs for development hints.
+# ===================================================================== Closer()
+class Closer:
+   """ 
+   Closer() --> Closer Object
+      Closes client connections gracefully (see closeConnection()), each 
+      from a thread of its own, and keeps count of the closes under way so 
+      the Agent can let them finish before it exits.
+      Members:
+         active
+         lock
+      Methods:
+         __init__()
+         close()
+         wait()
+         _close()
+   """
+   #---------------------------------------------------------- Closer.__init__()
+   def __init__(self):
+      """ Creates an instance of an object of type Closer. """
+      self.active = 0                      # Closes under way
+      self.lock   = threading.Condition()  # Guards and signals self.active
 
-# ---------------------------------------------------------------------- usage()
-def usage():
-   """usage() - Prints the usage message on stdout. """
-   print "\n\n%s, Version %s, This is a Remote Agent.              " %(ME,VERSION)
-   print "\nUSAGE: %s [OPTIONS]                                    " %ME
-   print "                                                         "
-   print "OPTIONS:                                                 "
-   print "   -h --help      Display this message.                  "
-   print "   -v --verbose   Runs the program in verbose mode, default: %s. " %VERBOSE
-   print "   -d --debug     Runs the program on debug mode (implies verbose). "
-   print "   -p --port=     The TCP port number for the listener, default: %s " %PORT
-   print "   -a --address=  The TCP address for the listener, default: %s " %HOST
-   print "   -l --logging   Enables logging, default=%s, logfile=%s  " %(LOGGING, LOG_FILE)
-   print "   -b --buffer=   The size of the TCP comm. buffer, default: %d " %BUF_SIZE
-   print "                                                         "
-   print "EXIT CODES:                                              "
-   print "    0 - Successful completion of the program.            "
-   print "    1 - Cannot import this script as a module.           "
-   print "    2 - Bad command line arguments.                      "
-   print "    3 - Bad port, must be a an integer                   "
-   print "    4 - Bad port, must be between 1025-65534 inclusive   "
-   print "    5 - Bad address, must be a string                    "
-   print "    6 - Bad buffer, must be etween 1025-65534 inclusive "
-   print "                                                         " 
-   print "EXAMPLES:                                                " 
-   print "    TODO - I'll make some examples up later.             "
-   print "                                                         "
+   # ------------------------------------------------------------- Closer.close()
+   def close(self, connection):
+      """ Starts the graceful close of a connection. """
+      with self.lock: self.active += 1
+      start_new_thread(self._close, (connection,))
 
-# ---------------------------------------------------------------------- pause()
-def pause():
-   """pause() Holds script execution until the user responds. """
-   raw_input(PAUSE_PROMPT)
-   return 
+   # ------------------------------------------------------------ Closer._close()
+   def _close(self, connection):
+      """ Thread body, closes the connection. """
+      try:
+         closeConnection(connection)
+      finally:
+         with self.lock:
+            self.active -= 1
+            self.lock.notifyAll()
 
-# ------------------------------------------------------------------------ now()
-def now():
-   """now() returns a timestamp string of the form "YYYY-MM-DD, HH:MM:SS"  """
-   return time.strftime("%Y-%b-%d, %H:%M:%S", time.localtime())
+   # -------------------------------------------------------------- Closer.wait()
+   def wait(self, timeout):
+      """ Waits up to timeout seconds for the closes under way to finish. """
+      deadline = time.time() + timeout
+      with self.lock:
+         while self.active > 0 and time.time() < deadline:
+            self.lock.wait(deadline - time.time())
+# === End of class Closer =====	  
 
-# ------------------------------------------------------------------ showError()
-def showError(message):
-   """showError(str message) write error message to stderr"""
-   message = str(message)
-   sys.stderr.write("\n\nERROR -- %s\n\n" %message)
-   sys.stderr.flush()
-   return 
+# ======================================================================== Job()
+class Job:
+   """ 
+   Job() --> Job Object
+      An OS command submitted with JOB:submit, run by the JobManager.
+      Members:
+         jobId
+         priority
+         timeout
+         command
+         state
+         submitted
+         finished
+      Methods:
+         __init__()
+         describe()
+   """
+   #------------------------------------------------------------- Job.__init__()
+   def __init__(self, jobId, command, priority, timeout = None):
+      """ Creates an instance of an object of type Job. """
+      self.jobId     = jobId             # Number the client asks for the job by
+      self.priority  = priority          # Higher runs first with a priority queue 
+      self.timeout   = timeout           # Seconds the job may run, None no limit
+      self.command   = Command(command)  # The OS command, with its results
+      self.state     = JOB_QUEUED        # JOB_QUEUED, RUNNING, DONE or CANCELLED
+      self.submitted = time.time()       # When the job was submitted 
+      self.finished  = None              # When the job was done or cancelled 
+
+   # ------------------------------------------------------------- Job.describe()
+   def describe(self):
+      """ Returns the dictionary used for the job in a JOB:list reply. """
+      return {JOB_ID     : self.jobId           ,
+              JOB_STATE  : self.state           ,
+              OS_COMMAND : self.command.command }
+# === End of class Job =====	  
+
+# ================================================================= JobManager()
+class JobManager:
+   """ 
+   JobManager() --> JobManager Object
+      Runs the jobs submitted with JOB:submit on a pool of worker threads, 
+      at most JOB_WORKERS at once, in the order they were submitted or, with 
+      a "priority" queue, highest priority first. A job is kept until its 
+      result is collected. At most MAX_JOBS are kept, when full the oldest 
+      finished job that has not been collected is thrown away to make room.
+      Members:
+         jobs
+         queue
+         lock
+         lastId
+         workers
+      Methods:
+         __init__()
+         submit()
+         get()
+         collect()
+         cancel()
+         list()
+         stop()
+         _start()
+         _makeRoom()
+         _worker()
+   """
+   #------------------------------------------------------ JobManager.__init__()
+   def __init__(self):
+      """ Creates an instance of an object of type JobManager. """
+      self.jobs    = {}                      # Job ID --> Job, until collected
+      self.queue   = Queue.PriorityQueue()   # (order, Job) waiting for a worker
+      self.lock    = threading.Lock()        # Guards the jobs and their states
+      self.lastId  = 0                       # ID of the last job submitted 
+      self.workers = 0                       # Worker threads started 
+
+   # -------------------------------------------------------- JobManager.submit()
+   def submit(self, command, priority = 0, timeout = None):
+      """ Queues an OS command and returns its Job, or None if the Agent 
+          already holds MAX_JOBS jobs that are not finished. """
+      with self.lock:
+         if len(self.jobs) >= MAX_JOBS and not self._makeRoom(): return None
+         self.lastId += 1
+         job = Job(self.lastId, command, priority, timeout)
+         self.jobs[job.jobId] = job
+      if JOB_QUEUE == "priority": order = (-priority, job.jobId)
+      else:                       order = (0, job.jobId)
+      self.queue.put((order, job))
+      self._start()
+      return job
+
+   # ----------------------------------------------------------- JobManager.get()
+   def get(self, jobId):
+      """ Returns the Job with the ID, None if there is no such job. """
+      with self.lock:
+         return self.jobs.get(jobId)
+
+   # ------------------------------------------------------- JobManager.collect()
+   def collect(self, jobId):
+      """ Returns the Job with the ID and forgets it if it is finished. """
+      with self.lock:
+         job = self.jobs.get(jobId)
+         if job is not None and job.finished is not None: del self.jobs[jobId]
+         return job
+
+   # -------------------------------------------------------- JobManager.cancel()
+   def cancel(self, jobId):
+      """ Cancels a queued job or kills a running one. Returns the Job, None 
+          if there is no such job. """
+      with self.lock:
+         job = self.jobs.get(jobId)
+         if job is None or job.finished is not None: return job
+         if job.state == JOB_QUEUED: job.finished = time.time()
+         job.state = JOB_CANCELLED
+      job.command.kill() # The worker finishes a running job off 
+      return job
+
+   # ---------------------------------------------------------- JobManager.list()
+   def list(self):
+      """ Returns the jobs held, in the order they were submitted. """
+      with self.lock:
+         return [self.jobs[jobId] for jobId in sorted(self.jobs)]
+
+   # ---------------------------------------------------------- JobManager.stop()
+   def stop(self):
+      """ Cancels every job that is not finished, for an Agent shutdown. """
+      for job in self.list(): self.cancel(job.jobId)
+
+   # -------------------------------------------------------- JobManager._start()
+   def _start(self):
+      """ Starts another worker thread, up to JOB_WORKERS of them. """
+      with self.lock:
+         if self.workers >= JOB_WORKERS or self.queue.qsize() <= 0: return
+         self.workers += 1
+      thread = threading.Thread(target = self._worker)
+      thread.daemon = True
+      thread.start()
+
+   # ----------------------------------------------------- JobManager._makeRoom()
+   def _makeRoom(self):
+      """ Throws away the oldest finished job, returns False if no job is 
+          finished. Called with the lock held. """
+      finished = [(job.finished, job.jobId) for job in self.jobs.values() 
+                  if job.finished is not None]
+      if not finished: return False
+      del self.jobs[min(finished)[LAST]]
+      return True
+
+   # ------------------------------------------------------- JobManager._worker()
+   def _worker(self):
+      """ Worker thread body, runs queued jobs for as long as the Agent runs. """
+      while True:
+         order, job = self.queue.get()
+         with self.lock:
+            if job.state != JOB_QUEUED: continue # Cancelled while queued 
+            job.state = JOB_RUNNING
+         job.command.run(job.timeout)
+         with self.lock:
+            if job.state == JOB_RUNNING: job.state = JOB_DONE
+            job.finished = time.time()
+# === End of class JobManager =====	  
+
+# =============================================================== Subscription()
+class Subscription:
+   """ 
+   Subscription() --> Subscription Object
+      A directive sampled at a fixed interval for a session (SUB:start), 
+      run by the Scheduler.
+      Members:
+         subId
+         session
+         directive
+         command
+         interval
+         count
+         timeout
+         started
+         due
+         seq
+         samples
+         missed
+         running
+         cancelled
+      Methods:
+         __init__()
+         describe()
+         sample()
+   """
+   #---------------------------------------------------- Subscription.__init__()
+   def __init__(self, subId, session, directive, command, interval, count = 0, 
+                timeout = None):
+      """ Creates an instance of an object of type Subscription. """
+      self.subId     = subId             # Number the client stops it by 
+      self.session   = session           # Session the samples are sent on 
+      self.directive = directive         # SYS or OS 
+      self.command   = command           # Command of the directive 
+      self.interval  = interval          # Seconds between samples 
+      self.count     = count             # Intervals before it ends, 0 never
+      self.timeout   = timeout           # Seconds an OS sample may run 
+      self.started   = monotonic()       # Monotonic time of the first sample
+      self.due       = self.started      # Monotonic time of the next sample 
+      self.seq       = 0                 # SUB_SEQ of the next sample 
+      self.samples   = 0                 # Samples taken 
+      self.missed    = 0                 # Samples missed 
+      self.running   = False             # A sample is being taken 
+      self.cancelled = False             # Stopped, send nothing more 
+
+   # ---------------------------------------------------- Subscription.describe()
+   def describe(self):
+      """ Returns the dictionary used for the subscription in a SUB:list 
+          reply. """
+      return {SUB_ID     : self.subId                                  ,
+              "REQUEST"  : "%s:%s" %(self.directive, self.command)     ,
+              "INTERVAL" : self.interval                               ,
+              "SAMPLES"  : self.samples                                ,
+              "MISSED"   : self.missed                                 }
+
+   # ------------------------------------------------------ Subscription.sample()
+   def sample(self):
+      """ Takes a sample, returns the reply of the directive. """
+      if self.directive == "OS":
+         c = Command(self.command)
+         c.run(self.timeout)
+         return build_RESULTS_Response(c.returnResults(), "SUB SAMPLE")
+      try:
+         data = readSys(self.command)
+      except SYS_ERRORS as e:
+         message = "Unable to read the system counters for SYS:%s - %s" %(self.command, str(e))
+         return build_TA_Response(261, message)
+      response = build_TA_Response(0, "SUB SAMPLE")
+      response[SYS_DATA] = data
+      return response
+# === End of class Subscription =====	  
+
+# ================================================================== Scheduler()
+class Scheduler:
+   """ 
+   Scheduler() --> Scheduler Object
+      Takes the samples of every subscription (SUB directive) from one 
+      thread. Subscriptions wait in a heap by the monotonic time of their 
+      next sample, which is always a whole number of intervals after the 
+      first, so samples stay evenly spaced however long each one takes. 
+      Each sample is taken by a thread of its own and handed to the 
+      session with Session.push(). A sample that falls due while the one 
+      before is still being taken is missed.
+      Members:
+         heap
+         lock
+         lastId
+         thread
+         wakeRead
+         wakeWrite
+      Methods:
+         __init__()
+         add()
+         cancel()
+         cancelSession()
+         list()
+         _start()
+         _run()
+         _due()
+         _take()
+   """
+   #------------------------------------------------------- Scheduler.__init__()
+   def __init__(self):
+      """ Creates an instance of an object of type Scheduler. """
+      self.heap      = []                # (due, subscription ID, Subscription)
+      self.lock      = threading.Lock()  # Guards the heap and the subscriptions
+      self.lastId    = 0                 # ID of the last subscription 
+      self.thread    = False             # The scheduler thread has started 
+      self.wakeRead  = None              # \_ Wakes up the scheduler thread for 
+      self.wakeWrite = None              # /  a new subscription
+
+   # ------------------------------------------------------------ Scheduler.add()
+   def add(self, session, directive, command, interval, count = 0, timeout = None):
+      """ Starts a subscription for a session, its first sample is due now. 
+          Returns the Subscription, None if the session already holds 
+          MAX_SUBSCRIPTIONS. """
+      with self.lock:
+         if len(session.subscriptions) >= MAX_SUBSCRIPTIONS: return None
+         if not self.thread: self._start()
+         self.lastId += 1
+         subscription = Subscription(self.lastId, session, directive, command, 
+                                     interval, count, timeout)
+         session.subscriptions[subscription.subId] = subscription
+         heapq.heappush(self.heap, (subscription.due, subscription.subId, subscription))
+      os.write(self.wakeWrite, "x")
+      return subscription
+
+   # --------------------------------------------------------- Scheduler.cancel()
+   def cancel(self, session, subId = None):
+      """ Stops a subscription of a session, or all of them when subId is 
+          None. Returns the number stopped. """
+      with self.lock:
+         if subId is None: subIds = session.subscriptions.keys()
+         elif subId in session.subscriptions: subIds = [subId]
+         else: subIds = []
+         for subId in subIds:
+            session.subscriptions.pop(subId).cancelled = True
+      return len(subIds)
+
+   # -------------------------------------------------- Scheduler.cancelSession()
+   def cancelSession(self, session):
+      """ Stops every subscription of a session that has ended. """
+      if session.subscriptions: self.cancel(session)
+
+   # ----------------------------------------------------------- Scheduler.list()
+   def list(self, session):
+      """ Returns the subscriptions of a session in the order they started. """
+      with self.lock:
+         return [session.subscriptions[subId] for subId in sorted(session.subscriptions)]
+
+   # --------------------------------------------------------- Scheduler._start()
+   def _start(self):
+      """ Starts the scheduler thread, with the lock held. The wake up pipe 
+          is made here rather than in __init__(), in a worker process (see 
+          --processes) it must not be shared with the other workers. """
+      self.wakeRead, self.wakeWrite = os.pipe()
+      closeOnExec(self.wakeRead)
+      closeOnExec(self.wakeWrite)
+      thread = threading.Thread(target = self._run)
+      thread.daemon = True
+      thread.start()
+      self.thread = True
+
+   # ----------------------------------------------------------- Scheduler._run()
+   def _run(self):
+      """ Scheduler thread body, takes the samples that are due and sleeps 
+          until the next one is, or until woken up by add(). """
+      while True:
+         with self.lock:
+            rightNow = monotonic()
+            while self.heap and self.heap[FIRST][FIRST] <= rightNow:
+               due, subId, subscription = heapq.heappop(self.heap)
+               if subscription.cancelled: continue
+               if self._due(subscription, rightNow):
+                  heapq.heappush(self.heap, (subscription.due, subId, subscription))
+            wait = None
+            if self.heap: wait = max(0, self.heap[FIRST][FIRST] - rightNow)
+         try:
+            ready = select.select([self.wakeRead], [], [], wait)[FIRST]
+         except select.error as e:
+            if e[FIRST] == errno.EINTR: continue
+            raise
+         if ready: os.read(self.wakeRead, PIPE_CHUNK)
+
+   # ----------------------------------------------------------- Scheduler._due()
+   def _due(self, subscription, rightNow):
+      """ Takes the sample of a subscription that is due, with the lock 
+          held, and works out when the next one is. Returns False once the 
+          subscription has ended. """
+      seq = subscription.seq
+      if subscription.running: 
+         subscription.missed += 1
+      else:
+         subscription.running = True
+         start_new_thread(self._take, (subscription, seq, time.time()))
+      seq += 1
+      # A scheduler that fell more than an interval behind, on a system that 
+      # stalled, skips the samples it has missed rather than catch up 
+      late = int((rightNow - subscription.started) / subscription.interval) + 1 - seq
+      if late > 0:
+         subscription.missed += late
+         seq += late
+      subscription.seq = seq
+      subscription.due = subscription.started + seq * subscription.interval
+      if subscription.count and seq >= subscription.count:
+         subscription.session.subscriptions.pop(subscription.subId, None)
+         return False
+      return True
+
+   # ---------------------------------------------------------- Scheduler._take()
+   def _take(self, subscription, seq, sampled):
+      """ Body of a sample thread, takes sample seq of a subscription and 
+          hands it to the session. The next sample of the subscription is 
+          not taken until this one has been handed over. """
+      try:
+         response = subscription.sample()
+         response[SUB_ID]   = subscription.subId
+         response[SUB_SEQ]  = seq
+         response[SUB_TIME] = round(sampled, 6)
+         subscription.samples += 1
+         subscription.session.push(response, subscription)
+      except Exception as e:
+         message = "Subscription %d failed - %s" %(subscription.subId, str(e))
+         showWarning(message)
+         if LOGGING: log.logit(message, WARN)
+      finally:
+         subscription.running = False
+# === End of class Scheduler =====	  
+
+# ================================================================ Histogram()
+class Histogram:
+   """ 
+   Histogram() --> Histogram Object
+      Counts latencies into the buckets of LATENCY_BUCKETS. Not thread safe, 
+      see Stats. 
+      Members:
+         counts
+         count
+         total
+         longest
+      Methods:
+         __init__()
+         observe()
+         report()
+   """
+   #------------------------------------------------------- Histogram.__init__()
+   def __init__(self):
+      """ Creates an instance of an object of type Histogram. """
+      self.counts  = [0] * (len(LATENCY_BUCKETS) + 1)  # Last one is past the last bound
+      self.count   = 0           # Latencies observed 
+      self.total   = 0.0         # Seconds observed 
+      self.longest = 0.0         # Longest latency observed 
+
+   # -------------------------------------------------------- Histogram.observe()
+   def observe(self, seconds):
+      """ Counts one latency of so many seconds. """
+      self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+      self.count   += 1
+      self.total   += seconds
+      if seconds > self.longest: self.longest = seconds
+
+   # --------------------------------------------------------- Histogram.report()
+   def report(self):
+      """ Returns the histogram as a dictionary, times in milliseconds. """
+      bounds  = [round(bound * 1000, 1) for bound in LATENCY_BUCKETS] + ["inf"]
+      return {"COUNT"    : self.count                    ,
+              "TOTAL_MS" : round(self.total * 1000, 3)   ,
+              "MAX_MS"   : round(self.longest * 1000, 3) ,
+              "BUCKETS"  : [[bound, count] for bound, count in zip(bounds, self.counts)]}
+# === End of class Histogram =====	  
+
+# ==================================================================== Stats()
+class Stats:
+   """ 
+   Stats() --> Stats Object
+      The counters reported by TA:stats, updated from every thread. 
+      Members:
+         lock
+         started
+         requests
+         errors
+         bytesIn
+         bytesOut
+         bytesBefore
+         bytesAfter
+         sessionsActive
+         sessionsTotal
+         sessionsReaped
+         latency
+      Methods:
+         __init__()
+         request()
+         executed()
+         received()
+         sent()
+         sentData()
+         compressed()
+         sessionStarted()
+         sessionEnded()
+         sessionReaped()
+         report()
+   """
+   #----------------------------------------------------------- Stats.__init__()
+   def __init__(self):
+      """ Creates an instance of an object of type Stats. """
+      self.lock           = threading.Lock()
+      self.started        = time.time()  # Time the Agent started 
+      self.requests       = {}           # Directive --> messages received 
+      self.errors         = {}           # AGENT_RETURN_CODE --> replies sent 
+      self.bytesIn        = 0            # Bytes received from clients 
+      self.bytesOut       = 0            # Bytes sent to clients 
+      self.bytesBefore    = 0            # Bytes compressed 
+      self.bytesAfter     = 0            # Bytes they were compressed to 
+      self.sessionsActive = 0            # Sessions open now 
+      self.sessionsTotal  = 0            # Sessions since the Agent started 
+      self.sessionsReaped = 0            # Sessions closed by a session limit 
+      self.latency        = {"PARSE" : Histogram(),
+                             "EXEC"  : Histogram(),
+                             "SEND"  : Histogram(),
+                             "COMPRESS" : Histogram()}
+
+   # ------------------------------------------------------------ Stats.request()
+   def request(self, parts, seconds):
+      """ Counts a message, parts as returned by parseMessage(), that took 
+          so many seconds to parse. """
+      if parts is None:                     directive = "INVALID"
+      elif parts[FIRST] in DIRECTIVES:      directive = parts[FIRST]
+      else:                                 directive = "UNKNOWN"
+      with self.lock:
+         self.requests[directive] = self.requests.get(directive, 0) + 1
+         self.latency["PARSE"].observe(seconds)
+
+   # ----------------------------------------------------------- Stats.executed()
+   def executed(self, seconds):
+      """ Counts an OS command that ran for so many seconds. """
+      with self.lock:
+         self.latency["EXEC"].observe(seconds)
+
+   # ----------------------------------------------------------- Stats.received()
+   def received(self, count):
+      """ Counts bytes received from a client. """
+      with self.lock:
+         self.bytesIn += count
+
+   # --------------------------------------------------------------- Stats.sent()
+   def sent(self, returnCode, count, seconds):
+      """ Counts a reply of count bytes that took so many seconds to send. """
+      with self.lock:
+         if returnCode: 
+            self.errors[returnCode] = self.errors.get(returnCode, 0) + 1
+         self.bytesOut += count
+         self.latency["SEND"].observe(seconds)
+
+   # ----------------------------------------------------------- Stats.sentData()
+   def sentData(self, count):
+      """ Counts bytes sent to a client that were not a reply (FILE:get). """
+      with self.lock:
+         self.bytesOut += count
+
+   # --------------------------------------------------------- Stats.compressed()
+   def compressed(self, before, after, seconds):
+      """ Counts before bytes compressed to after bytes in so many seconds. """
+      with self.lock:
+         self.bytesBefore += before
+         self.bytesAfter  += after
+         self.latency["COMPRESS"].observe(seconds)
+
+   # ----------------------------------------------------- Stats.sessionStarted()
+   def sessionStarted(self):
+      """ Counts a new session. """
+      with self.lock:
+         self.sessionsActive += 1
+         self.sessionsTotal  += 1
+
+   # ------------------------------------------------------- Stats.sessionEnded()
+   def sessionEnded(self):
+      """ Counts a session that has ended. """
+      with self.lock:
+         self.sessionsActive -= 1
+
+   # ------------------------------------------------------ Stats.sessionReaped()
+   def sessionReaped(self):
+      """ Counts a session closed for being idle or open too long. """
+      with self.lock:
+         self.sessionsReaped += 1
+
+   # ------------------------------------------------------------- Stats.report()
+   def report(self):
+      """ Returns the counters as a dictionary (see STATISTICS). Return codes 
+          are given as strings, JSON has no other kind of key. """
+      with self.lock:
+         return {"UPTIME"          : round(time.time() - self.started, 3) ,
+                 "SESSIONS_ACTIVE" : self.sessionsActive                  ,
+                 "SESSIONS_TOTAL"  : self.sessionsTotal                   ,
+                 "SESSIONS_REAPED" : self.sessionsReaped                  ,
+                 "REQUESTS"        : dict(self.requests)                  ,
+                 "ERRORS"          : dict([(str(code), count) for code, count in self.errors.items()]),
+                 "BYTES_IN"        : self.bytesIn                         ,
+                 "BYTES_OUT"       : self.bytesOut                        ,
+                 "COMPRESSION"     : {"BYTES_BEFORE" : self.bytesBefore,
+                                      "BYTES_AFTER"  : self.bytesAfter ,
+                                      "RATIO"        : round(float(self.bytesBefore) / 
+                                                             max(self.bytesAfter, 1), 2)},
+                 "LATENCY"         : dict([(name, histogram.report()) 
+                                           for name, histogram in self.latency.items()])}
+# === End of class Stats =====	  
+
+# =============================================================== FramingError()
+class FramingError(Exception):
+   """ Raised when a framed message from a client cannot be accepted. """
+   pass
+
+class SessionExpired(Exception):
+   """ Raised when a session has been idle or open for too long, see 
+       SESSION LIMITS. """
+   pass
+
+# ==================================================================== Session()
+class Session:
+   """ 
+   Session() --> Session Object
+      Members:
+         connection
+         remoteAddr
+         framed
+         encoding
+         inbuf
+         pending
+         outbuf
+         useShell
+         shell
+         ended
+         compress
+         bytesBefore
+         bytesAfter
+         compressTime
+         started
+         lastActive
+         sendLock
+         subscriptions
+      Methods:
+         __init__()
+         expires()
+         expiredReason()
+         feed()
+         recvMessage()
+         send()
+         push()
+         sendData()
+         frame()
+         runCommand()
+         stopShell()
+         end()
+         close()
+   """
+   #--------------------------------------------------------- Session.__init__()
+   def __init__(self, connection, remoteAddr):
+      """ Creates an instance of an object of type Session. """
+      self.connection = connection   # Socket connected to the client 
+      self.remoteAddr = remoteAddr   # Address and port of the client 
+      self.framed     = False        # Are messages length prefixed (TA:framing)
+      self.encoding   = "repr"       # Encoding of the replies (TA:encoding) 
+      self.inbuf      = ""           # Received bytes not yet a whole message
+      self.pending    = []           # Received messages not yet processed
+      self.outbuf     = None         # Replies queued by the EventLoop, if any
+      closeOnExec(connection.fileno())
+      self.useShell   = PERSISTENT_SHELL  # Run OS directives in self.shell (TA:shell)
+      self.shell      = None         # Shell of the session, started when needed
+      self.ended      = False        # Set by end() 
+      self.compress   = 0            # zlib level of the replies, 0 off (TA:compress)
+      self.bytesBefore  = 0          # \
+      self.bytesAfter   = 0          #  > -- Compression by this session, for the log 
+      self.compressTime = 0.0        # /
+      self.started    = time.time()  # Time the session started 
+      self.lastActive = self.started # Time of the last message or reply 
+      self.sendLock   = threading.RLock()  # Held while sending, see push()
+      self.subscriptions = {}        # Subscription ID --> Subscription (SUB)
+      keepAlive(connection)
+      stats.sessionStarted()
+
+   # --------------------------------------------------------- Session.expires()
+   def expires(self):
+      """ Returns the time the session is reaped at if nothing arrives from 
+          the client before then, None if it never is. """
+      times = []
+      if IDLE_TIMEOUT:     times.append(self.lastActive + IDLE_TIMEOUT)
+      if SESSION_LIFETIME: times.append(self.started + SESSION_LIFETIME)
+      if times: return min(times)
+      return None
+
+   # --------------------------------------------------- Session.expiredReason()
+   def expiredReason(self):
+      """ Returns why a session that has expired is reaped. """
+      if SESSION_LIFETIME and time.time() >= self.started + SESSION_LIFETIME:
+         return "open for more than %s seconds" %SESSION_LIFETIME
+      return "idle for more than %s seconds" %IDLE_TIMEOUT
+
+   # ------------------------------------------------------------ Session.feed()
+   def feed(self, data):
+      """ Adds bytes received from the client to the session and returns the 
+          number of messages now waiting in self.pending. Without framing 
+          every receive is one message, with framing messages are cut out 
+          of the received bytes by their length headers and kept byte for 
+          byte, they may be the contents of a file (FILE:put). """
+      stats.received(len(data))
+      self.lastActive = time.time()
+      if not self.framed:
+         self.pending.append(data.strip())
+         return len(self.pending)
+      self.inbuf += data
+      while len(self.inbuf) >= FRAME_HEADER_SIZE:
+         length = struct.unpack(FRAME_HEADER, self.inbuf[:FRAME_HEADER_SIZE])[FIRST]
+         compressed = length & FRAME_COMPRESSED
+         length    &= ~FRAME_COMPRESSED
+         if length > MAX_FRAME:
+            raise FramingError("Message of %d bytes is larger than %d bytes" %(length, MAX_FRAME))
+         end = FRAME_HEADER_SIZE + length
+         if len(self.inbuf) < end: break
+         message    = self.inbuf[FRAME_HEADER_SIZE:end]
+         self.inbuf = self.inbuf[end:]
+         if compressed:
+            try:
+               decompressor = zlib.decompressobj()
+               message = decompressor.decompress(message, MAX_FRAME)
+            except zlib.error as e:
+               raise FramingError("Compressed message is not valid - %s" %str(e))
+            if decompressor.unconsumed_tail:
+               raise FramingError("Compressed message is larger than %d bytes" %MAX_FRAME)
+         self.pending.append(message)
+      return len(self.pending)
+
+   # ----------------------------------------------------- Session.recvMessage()
+   def recvMessage(self):
+      """ Returns the next message from the client or None if the client 
+          has closed the connection. Raises SessionExpired if the session 
+          reaches a session limit first. """
+      while not self.pending:
+         expires = self.expires()
+         if expires is not None:
+            wait = expires - time.time()
+            if wait <= 0: raise SessionExpired(self.expiredReason())
+            self.connection.settimeout(wait)
+         try:
+            data = self.connection.recv(max(BUF_SIZE, FRAME_RECV_SIZE) if self.framed else BUF_SIZE)
+         except socket.timeout:
+            raise SessionExpired(self.expiredReason())
+         finally:
+            if expires is not None: self.connection.settimeout(None)
+         if not data: return None
+         self.feed(data)
+      return self.pending.pop(FIRST)
+
+   # ------------------------------------------------------------ Session.send()
+   def send(self, response, legacy = None):
+      """ Sends a response dictionary to the client in the encoding of the 
+          session, with a length header if the session is framed. legacy is 
+          the text sent instead of the dictionary in the "repr" encoding 
+          for the replies that have always been sent as a list. """
+      started = time.time()
+      self.lastActive = started
+      if self.encoding == "repr" or VERBOSE or LOGGING:
+         if legacy is not None: text = legacy
+         else:                  text = str(response)
+         if VERBOSE: showMessage("Sending: %s" %text)
+         if LOGGING: log.logit("Sending: %s" %text)
+      if self.encoding == "repr": reply = text
+      else:                       reply = encodeResponse(response, self.encoding)
+      with self.sendLock:
+         if self.framed: reply = self.frame(reply)
+         if self.outbuf is not None: # The EventLoop writes it 
+            self.outbuf.append(reply) 
+         else:
+            self.connection.sendall(reply)
+      stats.sent(response.get(AGENT_RETURN_CODE), len(reply), time.time() - started)
+
+   # ------------------------------------------------------------ Session.push()
+   def push(self, response, subscription):
+      """ Sends a sample of a subscription, called from a thread of the 
+          Scheduler. Nothing is sent once the subscription has been stopped 
+          or the session has ended. The EventLoop has its own push() for 
+          the sessions it serves. """
+      with self.sendLock:
+         if subscription.cancelled or self.ended: return
+         try:
+            self.send(response)
+         except socket.error:
+            scheduler.cancelSession(self) # The client has gone, the session ends as usual
+
+   # -------------------------------------------------------- Session.sendData()
+   def sendData(self, data):
+      """ Sends data that is not a reply, such as part of a file, as a frame 
+          of its own on the socket. """
+      with self.sendLock:
+         frame = self.frame(data)
+         self.connection.sendall(frame)
+      stats.sentData(len(frame))
+
+   # ----------------------------------------------------------- Session.frame()
+   def frame(self, data):
+      """ Returns data with its length header, compressed first if the 
+          session has compression on, data is large enough and it gets 
+          smaller. The header goes in the same write as the data, written on 
+          its own the data would wait for the client to acknowledge the 
+          header. """
+      if self.compress and len(data) >= COMPRESS_THRESHOLD:
+         start      = time.time()
+         compressed = zlib.compress(data, self.compress)
+         seconds    = time.time() - start
+         stats.compressed(len(data), len(compressed), seconds)
+         self.bytesBefore  += len(data)
+         self.bytesAfter   += len(compressed)
+         self.compressTime += seconds
+         if len(compressed) < len(data):
+            return struct.pack(FRAME_HEADER, len(compressed) | FRAME_COMPRESSED) + compressed
+      return struct.pack(FRAME_HEADER, len(data)) + data
+
+   # ------------------------------------------------------ Session.runCommand()
+   def runCommand(self, command, timeout = None):
+      """ Executes an OS command, in the shell of the session if it has one, 
+          and returns a dictionary like Command.returnResults(). """
+      if self.useShell:
+         if self.shell is None: self.shell = Shell()
+         return self.shell.run(command, timeout)
+      c = Command(command)
+      c.run(timeout)
+      return c.returnResults()
+
+   # ------------------------------------------------------- Session.stopShell()
+   def stopShell(self):
+      """ Ends the shell of the session, if it has one. """
+      if self.shell is not None:
+         self.shell.close()
+         self.shell = None
+
+   # ------------------------------------------------------------- Session.end()
+   def end(self):
+      """ Ends the shell of the session and counts the session as ended, 
+          once however often it is called. Compression by the session, if 
+          any, is reported. """
+      self.stopShell()
+      scheduler.cancelSession(self)
+      if not self.ended:
+         self.ended = True
+         stats.sessionEnded()
+         if self.bytesBefore and (VERBOSE or LOGGING):
+            message = "Session with %s compressed %d bytes to %d (%.1f:1) in %.1f ms" \
+                      %(str(self.remoteAddr), self.bytesBefore, self.bytesAfter, 
+                        float(self.bytesBefore) / max(self.bytesAfter, 1), 
+                        self.compressTime * 1000)
+            if VERBOSE: showMessage(message)
+            if LOGGING: log.logit(message)
+
+   # ----------------------------------------------------------- Session.close()
+   def close(self, linger = True):
+      """ Closes the connection to the client. With linger the close is 
+          graceful (see closeConnection()) and done by a thread of its own, 
+          so the caller can get on with the next session straight away. """
+      self.end()
+      if linger: closer.close(self.connection)
+      else:      self.connection.close()
+# === End of class Session =====	  
+
+# ============================================================= AsyncCommand()
+class AsyncCommand:
+   """ 
+   AsyncCommand() --> AsyncCommand Object
+      An OS directive started by the EventLoop. The output of the command is 
+      collected from its pipes by the EventLoop as it becomes available.
+      Members:
+         session
+         stream
+         pipes
+         command
+         process
+         output
+         error
+         openPipes
+         deadline
+         timedOut
+         exitWait
+         exitCheck
+         started
+      Methods:
+         __init__()
+         start()
+         kill()
+         returnResults()
+   """
+   #---------------------------------------------------- AsyncCommand.__init__()
+   def __init__(self, session, command, stream = False, timeout = None):
+      """ Creates an instance of an object of type AsyncCommand. """
+      self.session    = session                # Session that sent the command
+      self.stream     = stream                 # Send output as it arrives (OS-STREAM)
+      self.pipes      = []                     # Pipes still being read 
+      self.command    = str(command).strip()   # The command to execute 
+      self.process    = None                   # Running process 
+      self.output     = Capture(self.command, OS_STDOUT)  # Standard output 
+      self.error      = Capture(self.command, OS_STDERR)  # Standard error 
+      self.openPipes  = 0                      # Pipes not yet at end of file 
+      self.returnCode = 127                    # Return code from command                
+      self.deadline   = None                   # Time it is killed, then KILL_GRACE later given up on
+      if timeout: self.deadline = time.time() + timeout
+      self.timedOut   = False                  # Killed for running too long 
+      self.exitWait   = EXIT_POLL_FIRST        # Seconds between checks once its pipes close
+      self.exitCheck  = None                   # Time of the next check once its pipes close
+      self.started    = None                   # Time the command was started 
+
+   # -------------------------------------------------------- AsyncCommand.start()
+   def start(self):
+      """ Starts the command, in a process group of its own, without waiting 
+          for it. Returns False if the command could not be started. """
+      try:
+         self.started = time.time()
+         self.process = subprocess.Popen(self.command, 
+                                         stdout     = subprocess.PIPE ,
+                                         shell      = True            , 
+                                         stderr     = subprocess.PIPE , 
+                                         preexec_fn = os.setsid       ) 
+         self.openPipes = 2
+         return True
+      except Exception as e:
+         self.output.add(str(e))
+         self.error.add("Unable to execute: \"%s\"" %self.command)
+         self.returnCode = 113
+         return False
+
+   # --------------------------------------------------------- AsyncCommand.kill()
+   def kill(self):
+      """ Kills the process group of the command if it is running. """
+      if self.process is not None and self.process.returncode is None:
+         try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+         except OSError:
+            pass # Already gone 
+
+   # ------------------------------------------------ AsyncCommand.returnResults()   
+   def returnResults(self):
+      """ Returns a dictionary containing the original command and results. """
+      results = {"command"    : self.command                 ,
+                 "output"     : self.output.text().strip()   ,
+                 "error"      : self.error.text().strip()    ,
+                 "returnCode" : self.returnCode              ,
+                 "timedOut"   : self.timedOut                ,
+                 "spills"     : spillsOf({OS_STDOUT : self.output, 
+                                          OS_STDERR : self.error })}
+      return results    
+# === End of class AsyncCommand =====	  
+
+# ================================================================ EventLoop()
+class EventLoop:
+   """ 
+   EventLoop() --> EventLoop Object
+      Serves every client session and runs every OS directive from a single 
+      thread. Sockets and command pipes are watched with poll() so that idle 
+      sessions and running commands cost a file descriptor, not a thread. 
+      Members:
+         listener
+         poller
+         handlers
+         closing
+         exiting
+         timed
+         posted
+         sessions
+         nextReap
+      Methods:
+         __init__()
+         run()
+         post()
+         _register()
+         _unregister()
+         _timeout()
+         _accept()
+         _sessionEvent()
+         _read()
+         _handle()
+         _update()
+         _flush()
+         _throttle()
+         _finishSession()
+         _drain()
+         _close()
+         _drop()
+         _reap()
+         _startCommand()
+         _pipeEvent()
+         _finishCommand()
+         _offload()
+         _resume()
+         _push()
+         _wakeup()
+         _runTimers()
+   """
+   #------------------------------------------------------- EventLoop.__init__()
+   def __init__(self, tcpSocket):
+      """ Creates an instance of an object of type EventLoop. """
+      self.listener = tcpSocket      # Listener socket 
+      self.poller   = select.poll()  # Watches every socket and pipe 
+      self.handlers = {}             # File descriptor --> event handler 
+      self.closing  = []             # (close time, session) of ending sessions
+      self.exiting  = []             # Commands with closed pipes still running
+      self.timed    = []             # Running commands with a timeout 
+      self.posted   = Queue.Queue()  # Functions posted by other threads 
+      self.sessions = set()          # Open sessions, checked for reaping 
+      self.nextReap = None           # Time of the next check for sessions to reap
+      if IDLE_TIMEOUT or SESSION_LIFETIME: self.nextReap = time.time() + REAP_INTERVAL
+      self.wakeRead, self.wakeWrite = os.pipe()  # Wakes up poll() for a post
+      closeOnExec(self.wakeRead)
+      closeOnExec(self.wakeWrite)
+      self.listener.setblocking(0)
+      self._register(self.listener.fileno(), select.POLLIN, self._accept)
+      self._register(self.wakeRead, select.POLLIN, self._wakeup)
+
+   # ------------------------------------------------------------ EventLoop.run()
+   def run(self):
+      """ Serves sessions until an agent shutdown is requested. """
+      while RUNNING:
+         try:
+            events = self.poller.poll(self._timeout())
+         except select.error as e:
+            if e[FIRST] == errno.EINTR: continue
+            raise
+         for fd, mask in events:
+            handler = self.handlers.get(fd)
+            if handler is not None: handler(mask)
+         self._runTimers()
+
+   # ------------------------------------------------------ EventLoop._register()
+   def _register(self, fd, mask, handler):
+      """ Starts watching a file descriptor. """
+      self.poller.register(fd, mask)
+      self.handlers[fd] = handler
+
+   # ---------------------------------------------------- EventLoop._unregister()
+   def _unregister(self, fd):
+      """ Stops watching a file descriptor. """
+      if fd in self.handlers:
+         self.poller.unregister(fd)
+         del self.handlers[fd]
+
+   # ------------------------------------------------------- EventLoop._timeout()
+   def _timeout(self):
+      """ Returns the poll() timeout in milliseconds, None to wait forever. """
+      times = [closeTime for closeTime, session in self.closing] + \
+              [c.deadline for c in self.timed] + \
+              [c.exitCheck for c in self.exiting]
+      if self.nextReap is not None: times.append(self.nextReap)
+      # Rounded up, a wait rounded down to 0 would spin until the time comes
+      if times: return max(0, int(math.ceil((min(times) - time.time()) * 1000)))
+      return None
+
+   # -------------------------------------------------------- EventLoop._accept()
+   def _accept(self, mask):
+      """ Accepts every pending connection on the listener. """
+      while True:
+         try:
+            connection, remoteAddr = self.listener.accept()
+         except socket.error as e:
+            if e[FIRST] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+            showWarning("Unable to accept a connection - %s" %str(e))
+            return
+         message = "Connection from: %s" %str(remoteAddr)
+         if VERBOSE: showMessage(message)
+         if LOGGING: log.logit(message)                        
+         connection.setblocking(0)
+         session         = Session(connection, remoteAddr)
+         session.outbuf  = []     # Replies are queued and written by the loop 
+         session.outpos  = 0      # Bytes of the first queued reply already sent
+         session.busy    = False  # Waiting for an OS directive to finish 
+         session.command = None   # The running AsyncCommand, if any 
+         session.action  = SESSION_CONTINUE
+         session.fd      = connection.fileno()
+         session.held    = []     # Samples waiting for an offloaded directive 
+         session.push    = lambda response, subscription, session = session: \
+                           self.post(lambda: self._push(session, response, subscription))
+         handler = lambda mask, session = session: self._sessionEvent(session, mask)
+         self._register(session.fd, select.POLLIN, handler)
+         self.sessions.add(session)
+
+   # -------------------------------------------------- EventLoop._sessionEvent()
+   def _sessionEvent(self, session, mask):
+      """ Handles poll() events for a client session. """
+      if mask & (select.POLLERR | select.POLLNVAL):
+         self._drop(session, "socket error")
+         return
+      if mask & select.POLLOUT: 
+         self._flush(session)
+      if mask & (select.POLLIN | select.POLLHUP) and session.fd in self.handlers:
+         self._read(session)
+
+   # ---------------------------------------------------------- EventLoop._read()
+   def _read(self, session):
+      """ Reads and handles the next message from a client. """
+      if session.busy or session.action != SESSION_CONTINUE: return
+      try:
+         data = session.connection.recv(max(BUF_SIZE, FRAME_RECV_SIZE) if session.framed else BUF_SIZE)
+      except socket.error as e:
+         if e[FIRST] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+         self._drop(session, str(e))
+         return
+      if not data:
+         message = "Connection closed by %s" %str(session.remoteAddr)
+         if VERBOSE: showMessage(message)
+         if LOGGING: log.logit(message)
+         self._drop(session, None)
+         return
+      try:
+         session.feed(data)
+      except FramingError as e:
+         self._drop(session, str(e))
+         return
+      self._handle(session)
+
+   # -------------------------------------------------------- EventLoop._handle()
+   def _handle(self, session):
+      """ Acts on the waiting messages of a session in order. OS directives 
+          are started without waiting for them, the messages after one wait 
+          for it to finish. Everything else is answered straight away. """
+      while session.pending and not session.busy and session.action == SESSION_CONTINUE:
+         data  = session.pending[FIRST]
+         start = time.time()
+         parts = parseMessage(data)
+         parsed = time.time() - start
+         if parts is None: 
+            directive = None
+         else:
+            directive, options, command = parts
+         cached = cache.get(session, parts)
+         # OS directives for a session shell wait on the shell, so they are
+         # offloaded as well 
+         offload = cached is None and (directive in OFFLOADED_DIRECTIVES or 
+                                       (directive == "OS" and session.useShell))
+         if offload and session.outbuf:
+            break # Offloaded once the replies before it have been sent 
+         session.pending.pop(FIRST)
+         stats.request(parts, parsed)
+         if cached is not None:
+            logReceived(session, data)
+            session.send(cached)
+         elif offload:
+            self._offload(session, data, parts)
+         elif directive == "OS" or (directive == "OS-STREAM" and session.framed):
+            logReceived(session, data)
+            try:
+               timeout = getTimeout(options)
+            except ValueError as e:
+               session.send(build_TA_Response(222, str(e)))
+               continue
+            self._startCommand(session, command, directive == "OS-STREAM", timeout)
+         else:
+            logReceived(session, data)
+            session.action = dispatchRequest(session, parts)
+      self._flush(session)
+
+   # -------------------------------------------------------- EventLoop._update()
+   def _update(self, session):
+      """ Watches a session for the events it is currently interested in. """
+      if session.fd not in self.handlers: return 
+      mask = 0
+      if not session.busy and session.action == SESSION_CONTINUE: 
+         mask |= select.POLLIN
+      if session.outbuf: 
+         mask |= select.POLLOUT
+      self.poller.modify(session.fd, mask)
+
+   # --------------------------------------------------------- EventLoop._flush()
+   def _flush(self, session):
+      """ Writes as much of the queued replies as the socket will take. """
+      while session.outbuf:
+         reply = session.outbuf[FIRST]
+         try:
+            sent = session.connection.send(buffer(reply, session.outpos))
+         except socket.error as e:
+            if e[FIRST] in (errno.EAGAIN, errno.EWOULDBLOCK): break
+            self._drop(session, str(e))
+            return
+         session.outpos += sent
+         if session.outpos >= len(reply):
+            session.outbuf.pop(FIRST)
+            session.outpos = 0
+      if not session.outbuf and session.action != SESSION_CONTINUE:
+         self._finishSession(session)
+      elif not session.outbuf and session.pending and not session.busy:
+         self._handle(session)
+      else:
+         self._update(session)
+         self._throttle(session)
+
+   # ------------------------------------------------------ EventLoop._throttle()
+   def _throttle(self, session):
+      """ Pauses reading the pipes of a streaming command while its client 
+          is behind, so that the Agent does not hold its output. """
+      c = session.command
+      if c is None or not c.stream: return
+      if len(session.outbuf) < STREAM_BACKLOG: mask = select.POLLIN
+      else:                                    mask = 0
+      for pipe in c.pipes: self.poller.modify(pipe.fileno(), mask)
+
+   # ------------------------------------------------- EventLoop._finishSession()
+   def _finishSession(self, session):
+      """ Starts the graceful close of a session that has ended, see 
+          closeConnection(). The session is closed once the client has 
+          closed its end, or CLOSE_LINGER seconds from now. """
+      self._unregister(session.fd)
+      self.sessions.discard(session)
+      try:
+         session.connection.shutdown(socket.SHUT_WR)
+      except socket.error:
+         self._close(session)
+         return
+      handler = lambda mask, session = session: self._drain(session)
+      self._register(session.fd, select.POLLIN, handler)
+      self.closing.append((time.time() + CLOSE_LINGER, session))
+
+   # --------------------------------------------------------- EventLoop._drain()
+   def _drain(self, session):
+      """ Throws away what a closing client sends until it closes its end. """
+      try:
+         if session.connection.recv(BUF_SIZE): return
+      except socket.error as e:
+         if e[FIRST] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+      self._close(session)
+
+   # --------------------------------------------------------- EventLoop._close()
+   def _close(self, session):
+      """ Closes a session that has ended. """
+      self._unregister(session.fd)
+      self.sessions.discard(session)
+      for closeTime, closing in self.closing:
+         if closing is session: 
+            self.closing.remove((closeTime, closing))
+            break
+      session.end()
+      session.connection.close()
+      if session.action == AGENT_SHUTDOWN: stopAgent()
+
+   # ---------------------------------------------------------- EventLoop._drop()
+   def _drop(self, session, reason):
+      """ Closes a session straight away. """
+      if reason is not None:
+         message = "Session with %s failed - %s" %(str(session.remoteAddr), reason)
+         showWarning(message)
+         if LOGGING: log.logit(message, WARN)
+      self._unregister(session.fd)
+      self.sessions.discard(session)
+      session.action = SESSION_CLOSE
+      session.end()
+      session.connection.close()
+      c = session.command
+      if c is not None and c.stream:  # Nobody left to hand the output to 
+         for pipe in c.pipes: self.poller.modify(pipe.fileno(), select.POLLIN)
+         c.kill()
+
+   # ---------------------------------------------------------- EventLoop._reap()
+   def _reap(self, session, reason):
+      """ Closes a session that has reached a session limit. A client that 
+          is not reading its replies is dropped, otherwise the session is 
+          closed gracefully. """
+      reapSession(session, reason)
+      if session.outbuf:
+         self._drop(session, None)
+      else:
+         session.action = SESSION_CLOSE
+         self._finishSession(session)
+
+   # -------------------------------------------------- EventLoop._startCommand()
+   def _startCommand(self, session, command, stream = False, timeout = None):
+      """ Starts an OS or OS-STREAM directive, the session is not read from 
+          until the command has finished and its results have been queued. """
+      if VERBOSE: showMessage("OS Command \"%s\"" % command)
+      c = AsyncCommand(session, command, stream, timeout)
+      session.busy    = True
+      session.command = c
+      if not c.start():
+         self._finishCommand(c)
+         return
+      if c.deadline is not None: self.timed.append(c)
+      c.pipes = [c.process.stdout, c.process.stderr]
+      for pipe, key, capture in ((c.process.stdout, OS_STDOUT, c.output), 
+                                 (c.process.stderr, OS_STDERR, c.error )):
+         handler = lambda mask, c = c, pipe = pipe, key = key, capture = capture: \
+                   self._pipeEvent(c, pipe, key, capture)
+         self._register(pipe.fileno(), select.POLLIN, handler)
+
+   # ----------------------------------------------------- EventLoop._pipeEvent()
+   def _pipeEvent(self, c, pipe, key, capture):
+      """ Collects output from a command pipe, or for OS-STREAM sends it on to 
+          the client. """
+      data = os.read(pipe.fileno(), PIPE_CHUNK)
+      if data and c.stream: 
+         if c.session.action == SESSION_CONTINUE:
+            c.session.send(build_STREAM_Response(c.command, key, data))
+            self._flush(c.session)
+         return
+      if data: 
+         capture.add(data)
+         return
+      self._unregister(pipe.fileno())
+      c.pipes.remove(pipe)
+      pipe.close()
+      c.openPipes -= 1
+      if c.openPipes == 0:
+         # A command closes its pipes as it exits, give it a moment to finish 
+         # exiting rather than wait for a timer, poll() counts in milliseconds
+         spin = time.time() + EXIT_SPIN
+         while c.process.poll() is None and time.time() < spin: time.sleep(EXIT_SPIN / 20)
+         if c.process.returncode is None: 
+            # Still running, check soon then less and less often 
+            c.exitWait  = EXIT_POLL_FIRST
+            c.exitCheck = time.time() + c.exitWait
+            self.exiting.append(c)
+         else:
+            self._finishCommand(c)
+
+   # ------------------------------------------------- EventLoop._finishCommand()
+   def _finishCommand(self, c):
+      """ Queues the results of a finished command to its session. """
+      if c.process is not None: 
+         c.returnCode = c.process.returncode
+         stats.executed(time.time() - c.started)
+      if c.timedOut:            c.returnCode = TIMEOUT_RETURNCODE
+      if c in self.timed:       self.timed.remove(c)
+      session = c.session
+      session.busy    = False
+      session.command = None
+      if session.action != SESSION_CONTINUE: return  # Client has gone away
+      if c.stream: message = "STREAM END"
+      else:        message = ""
+      response = build_RESULTS_Response(c.returnResults(), message)
+      if not c.stream: cache.store(session, "OS", c.command, response)
+      session.send(response)
+      self._handle(session)
+
+   # ------------------------------------------------------- EventLoop._offload()
+   def _offload(self, session, data, parts):
+      """ Hands a session to a thread for a directive that would block the 
+          loop, parts is the message data as parsed by parseMessage(). The 
+          thread uses the socket directly until the directive is done and 
+          the session is given back to the loop. """
+      session.busy   = True
+      session.outbuf = None
+      self._unregister(session.fd)
+      session.connection.setblocking(1)
+      def offloaded():
+         try:
+            logReceived(session, data)
+            action = dispatchRequest(session, parts)
+         except SessionExpired as e:
+            action = e
+         except (socket.error, FramingError) as e:
+            action = str(e)
+         self.post(lambda: self._resume(session, action))
+      thread = threading.Thread(target = offloaded)
+      thread.daemon = True
+      thread.start()
+
+   # -------------------------------------------------------- EventLoop._resume()
+   def _resume(self, session, action):
+      """ Takes back a session from an offloaded directive. """
+      session.busy   = False
+      session.outbuf = []
+      session.outpos = 0
+      session.connection.setblocking(0)
+      handler = lambda mask, session = session: self._sessionEvent(session, mask)
+      self._register(session.fd, select.POLLIN, handler)
+      if isinstance(action, str):  # The offloaded directive failed 
+         self._drop(session, action)
+         return
+      if isinstance(action, SessionExpired):
+         self._reap(session, str(action))
+         return
+      session.action = action
+      held, session.held = session.held, []
+      for response, subscription in held: self._push(session, response, subscription)
+      self._handle(session)
+
+   # ---------------------------------------------------------- EventLoop._push()
+   def _push(self, session, response, subscription):
+      """ Queues a sample of a subscription to its session, see 
+          Session.push(). The samples for an offloaded session wait until it 
+          is given back to the loop. A client that is behind misses samples 
+          rather than have the Agent hold them. """
+      if subscription.cancelled or session not in self.sessions or \
+         session.action != SESSION_CONTINUE: return
+      if session.outbuf is None: queued = session.held
+      else:                      queued = session.outbuf
+      if len(queued) >= STREAM_BACKLOG:
+         subscription.missed += 1
+         return
+      if session.outbuf is None:
+         session.held.append((response, subscription))
+         return
+      session.send(response)
+      self._flush(session)
+
+   # ---------------------------------------------------------- EventLoop.post()
+   def post(self, function):
+      """ Runs function() on the loop thread, may be called from any thread. """
+      self.posted.put(function)
+      os.write(self.wakeWrite, "x")
+
+   # ------------------------------------------------------- EventLoop._wakeup()
+   def _wakeup(self, mask):
+      """ Runs the functions posted from other threads. """
+      os.read(self.wakeRead, PIPE_CHUNK)
+      while True:
+         try:
+            function = self.posted.get_nowait()
+         except Queue.Empty:
+            return
+         function()
+
+   # ----------------------------------------------------- EventLoop._runTimers()
+   def _runTimers(self):
+      """ Finishes exited commands, kills commands that have timed out, 
+          closes sessions whose time is up and reaps sessions that have 
+          reached a session limit. """
+      rightNow = time.time()
+      for c in self.exiting[:]:
+         if c.process.poll() is not None:
+            self.exiting.remove(c)
+            self._finishCommand(c)
+         elif c.exitCheck <= rightNow:
+            c.exitWait  = min(c.exitWait * 2, EXIT_POLL)
+            c.exitCheck = rightNow + c.exitWait
+      for c in self.timed[:]:
+         if c.deadline > rightNow: continue
+         if not c.timedOut:
+            c.timedOut = True
+            c.kill()  # Its pipes close and it is finished as usual ...
+            c.deadline = rightNow + KILL_GRACE
+            continue
+         # ... unless something it started left the process group and holds 
+         # them, then stop reading them, as Command._communicate() does 
+         self.timed.remove(c)
+         if c in self.exiting: continue  # Its pipes are closed already
+         for pipe in c.pipes:
+            self._unregister(pipe.fileno())
+            pipe.close()
+         c.pipes     = []
+         c.openPipes = 0
+         if c.process.poll() is None:
+            c.exitWait  = EXIT_POLL_FIRST
+            c.exitCheck = rightNow + c.exitWait
+            self.exiting.append(c)
+         else:
+            self._finishCommand(c)
+      for closeTime, session in self.closing[:]:
+         if closeTime <= rightNow: self._close(session)
+      if self.nextReap is not None and self.nextReap <= rightNow:
+         self.nextReap = rightNow + REAP_INTERVAL
+         for session in list(self.sessions):
+            if session.busy or session.action != SESSION_CONTINUE: continue
+            if session.expires() <= rightNow: self._reap(session, session.expiredReason())
+# === End of class EventLoop =====	  
+
+# ==============================================================================
+# FUNCTIONS
+#    This section holds all of the functions used by the script. The first line 
+#    of the function is a comment that describes the fuunction. This comment 
+#    is read and usd by many IDEs for development hints.
+
+# ---------------------------------------------------------------------- usage()
+def usage():
+   """usage() - Prints the usage message on stdout. """
+   print "\n\n%s, Version %s, This is a Remote Agent.              " %(ME,VERSION)
+   print "\nUSAGE: %s [OPTIONS]                                    " %ME
+   print "                                                         "
+   print "OPTIONS:                                                 "
+   print "   -h --help      Display this message.                  "
+   print "   -v --verbose   Runs the program in verbose mode, default: %s. " %VERBOSE
+   print "   -d --debug     Runs the program on debug mode (implies verbose). "
+   print "   -p --port=     The TCP port number for the listener, default: %s " %PORT
+   print "   -a --address=  The TCP address for the listener, default: %s " %HOST
+   print "   -l --logging   Enables logging, default=%s, logfile=%s  " %(LOGGING, LOG_FILE)
+   print "   -b --buffer=   The size of the TCP comm. buffer, default: %d " %BUF_SIZE
+   print "   -w --workers=  Number of sessions served in parallel, default: %d " %WORKERS
+   print "   -e --eventloop Serve all sessions from one thread, default: %s " %EVENT_LOOP
+   print "   -x --capture-limit= Bytes of the output of a command kept in memory, "
+   print "                  past it the output is spilled to disk, 0 no limit, "
+   print "                  default: %d " %CAPTURE_LIMIT
+   print "   -g --cache=    File of the OS and SYS messages whose replies are "
+   print "                  cached and for how long, default: no cache "
+   print "   -u --udp-port= The UDP port health probes (PING) are answered on, "
+   print "                  0 off, default: %d " %UDP_PORT
+   print "   -n --processes= Worker processes sharing the port, each serving "
+   print "                  sessions as set by -w or -e, default: %d " %PROCESSES
+   print "   -m --max-parallel= Most BATCH commands run at once, default: %d " %MAX_PARALLEL
+   print "   -t --timeout=  Seconds an OS, OS-STREAM or BATCH command may run "
+   print "                  before it is killed, 0 no limit, default: %s " %OS_TIMEOUT
+   print "   -j --jobs=     Most jobs (JOB directive) run at once, default: %d " %JOB_WORKERS
+   print "   -q --job-queue= Order jobs are run in, fifo or priority, default: %s " %JOB_QUEUE
+   print "   -s --shell     Sessions run their OS commands in a shell of their "
+   print "                  own (see TA:shell), default: %s " %PERSISTENT_SHELL
+   print "   -c --compress-threshold= Smallest reply compressed in bytes, for "
+   print "                  sessions with TA:compress on, default: %d " %COMPRESS_THRESHOLD
+   print "   -i --idle-timeout= Seconds a session may send nothing before it is "
+   print "                  closed, 0 no limit, default: %s " %IDLE_TIMEOUT
+   print "   -r --max-session= Seconds a session may be open, 0 no limit, "
+   print "                  default: %s " %SESSION_LIFETIME
+   print "   -k --keepalive= Seconds without traffic before TCP keepalive probes "
+   print "                  are sent to a client, 0 off, default: %s " %KEEPALIVE_IDLE
+   print "   -z --log-size= Log file size in MB that starts a new log file, "
+   print "                  0 never, default: %d " %(LOG_MAX_BYTES / 1048576)
+   print "                                                         "
+   print "EXIT CODES:                                              "
+   print "    0 - Successful completion of the program.            "
+   print "    1 - Cannot import this script as a module.           "
+   print "    2 - Bad command line arguments.                      "
+   print "    3 - Bad port, must be a an integer                   "
+   print "    4 - Bad port, must be between 1025-65534 inclusive   "
+   print "    5 - Bad address, must be a string                    "
+   print "    6 - Bad buffer, must be etween 1025-65534 inclusive "
+   print "    7 - Bad workers, must be an integer of at least 1    "
+   print "    8 - Event loop not supported on this system          "
+   print "    9 - Bad max parallel, must be an integer of at least 1 "
+   print "   10 - Bad log size, must be an integer of at least 0  "
+   print "   11 - Bad jobs, must be an integer of at least 1       "
+   print "   12 - Bad job queue, must be fifo or priority          "
+   print "   13 - Bad timeout, must be a number of at least 0      "
+   print "   14 - Bad compress threshold, must be an integer of at least 0 "
+   print "   15 - Bad idle timeout, must be a number of at least 0 "
+   print "   16 - Bad max session, must be a number of at least 0  "
+   print "   17 - Bad keepalive, must be an integer of at least 0  "
+   print "   18 - Bad processes, must be an integer of at least 1, more than 1 "
+   print "        needs fork() and SO_REUSEPORT                    "
+   print "   19 - Bad capture limit, must be an integer of at least 0 "
+   print "   20 - Unable to read the cache file, or a bad line in it  "
+   print "   21 - Bad UDP port, must be 0 or between 1025-65534 inclusive "
+   print "   22 - Unable to bind the health probe to the UDP port  "
+   print "                                                         " 
+   print "EXAMPLES:                                                " 
+   print "    TODO - I'll make some examples up later.             "
+   print "                                                         "
+
+# ---------------------------------------------------------------------- pause()
+def pause():
+   """pause() Holds script execution until the user responds. """
+   raw_input(PAUSE_PROMPT)
+   return 
+
+# ------------------------------------------------------------------------ now()
+def now():
+   """now() returns a timestamp string of the form "YYYY-MM-DD, HH:MM:SS"  """
+   return time.strftime("%Y-%b-%d, %H:%M:%S", time.localtime())
+
+# ------------------------------------------------------------------ showError()
+def showError(message):
+   """showError(str message) write error message to stderr"""
+   message = str(message)
+   sys.stderr.write("\n\nERROR -- %s\n\n" %message)
+   sys.stderr.flush()
+   return 
 
 # ---------------------------------------------------------------- showWarning()
 def showWarning(message):
@@ -489,8 +3493,1417 @@ def build_OS_Response(taCode, taMessage, osCommand, osOutput, osError, osReturnc
       response = {AGENT_RETURN_CODE : 99                                      , 
                   AGENT_MESSAGE     : "Unable to process Operating System Directive"}
    return response 
+
+# ----------------------------------------------------- build_RESULTS_Response()   
+def build_RESULTS_Response(results, taMessage = ""):
+   """build_RESULTS_Response(dict results, str taMessage) Returns the OS 
+      directive reply for the results of a command (see 
+      Command.returnResults()). A command that timed out gets an 
+      AGENT_RETURN_CODE of 221, output that was spilled adds OS_SPILL. """
+   if results.get("timedOut"):
+      taCode    = 221
+      taMessage = "OS COMMAND TIMED OUT"
+   else:
+      taCode    = 0
+   response = build_OS_Response(taCode                , 
+                                taMessage             , 
+                                results["command"]    , 
+                                results["output"]     , 
+                                results["error"]      , 
+                                results["returnCode"] )
+   if results.get("spills"): response[OS_SPILL] = results["spills"]
+   return response
+
+# ------------------------------------------------------ build_STREAM_Response()   
+def build_STREAM_Response(osCommand, osStream, osData):
+   response = {}
+   try:
+      response[AGENT_RETURN_CODE] = 0
+      response[AGENT_MESSAGE]     = "STREAM"
+      response[OS_COMMAND]        = str(osCommand)       
+      response[OS_STREAM]         = str(osStream)        
+      response[OS_DATA]           = str(osData)        
+   except:
+      response = {AGENT_RETURN_CODE : 99                                      , 
+                  AGENT_MESSAGE     : "Unable to process Operating System Directive"}
+   return response 
+
+# ------------------------------------------------------- build_BATCH_Response()   
+def build_BATCH_Response(osResponses):
+   response = {}
+   try:
+      response[AGENT_RETURN_CODE] = 0
+      response[AGENT_MESSAGE]     = ""
+      response[BATCH_RESULTS]     = list(osResponses)
+   except:
+      response = {AGENT_RETURN_CODE : 99                                      , 
+                  AGENT_MESSAGE     : "Unable to process Batch Directive"}
+   return response 
+
+# --------------------------------------------------------- build_JOB_Response()   
+def build_JOB_Response(taCode, taMessage, jobId, jobState):
+   response = {}
+   try:
+      response[AGENT_RETURN_CODE] = int(taCode)
+      response[AGENT_MESSAGE]     = str(taMessage)
+      response[JOB_ID]            = int(jobId)
+      response[JOB_STATE]         = str(jobState)
+   except:
+      response = {AGENT_RETURN_CODE : 99                                      , 
+                  AGENT_MESSAGE     : "Unable to process Job Directive"}
+   return response 
+
+# -------------------------------------------------------- build_FILE_Response()   
+def build_FILE_Response(taCode, taMessage, path, size, offset = None, checksum = None):
+   response = {}
+   try:
+      response[AGENT_RETURN_CODE] = int(taCode)
+      response[AGENT_MESSAGE]     = str(taMessage)
+      response[FILE_PATH]         = str(path)
+      response[FILE_SIZE]         = int(size)
+      if offset is not None:   response[FILE_OFFSET]   = int(offset)
+      if checksum is not None: response[FILE_CHECKSUM] = str(checksum)
+   except:
+      response = {AGENT_RETURN_CODE : 99                                      , 
+                  AGENT_MESSAGE     : "Unable to process File Directive"}
+   return response 
+
+# ------------------------------------------------------- build_PING_Response()
+def build_PING_Response(token = ""):
+   """build_PING_Response(str token) Builds the reply to a PING, see HEALTH 
+      PROBE. """
+   data = {"NAME"         : AGENT_NAME, 
+           "VERSION"      : VERSION   , 
+           "AGENT_UPTIME" : round(time.time() - stats.started, 3)}
+   try:
+      load = readLoad()
+      for name in ("LOAD_1", "LOAD_5", "LOAD_15", "UPTIME"): data[name] = load[name]
+   except SYS_ERRORS: # No /proc, load averages where the system has them 
+      try:    averages = os.getloadavg()
+      except (AttributeError, OSError): averages = (None, None, None)
+      data.update(zip(("LOAD_1", "LOAD_5", "LOAD_15"), averages))
+      data["UPTIME"] = None
+   response = build_TA_Response(0, "PONG")
+   response[PING_DATA] = data
+   if token: response[PING_TOKEN] = token[:PROBE_TOKEN_MAX]
+   return response
+
+# ---------------------------------------------------------- encodeResponse()
+def encodeResponse(response, encoding):
+   """encodeResponse(dict response, str encoding) Returns the response 
+      encoded as "json" or "binary" (see encodeBinary()). """
+   if encoding == "json":
+      try:
+         return json.dumps(response, separators = (',', ':'))
+      except UnicodeDecodeError: # Output that is not UTF-8 goes byte for byte 
+         return json.dumps(response, separators = (',', ':'), encoding = "latin-1")
+   return encodeBinary(response)
+
+# ------------------------------------------------------------ encodeBinary()
+def encodeBinary(value):
+   """encodeBinary(value) Returns the compact binary encoding of a response.
+      Every value starts with a one character tag:
+         N  None                     T, F  True, False
+         b  int 0-255, 1 byte        i     int, 4 bytes signed
+         q  int, 8 bytes signed      f     float, 8 bytes
+         s  string, 4 byte length and the bytes of the string
+         k  1 byte index of a response key name in BINARY_KEYS
+         l  list, 4 byte count and the encoded items 
+         d  dictionary, 4 byte count and the encoded keys and values
+      Numbers are in network byte order. """
+   chunks = []
+   _encodeBinary(value, chunks)
+   return "".join(chunks)
+
+def _encodeBinary(value, chunks):
+   """ Appends the binary encoding of value to the list chunks. """
+   if value is None:              chunks.append("N")
+   elif value is True:            chunks.append("T")
+   elif value is False:           chunks.append("F")
+   elif isinstance(value, (int, long)):
+      if 0 <= value < 256:        chunks.append("b" + chr(value))
+      elif -2**31 <= value < 2**31: chunks.append("i" + struct.pack("!i", value))
+      else:                       chunks.append("q" + struct.pack("!q", value))
+   elif isinstance(value, float): chunks.append("f" + struct.pack("!d", value))
+   elif isinstance(value, basestring):
+      if isinstance(value, unicode): value = value.encode("utf-8")
+      if value in BINARY_KEY_INDEX:
+         chunks.append("k" + chr(BINARY_KEY_INDEX[value]))
+      else:
+         chunks.append("s" + struct.pack("!I", len(value)))
+         chunks.append(value)
+   elif isinstance(value, (list, tuple)):
+      chunks.append("l" + struct.pack("!I", len(value)))
+      for item in value: _encodeBinary(item, chunks)
+   elif isinstance(value, dict):
+      chunks.append("d" + struct.pack("!I", len(value)))
+      for key in value:
+         _encodeBinary(key, chunks)
+         _encodeBinary(value[key], chunks)
+   else:
+      _encodeBinary(str(value), chunks)
+
+# ------------------------------------------------------------ parseMessage()
+def parseMessage(data):
+   """parseMessage(str data) Splits a message of the form 
+      DIRECTIVE[;option=value ...]:COMMAND into a cleaned up 
+      (directive, options, command) tuple, options is a dictionary of the 
+      option values by lower case option name. Returns None if the message 
+      is not of that form. """
+   messageParts = data.split(':', 1)
+   if len(messageParts) != 2: return None
+   directiveParts = messageParts[FIRST].split(';')
+   directive = directiveParts[FIRST].strip().upper()
+   options   = {}
+   for option in directiveParts[1:]:
+      name, sep, value = option.partition('=')
+      options[name.strip().lower()] = value.strip()
+   command   = messageParts[LAST].strip()
+   return (directive, options, command)
+
+# ------------------------------------------------------------- getTimeout()
+def getTimeout(options, default = None):
+   """getTimeout(dict options, default) Returns the seconds an OS command may 
+      run for from the "timeout" option of a directive, 0 for no limit, or 
+      default if there is no timeout option. The default default is the 
+      --timeout of the Agent. Raises ValueError for a bad timeout. """
+   if "timeout" not in options: 
+      if default is None: return OS_TIMEOUT
+      return default
+   try:
+      timeout = float(options["timeout"])
+   except ValueError:
+      timeout = -1
+   if timeout < 0:
+      raise ValueError("timeout must be a number of seconds, 0 for no limit")
+   return timeout
+
+# --------------------------------------------------------- monotonicClock()
+def monotonicClock():
+   """monotonicClock() Returns a function that returns the seconds from a 
+      clock that only goes forward, it is not moved when the system time is 
+      set. Python 2 has no such clock so it is read with clock_gettime() 
+      through ctypes, where that cannot be done time.time() is returned. """
+   if hasattr(time, "monotonic"): return time.monotonic
+   if ctypes is None: return time.time
+   class timespec(ctypes.Structure):
+      _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+   try:
+      clockGettime = ctypes.CDLL(ctypes.util.find_library("rt"), use_errno = True).clock_gettime
+      clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+      if clockGettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) != 0: return time.time
+   except (OSError, AttributeError):
+      return time.time
+   def monotonic():
+      now = timespec()
+      clockGettime(CLOCK_MONOTONIC, ctypes.byref(now))
+      return now.tv_sec + now.tv_nsec * 1e-9
+   return monotonic
+
+# ---------------------------------------------------------- runCommands()
+def runCommands(commands, parallel, timeout = None):
+   """runCommands(list commands, int parallel, timeout) Executes the 
+      commands, up to "parallel" of them at once, each for at most timeout 
+      seconds, and returns a list of their results in the order of the 
+      commands. """
+   results = [None] * len(commands)
+   todo    = Queue.Queue()
+   for index, command in enumerate(commands): todo.put((index, command))
+   def worker():
+      while True:
+         try:
+            index, command = todo.get_nowait()
+         except Queue.Empty:
+            return
+         c = Command(command)
+         c.run(timeout)
+         results[index] = c.returnResults()
+   if parallel <= 1:
+      worker()
+   else:
+      threads = [threading.Thread(target = worker) for i in range(parallel)]
+      for thread in threads: thread.start()
+      for thread in threads: thread.join()
+   return results
+
+# --------------------------------------------------------------- processTA()
+def processTA(session, command):
+   """processTA(session, command) Processes a TA directive and returns the 
+      session action (SESSION_CONTINUE, SESSION_CLOSE or AGENT_SHUTDOWN). """
+   global AGENT_NAME
+   # ------------------------------------------------------------- TA:VERSION
+   if command == "version":
+      session.send(build_TA_Response(0, "VERSION %s" %VERSION))
+   # ----------------------------------------------------------------- TA:BYE
+   elif command == "bye" or command == "quit" or command == "exit": 
+      session.send(build_TA_Response(0, "CLOSING CONNECTION"))
+      return SESSION_CLOSE
+   # ------------------------------------------------------------ TA:SHUTDOWN
+   elif command == "shutdown" or command == "SHUTDOWN": 
+      session.send(build_TA_Response(0, "SHUTTING DOWN AGENT"))
+      return AGENT_SHUTDOWN
+   # ------------------------------------------------------------- TA:GETNAME
+   elif command == "getname" or command == "GETNAME":
+      session.send(build_TA_Response(0, AGENT_NAME), "[0, \"%s\"]" %AGENT_NAME)
+   # ------------------------------------------------------------- TA:SETNAME
+   elif command.find("setname") > -1:
+      if command.find('=') > -1:
+         parts = command.split('=')
+         if len(parts) != 2:
+            message = "Bad TA:setname - must have a name after the \'=\' operator"
+            session.send(build_TA_Response(2, message), "[2, \"%s\"]" %message)
+         else:
+            AGENT_NAME = parts[LAST].strip()
+            if VERBOSE: showMessage("Agent Name set to \"%s\"" %AGENT_NAME)
+            message = "Agent Name set to \'%s\'" %AGENT_NAME
+            session.send(build_TA_Response(0, message), "[0, \"%s\"]" %message)
+      else:
+         message = "TA:setname requires an assignment using \'=\'"
+         session.send(build_TA_Response(1, message), "[1, \"%s\"]" %message)
+   # --------------------------------------------------------- TA:GETUSERNAME 
+   elif command == "getusername" or command == "GETUSERNAME":
+      session.send(build_TA_Response(0, USER), "[0, \"%s\"]" %USER)
+   # ----------------------------------------------------------- TA:LOCALTIME 
+   elif command == "localtime" or command == "LOCALTIME":
+      session.send(build_TA_Response(0, now()))
+   # ------------------------------------------------------------- TA:FRAMING
+   elif command.startswith("framing"):
+      setting = command.split('=', 1)[LAST].strip().lower()
+      if command.find('=') < 0 or setting not in ("on", "off"):
+         session.send(build_TA_Response(3, "TA:framing must be set to on or off"))
+      else:
+         session.send(build_TA_Response(0, "FRAMING %s" %setting.upper()))
+         session.framed = (setting == "on") # Takes effect after this reply
+   # ------------------------------------------------------------ TA:ENCODING
+   elif command.startswith("encoding"):
+      setting = command.split('=', 1)[LAST].strip().lower()
+      if command.find('=') < 0 or setting not in ENCODINGS:
+         message = "TA:encoding must be set to one of %s" %", ".join(ENCODINGS)
+         session.send(build_TA_Response(4, message))
+      elif setting == "binary" and not session.framed:
+         message = "TA:encoding=binary needs a framed session, send TA:framing=on first"
+         session.send(build_TA_Response(4, message))
+      else:
+         session.send(build_TA_Response(0, "ENCODING %s" %setting.upper()))
+         session.encoding = setting # Takes effect after this reply
+   # --------------------------------------------------------------- TA:SHELL
+   elif command.startswith("shell"):
+      setting = command.split('=', 1)[LAST].strip().lower()
+      if command.find('=') < 0 or setting not in ("on", "off"):
+         session.send(build_TA_Response(5, "TA:shell must be set to on or off"))
+      else:
+         session.useShell = (setting == "on")
+         if not session.useShell: session.stopShell()
+         session.send(build_TA_Response(0, "SHELL %s" %setting.upper()))
+   # ------------------------------------------------------------ TA:COMPRESS
+   elif command.startswith("compress"):
+      setting = command.split('=', 1)[LAST].strip().lower()
+      levels  = [str(level) for level in range(1, 10)]
+      if command.find('=') < 0 or setting not in ["on", "off"] + levels:
+         message = "TA:compress must be set to on, off or a level from 1 to 9"
+         session.send(build_TA_Response(6, message))
+      elif not session.framed:
+         message = "TA:compress needs a framed session, send TA:framing=on first"
+         session.send(build_TA_Response(6, message))
+      else:
+         session.send(build_TA_Response(0, "COMPRESS %s" %setting.upper()))
+         if   setting == "on":  session.compress = COMPRESS_LEVEL # Takes effect after this reply
+         elif setting == "off": session.compress = 0
+         else:                  session.compress = int(setting)
+   # --------------------------------------------------------------- TA:STATS
+   elif command == "stats" or command == "STATS":
+      response = build_TA_Response(0, "")
+      response[AGENT_STATS] = stats.report()
+      session.send(response)
+   # ---------------------------------------------------------------- TA:HELP 
+   elif command == "help" or command == "HELP":
+      message = "Valid TA Commands are: version, localtime, framing, encoding, shell, compress, stats, bye, shutdown, help"
+      session.send(build_TA_Response(0, message))
+   # --------------------------------------------------------- TA:BAD COMMAND
+   else:
+      message = "Unknown TA Command \"%s\"" %command
+      session.send(build_TA_Response(97, message))
+   return SESSION_CONTINUE
+
+# --------------------------------------------------------------- processOS()
+def processOS(session, options, command):
+   """processOS(session, options, command) Executes an OS directive and sends
+      the results back to the client. """
+   try:
+      timeout = getTimeout(options)
+   except ValueError as e:
+      session.send(build_TA_Response(222, str(e)))
+      return SESSION_CONTINUE
+   if VERBOSE: showMessage("OS Command \"%s\"" % command)
+   response = build_RESULTS_Response(session.runCommand(command, timeout))
+   cache.store(session, "OS", command, response)
+   session.send(response)
+   return SESSION_CONTINUE
+
+# ------------------------------------------------------------- logReceived()
+def logReceived(session, data):
+   """logReceived(session, data) Reports a message received from a client. """
+   message = "Message from %s: %s" % (str(session.remoteAddr), data)
+   if VERBOSE: showMessage(message)
+   if LOGGING: log.logit(message)
+
+# --------------------------------------------------------- processOSStream()
+def processOSStream(session, options, command):
+   """processOSStream(session, options, command) Executes an OS-STREAM 
+      directive, the output is sent to the client as it is produced followed
+      by a final reply with the return code. Needs a framed session. """
+   if not session.framed:
+      message = "OS-STREAM needs a framed session, send TA:framing=on first"
+      session.send(build_TA_Response(220, message))
+      return SESSION_CONTINUE
+   try:
+      timeout = getTimeout(options)
+   except ValueError as e:
+      session.send(build_TA_Response(222, str(e)))
+      return SESSION_CONTINUE
+   if VERBOSE: showMessage("OS-STREAM Command \"%s\"" % command)
+   c = Command(command)
+   c.stream(lambda osStream, osData: 
+            session.send(build_STREAM_Response(c.command, osStream, osData)), 
+            timeout)
+   session.send(build_RESULTS_Response(c.returnResults(), "STREAM END"))
+   return SESSION_CONTINUE
+
+# ------------------------------------------------------------ processBatch()
+def processBatch(session, options, command):
+   """processBatch(session, options, command) Executes a BATCH directive, the
+      command is a list of OS commands such as ["uname -a", "df -h"]. The 
+      commands are run one after the other, or up to the "parallel" option 
+      at once, and their OS replies are sent back together as one reply. """
+   try:
+      commands = ast.literal_eval(command)
+      if not isinstance(commands, (list, tuple)) or \
+         not all([isinstance(c, basestring) for c in commands]): 
+         raise ValueError("not a list of strings")
+      parallel = int(options.get("parallel", 1))
+      timeout  = getTimeout(options)
+   except Exception:
+      message = "BATCH needs a list of OS commands, like [\"uname -a\", \"df -h\"], " + \
+                "and a number for the parallel and timeout options"
+      session.send(build_TA_Response(230, message))
+      return SESSION_CONTINUE
+   parallel = max(1, min(parallel, MAX_PARALLEL, len(commands)))
+   if VERBOSE: showMessage("BATCH of %d commands, %d at once" %(len(commands), parallel))
+   responses = [build_RESULTS_Response(results) 
+                for results in runCommands(commands, parallel, timeout)]
+   session.send(build_BATCH_Response(responses))
+   return SESSION_CONTINUE
+
+# -------------------------------------------------------------- processJob()
+def processJob(session, options, command):
+   """processJob(session, options, command) Processes a JOB directive, the 
+      command is one of submit=OS command, status=ID, result=ID, cancel=ID 
+      or list. Jobs belong to the Agent, not to the session, so any session 
+      may ask about a job. """
+   name, sep, value = command.partition('=')
+   name  = name.strip().lower()
+   value = value.strip()
+   # ------------------------------------------------------------ JOB:SUBMIT
+   if name == "submit" and value:
+      try:
+         priority = int(options.get("priority", 0))
+         timeout  = getTimeout(options, 0) # Jobs are for long commands 
+      except ValueError:
+         message = "JOB priority must be an integer and timeout a number of seconds"
+         session.send(build_TA_Response(240, message))
+         return SESSION_CONTINUE
+      job = jobs.submit(value, priority, timeout)
+      if job is None:
+         message = "Agent already holds %d jobs, collect some results first" %MAX_JOBS
+         session.send(build_TA_Response(244, message))
+      else:
+         if VERBOSE: showMessage("JOB %d submitted \"%s\"" %(job.jobId, value))
+         session.send(build_JOB_Response(0, "JOB SUBMITTED", job.jobId, job.state))
+      return SESSION_CONTINUE
+   # -------------------------------------------------------------- JOB:LIST
+   if name == "list":
+      response = build_TA_Response(0, "")
+      response[JOB_LIST] = [j.describe() for j in jobs.list()]
+      session.send(response)
+      return SESSION_CONTINUE
+   if name not in ("status", "result", "cancel"):
+      message = "JOB command must be submit=, status=, result=, cancel= or list"
+      session.send(build_TA_Response(240, message))
+      return SESSION_CONTINUE
+   try:
+      jobId = int(value)
+   except ValueError:
+      session.send(build_TA_Response(240, "JOB:%s needs a job ID, like %s=12" %(name, name)))
+      return SESSION_CONTINUE
+   if   name == "status": job = jobs.get(jobId)
+   elif name == "result": job = jobs.collect(jobId)
+   else:                  job = jobs.cancel(jobId)
+   if job is None:
+      session.send(build_TA_Response(241, "Unknown job %d" %jobId))
+   # ------------------------------------------------------------ JOB:STATUS
+   elif name == "status":
+      session.send(build_JOB_Response(0, "", job.jobId, job.state))
+   # ------------------------------------------------------------ JOB:RESULT
+   elif name == "result":
+      if job.finished is None:
+         message = "Job %d is not finished" %jobId
+         session.send(build_JOB_Response(242, message, job.jobId, job.state))
+      else:
+         response = build_RESULTS_Response(job.command.returnResults())
+         response[JOB_ID]    = job.jobId
+         response[JOB_STATE] = job.state
+         session.send(response)
+   # ------------------------------------------------------------ JOB:CANCEL
+   elif job.state != JOB_CANCELLED:
+      message = "Job %d is already finished" %jobId
+      session.send(build_JOB_Response(243, message, job.jobId, job.state))
+   else:
+      session.send(build_JOB_Response(0, "JOB CANCELLED", job.jobId, job.state))
+   return SESSION_CONTINUE
+
+# ------------------------------------------------------------- processFile()
+def processFile(session, options, command):
+   """processFile(session, options, command) Processes a FILE directive, the 
+      command is get=PATH, put=PATH or stat=PATH. Needs a framed session, 
+      see FILE TRANSFERS. """
+   if not session.framed:
+      message = "FILE needs a framed session, send TA:framing=on first"
+      session.send(build_TA_Response(250, message))
+      return SESSION_CONTINUE
+   name, sep, path = command.partition('=')
+   name = name.strip().lower()
+   path = path.strip()
+   if name not in ("get", "put", "stat") or not path:
+      message = "FILE command must be get=, put= or stat= and a path, like get=/tmp/out.log"
+      session.send(build_TA_Response(250, message))
+      return SESSION_CONTINUE
+   try:
+      offset    = int(options.get("offset", 0))
+      size      = int(options.get("size", -1))
+      algorithm = options.get("checksum", "").lower() or None
+      if offset < 0 or (name == "put" and size < 0) or \
+         (algorithm is not None and algorithm not in CHECKSUMS):
+         raise ValueError("bad option")
+   except ValueError:
+      message = "FILE offset and size must be whole numbers of bytes, put needs a size " + \
+                "and checksum must be one of %s" %", ".join(CHECKSUMS)
+      session.send(build_TA_Response(250, message))
+      return SESSION_CONTINUE
+   if VERBOSE: showMessage("FILE:%s \"%s\"" %(name, path))
+   # Samples of subscriptions (SUB) are held back until the copy is done 
+   if name == "get":
+      with session.sendLock: sendFile(session, path, offset, algorithm)
+   elif name == "put": 
+      with session.sendLock: receiveFile(session, path, offset, size, algorithm)
+   else:
+      try:
+         f = open(path, "rb")
+      except IOError as e:
+         session.send(build_TA_Response(251, "Unable to read %s - %s" %(path, e.strerror)))
+         return SESSION_CONTINUE
+      try:
+         size     = os.fstat(f.fileno()).st_size
+         checksum = None
+         if algorithm is not None: checksum = checksumFile(f, algorithm, size).hexdigest()
+      finally:
+         f.close()
+      session.send(build_FILE_Response(0, "", path, size, checksum = checksum))
+   return SESSION_CONTINUE
+
+# ------------------------------------------------------------ checksumFile()
+def checksumFile(f, algorithm, length):
+   """checksumFile(file f, str algorithm, int length) Returns a hashlib 
+      object fed with the first length bytes of the open file f. """
+   digest = hashlib.new(algorithm)
+   f.seek(0)
+   while length > 0:
+      data = f.read(min(length, FILE_CHUNK))
+      if not data: break
+      digest.update(data)
+      length -= len(data)
+   return digest
+
+# ---------------------------------------------------------------- sendFile()
+def sendFile(session, path, offset, algorithm):
+   """sendFile(session, path, offset, algorithm) Sends a file from offset on 
+      as raw frames between a FILE DATA and a FILE END reply (FILE:get). The 
+      kernel copies the file to the socket with sendfile() where Python has 
+      it, unless a checksum is wanted, otherwise FILE_CHUNK bytes at a time 
+      are read and sent, compressed if the session has compression on. """
+   try:
+      f = open(path, "rb")
+   except IOError as e:
+      session.send(build_TA_Response(251, "Unable to read %s - %s" %(path, e.strerror)))
+      return
+   try:
+      size = os.fstat(f.fileno()).st_size
+      if offset > size:
+         message = "FILE offset %d is past the end of %s, %d bytes" %(offset, path, size)
+         session.send(build_TA_Response(250, message))
+         return
+      digest = None
+      if algorithm is not None: digest = checksumFile(f, algorithm, offset)
+      session.send(build_FILE_Response(0, "FILE DATA", path, size, offset))
+      f.seek(offset)
+      fd       = session.connection.fileno()
+      position = offset
+      short    = False    # The file has shrunk, the rest is padding 
+      while position < size:
+         count  = min(FILE_CHUNK, size - position)
+         if sendfile is not None and digest is None and not session.compress and not short:
+            header = struct.pack(FRAME_HEADER, count)
+            session.connection.sendall(header)
+            stats.sentData(len(header) + count)
+            done = 0
+            while done < count:
+               sent = sendfile(fd, f.fileno(), position + done, count - done)
+               if sent == 0: break
+               done += sent
+            if done < count:
+               short = True
+               session.connection.sendall("\0" * (count - done))
+         else:
+            data = ""
+            if not short:
+               try:
+                  data = f.read(count)
+               except IOError:
+                  pass
+               if digest is not None: digest.update(data)
+            if len(data) < count:
+               short = True
+               data += "\0" * (count - len(data))
+            session.sendData(data)
+         position += count
+      if short:
+         message = "%s shrank while it was being sent, the end of it is zero bytes" %path
+         session.send(build_FILE_Response(251, message, path, size))
+      else:
+         checksum = None
+         if digest is not None: checksum = digest.hexdigest()
+         session.send(build_FILE_Response(0, "FILE END", path, size, checksum = checksum))
+   finally:
+      f.close()
+
+# ------------------------------------------------------------- receiveFile()
+def receiveFile(session, path, offset, size, algorithm):
+   """receiveFile(session, path, offset, size, algorithm) Writes size bytes 
+      sent by the client as raw frames to a file from offset on (FILE:put). 
+      The frames are written as they arrive, one at a time. """
+   try:
+      if offset:
+         f = open(path, "r+b")
+         if os.fstat(f.fileno()).st_size < offset:
+            f.close()
+            message = "FILE offset %d is past the end of %s" %(offset, path)
+            session.send(build_TA_Response(250, message))
+            return
+         f.truncate(offset)
+      else:
+         f = open(path, "wb")
+   except IOError as e:
+      session.send(build_TA_Response(251, "Unable to write %s - %s" %(path, e.strerror)))
+      return
+   digest = None
+   if algorithm is not None: digest = checksumFile(f, algorithm, offset)
+   f.seek(offset)
+   session.send(build_FILE_Response(0, "FILE READY", path, offset, offset))
+   remaining = size
+   failure   = None   # Set once the file can not be written 
+   try:
+      while remaining > 0:
+         data = session.recvMessage()
+         if data is None: return  # Client gone, what it sent is kept for a resume 
+         if len(data) > remaining: 
+            failure = (250, "FILE put was sent more than its size of %d bytes" %size)
+            data    = data[:remaining]
+         remaining -= len(data)
+         if digest is not None: digest.update(data)
+         if failure is None:
+            try:
+               f.write(data)
+            except IOError as e:
+               failure = (251, "Unable to write %s - %s" %(path, e.strerror))
+   finally:
+      try:
+         f.close()
+      except IOError as e:
+         if failure is None: failure = (251, "Unable to write %s - %s" %(path, e.strerror))
+   if failure is not None:
+      session.send(build_TA_Response(*failure))
+      return
+   checksum = None
+   if digest is not None: checksum = digest.hexdigest()
+   session.send(build_FILE_Response(0, "FILE RECEIVED", path, offset + size, checksum = checksum))
+
+# -------------------------------------------------------------- processSys()
+def processSys(session, command):
+   """processSys(session, command) Processes a SYS directive, see SYSTEM 
+      METRICS. The counters are read by the Agent itself, nothing is run. """
+   if sysCommand(command) is None:
+      message = "SYS command must be one of %s, or disk=PATH" %", ".join(SYS_COMMANDS)
+      session.send(build_TA_Response(260, message))
+      return SESSION_CONTINUE
+   try:
+      data = readSys(command)
+   except SYS_ERRORS as e:
+      message = "Unable to read the system counters for SYS:%s - %s" %(command, str(e))
+      session.send(build_TA_Response(261, message))
+      return SESSION_CONTINUE
+   response = build_TA_Response(0, "")
+   response[SYS_DATA] = data
+   cache.store(session, "SYS", command, response)
+   session.send(response)
+   return SESSION_CONTINUE
+
+# -------------------------------------------------------------- sysCommand()
+def sysCommand(command):
+   """sysCommand(str command) Returns the (name, value) of a SYS command, 
+      None if it is not one. """
+   name, sep, value = command.partition('=')
+   name  = name.strip().lower()
+   value = value.strip()
+   if name not in SYS_COMMANDS or (value and name != "disk"): return None
+   return name, value
+
+# ----------------------------------------------------------------- readSys()
+def readSys(command):
+   """readSys(str command) Returns the counters asked for by a SYS command 
+      checked by sysCommand(), raises one of SYS_ERRORS if they cannot be 
+      read. """
+   name, value = sysCommand(command)
+   if   name == "cpu":       return readCpu()
+   elif name == "load":      return readLoad()
+   elif name == "memory":    return readMemory()
+   elif name == "disk":      return readDisks(value or None)
+   elif name == "diskio":    return readDiskIO()
+   elif name == "net":       return readNet()
+   elif name == "processes": return readProcesses()
+   return {"CPU"    : readCpu()   , "LOAD"   : readLoad()  , 
+           "MEMORY" : readMemory(), "DISK"   : readDisks() , 
+           "DISKIO" : readDiskIO(), "NET"    : readNet()   }
+
+# ------------------------------------------------------------ processSpill()
+def processSpill(session, options, command):
+   """processSpill(session, options, command) Processes a SPILL directive, 
+      the command is read=ID, drop=ID or list, see LARGE OUTPUT. """
+   name, sep, value = command.partition('=')
+   name  = name.strip().lower()
+   value = value.strip()
+   # ------------------------------------------------------------ SPILL:LIST
+   if name == "list":
+      response = build_TA_Response(0, "")
+      response[SPILL_LIST] = []
+      for spill in spills.list():
+         entry = spill.describe()
+         entry[OS_COMMAND] = spill.command
+         entry["STREAM"]   = spill.key
+         response[SPILL_LIST].append(entry)
+      session.send(response)
+      return SESSION_CONTINUE
+   try:
+      spillId = int(value)
+      offset  = int(options.get("offset", 0))
+      size    = int(options.get("size", SPILL_CHUNK))
+      if name not in ("read", "drop") or offset < 0 or not 0 < size <= SPILL_READ_MAX: 
+         raise ValueError("bad option")
+   except ValueError:
+      message = "SPILL command must be read=ID, drop=ID or list, offset a whole number " + \
+                "of bytes and size at most %d bytes" %SPILL_READ_MAX
+      session.send(build_TA_Response(280, message))
+      return SESSION_CONTINUE
+   # ------------------------------------------------------------ SPILL:DROP
+   if name == "drop":
+      if spills.drop(spillId): session.send(build_TA_Response(0, "SPILL DROPPED"))
+      else:                    session.send(build_TA_Response(281, "Unknown spill %d" %spillId))
+      return SESSION_CONTINUE
+   # ------------------------------------------------------------ SPILL:READ
+   spill = spills.get(spillId)
+   if spill is None:
+      session.send(build_TA_Response(281, "Unknown spill %d" %spillId))
+      return SESSION_CONTINUE
+   response = build_TA_Response(0, "")
+   response.update(spill.describe())
+   response[SPILL_OFFSET] = offset
+   response[OS_DATA]      = spill.read(offset, size)
+   session.send(response)
+   return SESSION_CONTINUE
+
+# ------------------------------------------------------------ processCache()
+def processCache(session, command):
+   """processCache(session, command) Processes a CACHE directive, the command
+      is list, invalidate or invalidate=MESSAGE, see RESULT CACHE. """
+   name, sep, value = command.partition('=')
+   name = name.strip().lower()
+   if name == "list" and not sep:
+      response = build_TA_Response(0, "")
+      response[CACHE_LIST]   = cache.list()
+      response[CACHE_HITS]   = cache.hits
+      response[CACHE_MISSES] = cache.misses
+      session.send(response)
+   elif name == "invalidate":
+      pattern = value.strip() or "*"
+      if sep:
+         parts = parseMessage(pattern)
+         if parts is not None: pattern = "%s:%s" %(parts[FIRST], parts[LAST])
+      dropped = cache.invalidate(pattern)
+      session.send(build_TA_Response(0, "CACHE INVALIDATED %d" %dropped))
+   else:
+      session.send(build_TA_Response(290, "CACHE command must be list, invalidate or invalidate=MESSAGE"))
+   return SESSION_CONTINUE
+
+# ---------------------------------------------------------------- spillsOf()
+def spillsOf(captures):
+   """spillsOf(dict captures) Returns the OS_SPILL of a reply for the 
+      captures of a command by stream, empty if nothing was spilled. """
+   found = {}
+   for key, capture in captures.items():
+      if capture.spill is not None: found[key] = capture.spill.describe()
+   return found
+
+# -------------------------------------------------------------- processSub()
+def processSub(session, options, command):
+   """processSub(session, options, command) Processes a SUB directive, the 
+      command is start=DIRECTIVE:COMMAND, stop=ID, stop=all or list. Needs a 
+      framed session, see SUBSCRIPTIONS. """
+   if not session.framed:
+      message = "SUB needs a framed session, send TA:framing=on first"
+      session.send(build_TA_Response(270, message))
+      return SESSION_CONTINUE
+   name, sep, value = command.partition('=')
+   name  = name.strip().lower()
+   value = value.strip()
+   # ------------------------------------------------------------- SUB:START
+   if name == "start":
+      parts = parseMessage(value)
+      try:
+         interval = float(options.get("interval", ""))
+         count    = int(options.get("count", 0))
+         if parts is None or parts[FIRST] not in SUB_DIRECTIVES or \
+            interval < MIN_SUB_INTERVAL or count < 0:
+            raise ValueError("bad option")
+         directive, subOptions, subCommand = parts
+         if directive == "SYS" and sysCommand(subCommand) is None: 
+            raise ValueError("bad SYS command")
+         timeout = getTimeout(subOptions)
+      except ValueError:
+         message = "SUB needs an interval of at least %s seconds, a whole number count " %MIN_SUB_INTERVAL + \
+                   "and start= a SYS or OS directive, like start=SYS:load"
+         session.send(build_TA_Response(270, message))
+         return SESSION_CONTINUE
+      # The reply goes before the first sample 
+      with session.sendLock:
+         subscription = scheduler.add(session, directive, subCommand, interval, count, timeout)
+         if subscription is None:
+            message = "Session already has %d subscriptions" %MAX_SUBSCRIPTIONS
+            session.send(build_TA_Response(272, message))
+         else:
+            if VERBOSE: showMessage("SUB %d started \"%s\"" %(subscription.subId, value))
+            response = build_TA_Response(0, "SUBSCRIBED")
+            response[SUB_ID] = subscription.subId
+            session.send(response)
+      return SESSION_CONTINUE
+   # -------------------------------------------------------------- SUB:LIST
+   if name == "list":
+      response = build_TA_Response(0, "")
+      response[SUB_LIST] = [sub.describe() for sub in scheduler.list(session)]
+      session.send(response)
+      return SESSION_CONTINUE
+   # -------------------------------------------------------------- SUB:STOP
+   if name != "stop":
+      message = "SUB command must be start=, stop= or list"
+      session.send(build_TA_Response(270, message))
+      return SESSION_CONTINUE
+   if value.lower() == "all":
+      subId = None
+   else:
+      try:
+         subId = int(value)
+      except ValueError:
+         session.send(build_TA_Response(270, "SUB:stop needs a subscription ID or all, like stop=3"))
+         return SESSION_CONTINUE
+   # No sample is sent after the reply 
+   with session.sendLock:
+      if scheduler.cancel(session, subId) == 0 and subId is not None:
+         session.send(build_TA_Response(271, "Unknown subscription %d" %subId))
+      else:
+         response = build_TA_Response(0, "UNSUBSCRIBED")
+         if subId is not None: response[SUB_ID] = subId
+         session.send(response)
+   return SESSION_CONTINUE
+
+# ---------------------------------------------------------- readProcLines()
+def readProcLines(name):
+   """readProcLines(str name) Returns the lines of a file under /proc. """
+   with open(os.path.join(PROC, name)) as f:
+      return f.read().splitlines()
+
+# ----------------------------------------------------------------- readCpu()
+def readCpu():
+   """readCpu() Returns the CPU times and counters of SYS:cpu. """
+   ticks = float(os.sysconf("SC_CLK_TCK"))
+   data  = {"PER_CPU" : []}
+   for line in readProcLines("stat"):
+      fields = line.split()
+      if not fields: continue
+      if fields[FIRST].startswith("cpu"):
+         times = dict([(state, round(int(value) / ticks, 2)) 
+                       for state, value in zip(CPU_STATES, fields[1:])])
+         if fields[FIRST] == "cpu": data["TOTAL"] = times
+         else:                      data["PER_CPU"].append(times)
+      elif fields[FIRST] == "ctxt":      data["CONTEXT_SWITCHES"] = int(fields[1])
+      elif fields[FIRST] == "intr":      data["INTERRUPTS"]       = int(fields[1])
+      elif fields[FIRST] == "processes": data["FORKS"]            = int(fields[1])
+   data["CPUS"] = len(data["PER_CPU"])
+   return data
+
+# ---------------------------------------------------------------- readLoad()
+def readLoad():
+   """readLoad() Returns the load averages and uptime of SYS:load. """
+   fields = readProcLines("loadavg")[FIRST].split()
+   running, threads = fields[3].split("/")
+   return {"LOAD_1"  : float(fields[0]),
+           "LOAD_5"  : float(fields[1]),
+           "LOAD_15" : float(fields[2]),
+           "RUNNING" : int(running)    ,
+           "THREADS" : int(threads)    ,
+           "UPTIME"  : float(readProcLines("uptime")[FIRST].split()[FIRST])}
+
+# -------------------------------------------------------------- readMemory()
+def readMemory():
+   """readMemory() Returns the memory in use of SYS:memory, in bytes. """
+   meminfo = {}
+   for line in readProcLines("meminfo"):
+      name, sep, value = line.partition(":")
+      fields = value.split()
+      if not fields: continue
+      meminfo[name] = int(fields[FIRST])
+      if fields[LAST] == "kB": meminfo[name] *= 1024
+   data = {}
+   for key, name in (("TOTAL",      "MemTotal"    ), ("FREE",       "MemFree"  ), 
+                     ("AVAILABLE",  "MemAvailable"), ("BUFFERS",    "Buffers"  ), 
+                     ("SHARED",     "Shmem"       ), ("SWAP_TOTAL", "SwapTotal"), 
+                     ("SWAP_FREE",  "SwapFree"    )):
+      if name in meminfo: data[key] = meminfo[name]
+   # As free works out the cache and the memory used 
+   data["CACHED"] = meminfo.get("Cached", 0) + meminfo.get("SReclaimable", 0)
+   if "AVAILABLE" in data: 
+      data["USED"] = data["TOTAL"] - data["AVAILABLE"]
+   else:
+      data["USED"] = data["TOTAL"] - data["FREE"] - data.get("BUFFERS", 0) - data["CACHED"]
+   return data
+
+# --------------------------------------------------------------- readDisks()
+def readDisks(path = None):
+   """readDisks(str path) Returns the space used on the file system holding 
+      path or, without a path, on every mounted file system with blocks. """
+   mounts, seen = [], set()
+   for line in readProcLines("mounts"):
+      fields = line.split()
+      if len(fields) < 3 or fields[1] in seen: continue
+      seen.add(fields[1])
+      # Spaces and the like are escaped as octal in /proc/mounts
+      mount = re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), fields[1])
+      mounts.append((fields[0], mount, fields[2]))
+   if path is not None: 
+      # The last file system mounted on the device of path is the one seen
+      device  = os.stat(path).st_dev
+      holding = [("", path, "")]
+      for entry in mounts:
+         try:
+            if os.stat(entry[1]).st_dev == device: holding = [entry]
+         except OSError:
+            pass
+      mounts = holding
+   disks = []
+   for device, mount, fsType in mounts:
+      try:
+         vfs = os.statvfs(mount)
+      except OSError:
+         if path is not None: raise
+         continue # Gone, or not ours to look at 
+      if path is None and vfs.f_blocks == 0: continue # /proc, /sys and the like
+      disks.append({"DEVICE"      : device                                       ,
+                    "MOUNT"       : mount                                        ,
+                    "TYPE"        : fsType                                       ,
+                    "SIZE"        : vfs.f_blocks * vfs.f_frsize                  ,
+                    "USED"        : (vfs.f_blocks - vfs.f_bfree) * vfs.f_frsize  ,
+                    "FREE"        : vfs.f_bavail * vfs.f_frsize                  ,
+                    "INODES"      : vfs.f_files                                  ,
+                    "INODES_FREE" : vfs.f_ffree                                  })
+   return disks
+
+# -------------------------------------------------------------- readDiskIO()
+def readDiskIO():
+   """readDiskIO() Returns the I/O counters of each block device, keyed by 
+      device name. """
+   devices = {}
+   for line in readProcLines("diskstats"):
+      fields = line.split()
+      if len(fields) < 14: continue
+      devices[fields[2]] = {"READS"         : int(fields[3])                   ,
+                            "READ_BYTES"    : int(fields[5]) * SECTOR_SIZE     ,
+                            "WRITES"        : int(fields[7])                   ,
+                            "WRITTEN_BYTES" : int(fields[9]) * SECTOR_SIZE     ,
+                            "BUSY_SECONDS"  : int(fields[12]) / 1000.0         }
+   return devices
+
+# ----------------------------------------------------------------- readNet()
+def readNet():
+   """readNet() Returns the traffic counters of each network interface, 
+      keyed by interface name. """
+   interfaces = {}
+   for line in readProcLines("net/dev")[2:]: # Two lines of headings 
+      name, sep, counters = line.partition(":")
+      fields = [int(field) for field in counters.split()]
+      interfaces[name.strip()] = {"RX_BYTES"   : fields[0] , "RX_PACKETS" : fields[1] ,
+                                  "RX_ERRORS"  : fields[2] , "RX_DROPS"   : fields[3] ,
+                                  "TX_BYTES"   : fields[8] , "TX_PACKETS" : fields[9] ,
+                                  "TX_ERRORS"  : fields[10], "TX_DROPS"   : fields[11]}
+   return interfaces
+
+# ----------------------------------------------------------- readProcesses()
+def readProcesses():
+   """readProcesses() Returns the process table of SYS:processes. A 
+      process that ends while the table is read is left out. """
+   ticks    = float(os.sysconf("SC_CLK_TCK"))
+   pageSize = os.sysconf("SC_PAGE_SIZE")
+   bootTime = 0
+   for line in readProcLines("stat"):
+      if line.startswith("btime"): bootTime = int(line.split()[1])
+   users = {} # uid --> user name, looked up once 
+   processes = []
+   for pid in os.listdir(PROC):
+      if not pid.isdigit(): continue
+      try:
+         uid = os.stat(os.path.join(PROC, pid)).st_uid
+         stat = readProcLines(os.path.join(pid, "stat"))[FIRST]
+         with open(os.path.join(PROC, pid, "cmdline")) as f: 
+            commandLine = f.read()
+      except (IOError, OSError, IndexError):
+         continue # The process has ended 
+      # The name may hold spaces and brackets, the fields follow the last ")"
+      name   = stat[stat.find("(") + 1 : stat.rfind(")")]
+      fields = stat[stat.rfind(")") + 2:].split()
+      if uid not in users:
+         users[uid] = str(uid)
+         if pwd is not None:
+            try:    users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError: pass
+      processes.append({"PID"         : int(pid)                                       ,
+                        "PPID"        : int(fields[1])                                 ,
+                        "USER"        : users[uid]                                     ,
+                        "STATE"       : fields[0]                                      ,
+                        "NAME"        : name                                           ,
+                        "THREADS"     : int(fields[17])                                ,
+                        "RSS"         : int(fields[21]) * pageSize                     ,
+                        "VSIZE"       : int(fields[20])                                ,
+                        "CPU_SECONDS" : round((int(fields[11]) + int(fields[12])) / ticks, 2),
+                        "STARTED"     : round(bootTime + int(fields[19]) / ticks, 2)   ,
+                        "COMMAND"     : commandLine.replace("\0", " ").strip() or "[%s]" %name})
+   processes.sort(key = lambda process: process["PID"])
+   return processes
+
+# --------------------------------------------------------- dispatchMessage()
+def dispatchMessage(session, data):
+   """dispatchMessage(session, data) Acts on one message from the client and 
+      returns the session action (SESSION_CONTINUE, SESSION_CLOSE or 
+      AGENT_SHUTDOWN). """
+   logReceived(session, data)
+   # --- Check message from client and see if it is in form:
+   #     DIRECTIVE:COMMAND
+   start = time.time()
+   parts = parseMessage(data)
+   stats.request(parts, time.time() - start)
+   return dispatchRequest(session, parts)
+
+# --------------------------------------------------------- dispatchRequest()
+def dispatchRequest(session, parts):
+   """dispatchRequest(session, parts) Acts on a message from the client as 
+      parsed by parseMessage() and returns the session action. """
+   if parts is None:
+      session.send(build_TA_Response(98, "Invalid message"))
+      return SESSION_CONTINUE
+   cached = cache.get(session, parts)
+   if cached is not None:
+      session.send(cached)
+      return SESSION_CONTINUE
+   directive, options, command = parts
+   if directive == "TA":
+      return processTA(session, command)
+   elif directive == "OS":
+      return processOS(session, options, command)
+   elif directive == "OS-STREAM":
+      return processOSStream(session, options, command)
+   elif directive == "BATCH":
+      return processBatch(session, options, command)
+   elif directive == "JOB":
+      return processJob(session, options, command)
+   elif directive == "FILE":
+      return processFile(session, options, command)
+   elif directive == "SYS":
+      return processSys(session, command)
+   elif directive == "SUB":
+      return processSub(session, options, command)
+   elif directive == "SPILL":
+      return processSpill(session, options, command)
+   elif directive == "CACHE":
+      return processCache(session, command)
+   elif directive == "PING":
+      session.send(build_PING_Response(command))
+      return SESSION_CONTINUE
+   elif directive == "HELP":
+      session.send(build_TA_Response(0, helpMessage), "[0, \"%s\"]" %helpMessage)
+      return SESSION_CONTINUE
+   else:
+      if VERBOSE: showMessage("Sending Unknown Directive")
+      message = "UNKNOWN DIRECTIVE: %s" %directive
+      session.send(build_TA_Response(200, message), "[200, \"%s\"]" %message)
+      return SESSION_CONTINUE
+
+# ------------------------------------------------------------ serveSession()
+def serveSession(connection, remoteAddr):
+   """serveSession(connection, remoteAddr) Serves one client until the 
+      session ends and returns the action that ended it. """
+   message = "Connection from: %s" %str(remoteAddr)
+   if VERBOSE: showMessage(message)
+   if LOGGING: log.logit(message)                        
+   session = Session(connection, remoteAddr)
+   action  = SESSION_CONTINUE
+   linger  = True  # False once the client has gone 
+   try:
+      while action == SESSION_CONTINUE:
+         data = session.recvMessage()
+         if data is None:
+            message = "Connection closed by %s" %str(remoteAddr)
+            if VERBOSE: showMessage(message)
+            if LOGGING: log.logit(message)
+            linger = False
+            break
+         action = dispatchMessage(session, data)
+   except SessionExpired as e:
+      reapSession(session, str(e))
+   except (socket.error, FramingError) as e:
+      message = "Session with %s failed - %s" %(str(remoteAddr), str(e))
+      showWarning(message)
+      if LOGGING: log.logit(message, WARN)
+      linger = False
+   session.close(linger)
+   return action
+
+# ------------------------------------------------------------- serveSerial()
+def serveSerial(tcpSocket):
+   """serveSerial(tcpSocket) Serves one client session at a time until an 
+      agent shutdown is requested. """
+   while RUNNING:
+      message = "Waiting for a connection ..."
+      if VERBOSE: showMessage(message)
+      if LOGGING: log.logit(message)                        
+      try:
+         connection, remoteAddr = tcpSocket.accept()
+      except socket.error as e:
+         if e[FIRST] == errno.EINTR: continue # A signal, see runWorker()
+         raise
+      if serveSession(connection, remoteAddr) == AGENT_SHUTDOWN: stopAgent()
+
+# ----------------------------------------------------------- sessionWorker()
+def sessionWorker(connections):
+   """sessionWorker(Queue connections) Worker thread body, serves the 
+      sessions handed to it by the listener until given None. """
+   while True:
+      item = connections.get()
+      if item is None: return
+      connection, remoteAddr = item
+      if serveSession(connection, remoteAddr) == AGENT_SHUTDOWN: stopAgent()
+
+# ----------------------------------------------------------- serveThreaded()
+def serveThreaded(tcpSocket, workers):
+   """serveThreaded(tcpSocket, int workers) Accepts connections and hands them
+      to a pool of worker threads so that up to "workers" sessions are served
+      in parallel. Returns once an agent shutdown is requested. """
+   connections = Queue.Queue()
+   for i in range(workers):
+      start_new_thread(sessionWorker, (connections,))
+   message = "Started %d session workers" %workers
+   if VERBOSE: showMessage(message)
+   if LOGGING: log.logit(message)
+   # The listener polls so that a shutdown from any worker is noticed 
+   tcpSocket.settimeout(ACCEPT_POLL)
+   while RUNNING:
+      try:
+         connection, remoteAddr = tcpSocket.accept()
+      except socket.timeout:
+         continue
+      except socket.error as e:
+         if e[FIRST] == errno.EINTR: continue # A signal, see runWorker()
+         raise
+      connection.settimeout(None)
+      connections.put((connection, remoteAddr))
+   for i in range(workers): connections.put(None)
+
+# ---------------------------------------------------------- serveEventLoop()
+def serveEventLoop(tcpSocket):
+   """serveEventLoop(tcpSocket) Serves every session from a single thread with
+      an EventLoop until an agent shutdown is requested. """
+   # Each idle session holds a file descriptor, allow as many as we may 
+   if resource is not None:
+      try:
+         soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+         if soft < hard: resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+      except Exception as e:
+         showWarning("Unable to raise the open file limit - %s" %str(e))
+   message = "Serving sessions from an event loop"
+   if VERBOSE: showMessage(message)
+   if LOGGING: log.logit(message)
+   EventLoop(tcpSocket).run()
+
+# ------------------------------------------------------------ openListener()
+def openListener(reusePort = False):
+   """openListener(bool reusePort) Returns a listening socket bound to 
+      HOST:PORT, raises socket.error when it cannot bind. With reusePort 
+      other listeners may bind the same port, see serveProcesses(). """
+   tcpSocket  = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
+   # Sessions closed by the Agent leave their port in TIME_WAIT for a 
+   # while, do not let that stop a restarted Agent from binding 
+   tcpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+   if reusePort: tcpSocket.setsockopt(socket.SOL_SOCKET, REUSE_PORT, 1)
+   closeOnExec(tcpSocket.fileno())
+   try:
+      tcpSocket.bind((HOST, PORT))
+      tcpSocket.listen(LISTEN_BACKLOG)
+   except socket.error:
+      tcpSocket.close()
+      raise
+   return tcpSocket
+
+# ----------------------------------------------------------- serveListener()
+def serveListener(tcpSocket):
+   """serveListener(tcpSocket) Serves sessions on the listener until an 
+      agent shutdown is requested. The event loop serves every session from 
+      one thread, with more than one worker the sessions are served in 
+      parallel by a pool of threads, otherwise one at a time. """
+   if EVENT_LOOP:    serveEventLoop(tcpSocket)
+   elif WORKERS > 1: serveThreaded(tcpSocket, WORKERS)
+   else:             serveSerial(tcpSocket)
+
+# --------------------------------------------------------------- runWorker()
+def runWorker(number, holder, logPipe):
+   """runWorker(int number, holder, int logPipe) Body of worker process 
+      number, runs in the child after the fork. Serves sessions on a 
+      listener of its own until an agent shutdown is requested, by 
+      TA:shutdown or by SIGTERM from the supervisor. Returns the exit code 
+      for the worker. """
+   holder.close()
+   if probe is not None: probe.close() # The supervisor answers the probes 
+   log.forkChild(logPipe)
+   # <Control>-<C> reaches the whole group, the supervisor stops the workers
+   signal.signal(signal.SIGINT, signal.SIG_IGN)
+   signal.signal(signal.SIGTERM, lambda signum, frame: stopAgent())
+   tcpSocket = openListener(reusePort = True)
+   message = "Worker %d (pid %d) listening on %s:%d" %(number, os.getpid(), HOST, PORT)
+   if VERBOSE: showMessage(message)
+   if LOGGING: log.logit(message)
+   serveListener(tcpSocket)
+   tcpSocket.close()
+   jobs.stop()               # Jobs still running are killed 
+   closer.wait(CLOSE_LINGER) # Let the last sessions close cleanly
+   message = "Worker %d (pid %d) stopped" %(number, os.getpid())
+   if VERBOSE: showMessage(message)
+   if LOGGING: log.logit(message)
+   log.close()
+   return EXIT_SUCCESS
+
+# ------------------------------------------------------------- startWorker()
+def startWorker(number, holder):
+   """startWorker(int number, holder) Forks worker process number, returns 
+      its pid and the read end of the pipe its log entries come through, 
+      None when not logging. The worker never returns from here. """
+   readEnd = writeEnd = None
+   if LOGGING: readEnd, writeEnd = os.pipe()
+   pid = os.fork()
+   if pid == 0:
+      exitCode = 1
+      try:
+         if readEnd is not None: os.close(readEnd)
+         exitCode = runWorker(number, holder, writeEnd)
+      except BaseException as e:
+         showError("Worker %d (pid %d) failed - %s" %(number, os.getpid(), str(e)))
+      finally:
+         os._exit(exitCode) # Never run the supervisor's code in the worker
+   if writeEnd is not None: 
+      os.close(writeEnd)
+      closeOnExec(readEnd)
+   return pid, readEnd
+
+# ---------------------------------------------------------- serveProcesses()
+def serveProcesses(holder, processes):
+   """serveProcesses(holder, int processes) Supervisor of the worker 
+      processes, see SERVING MODES. Starts the workers and, until an agent 
+      shutdown is requested, writes their log entries and restarts any 
+      worker that dies. A worker that exits with EXIT_SUCCESS was stopped by 
+      TA:shutdown, the other workers are then stopped too. The holder is a 
+      socket bound to the port, but not listening, that keeps the port for 
+      the group while workers are restarted. """
+   workers  = {} # pid --> (worker number, start time)
+   pipes    = {} # log pipe --> start of an entry not yet complete 
+   restarts = [] # (restart time, worker number) of workers that died 
+   poller   = select.poll()
+   # - - - - - - - - - - - - - - - - - - - - - - - -
+   def start(number):
+      pid, pipe = startWorker(number, holder)
+      workers[pid] = (number, time.time())
+      if pipe is not None:
+         pipes[pipe] = ""
+         poller.register(pipe, select.POLLIN)
+   # - - - - - - - - - - - - - - - - - - - - - - - -
+   def readPipes(timeout):
+      try:
+         events = poller.poll(timeout * 1000)
+      except select.error as e:
+         if e[FIRST] == errno.EINTR: return # A signal, see below
+         raise
+      for pipe, mask in events:
+         data = os.read(pipe, PIPE_CHUNK)
+         if data:
+            text = pipes[pipe] + data
+            end = text.rfind("\n") + 1 # Only whole entries go in the log
+            if end: log.logEntries(text[:end])
+            pipes[pipe] = text[end:]
+         else: # The worker has gone 
+            poller.unregister(pipe)
+            os.close(pipe)
+            del pipes[pipe]
+   # - - - - - - - - - - - - - - - - - - - - - - - -
+   def reapWorkers():
+      ended = []
+      while workers:
+         try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+         except OSError as e:
+            if e.errno == errno.EINTR: continue
+            break
+         if pid == 0: break
+         if pid not in workers: continue
+         number, started = workers.pop(pid)
+         ended.append((pid, number, started, status))
+      return ended
+   # - - - - - - - - - - - - - - - - - - - - - - - -
+   signal.signal(signal.SIGTERM, lambda signum, frame: stopAgent())
+   message = "Starting %d worker processes" %processes
+   if VERBOSE: showMessage(message)
+   if LOGGING: log.logit(message)
+   try:
+      for number in range(1, processes + 1): start(number)
+      while RUNNING:
+         readPipes(WORKER_POLL)
+         for pid, number, started, status in reapWorkers():
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == EXIT_SUCCESS:
+               message = "Worker %d (pid %d) was shut down, stopping all workers" %(number, pid)
+               if VERBOSE: showMessage(message)
+               if LOGGING: log.logit(message)
+               stopAgent()
+               continue
+            if os.WIFSIGNALED(status): how = "was killed by signal %d" %os.WTERMSIG(status)
+            else:                      how = "exited with code %d" %os.WEXITSTATUS(status)
+            message = "Worker %d (pid %d) %s, restarting it" %(number, pid, how)
+            showWarning(message)
+            if LOGGING: log.logit(message, WARN)
+            # A worker that dies straight away would otherwise be restarted in a tight loop
+            delay = 0
+            if time.time() - started < WORKER_RESTART_DELAY: delay = WORKER_RESTART_DELAY
+            restarts.append((time.time() + delay, number))
+         for restart in sorted(restarts):
+            if not RUNNING or restart[FIRST] > time.time(): break
+            restarts.remove(restart)
+            start(restart[LAST])
+   finally:
+      # Stop the workers, any still running after WORKER_STOP_TIMEOUT are killed 
+      for pid in workers: 
+         try:    os.kill(pid, signal.SIGTERM)
+         except OSError: pass
+      deadline = time.time() + WORKER_STOP_TIMEOUT
+      while workers and time.time() < deadline:
+         readPipes(min(EXIT_POLL, max(deadline - time.time(), 0)))
+         reapWorkers()
+      for pid in workers:
+         showWarning("Worker %d (pid %d) did not stop, killing it" %(workers[pid][FIRST], pid))
+         try:    os.kill(pid, signal.SIGKILL)
+         except OSError: pass
+      while workers and reapWorkers(): pass
+      while pipes: readPipes(0) # Whatever the workers wrote last
+
+# ------------------------------------------------------------- reapSession()
+def reapSession(session, reason):
+   """reapSession(session, str reason) Reports a session that is being closed 
+      for reaching a session limit, see SESSION LIMITS. """
+   message = "Reaped session with %s - %s" %(str(session.remoteAddr), reason)
+   showWarning(message)
+   if LOGGING: log.logit(message, WARN)
+   stats.sessionReaped()
+
+# --------------------------------------------------------- closeConnection()
+def closeConnection(connection):
+   """closeConnection(connection) Closes a client connection gracefully. Our 
+      end is shut down so the client sees the end of the session as soon as 
+      it has read the last reply, then anything the client still sends is 
+      read and thrown away until it closes its end, or for at most 
+      CLOSE_LINGER seconds, before the socket is closed. Closing without 
+      the wait could reset the connection and lose the last reply. """
+   try:
+      connection.shutdown(socket.SHUT_WR)
+      deadline = time.time() + CLOSE_LINGER
+      while True:
+         remaining = deadline - time.time()
+         if remaining <= 0: break
+         connection.settimeout(remaining)
+         if not connection.recv(BUF_SIZE): break
+   except socket.error:
+      pass # Timed out or the client has gone, either way we are done 
+   connection.close()
+
+# ------------------------------------------------------------- closeOnExec()
+def closeOnExec(fd):
+   """closeOnExec(int fd) Keeps a file descriptor of the Agent out of the OS 
+      commands it runs. Otherwise a command, or anything left running by a 
+      command that was killed, holds on to the listener or a client socket 
+      after the Agent has closed it. """
+   if fcntl is None: return
+   flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+   fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+# --------------------------------------------------------------- keepAlive()
+def keepAlive(connection):
+   """keepAlive(connection) Turns on TCP keepalive for a client connection, 
+      so that a client whose system has died is noticed by the Agent instead 
+      of holding the session for ever. The probe timings are set where the 
+      system allows it. """
+   if not KEEPALIVE_IDLE: return
+   try:
+      connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+      for name, value in (("TCP_KEEPIDLE",  KEEPALIVE_IDLE    ), 
+                          ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), 
+                          ("TCP_KEEPCNT",   KEEPALIVE_COUNT   )):
+         option = getattr(socket, name, None)
+         if option is not None: connection.setsockopt(socket.IPPROTO_TCP, option, value)
+   except socket.error as e:
+      showWarning("Unable to turn on keepalive - %s" %str(e))
+
+# --------------------------------------------------------------- stopAgent()
+def stopAgent():
+   """stopAgent() Flags the listener loop to stop accepting connections. """
+   global RUNNING
+   RUNNING = False
    
 
+closer = Closer()     # Closes the connections of ended sessions (see Session.close())
+jobs   = JobManager() # Runs the jobs of the JOB directive 
+scheduler = Scheduler()  # Takes the samples of the SUB directive 
+spills = SpillManager()  # Output of commands too large to keep in memory 
+cache = ResultCache()    # Replies kept to answer repeats, see RESULT CACHE 
+monotonic = monotonicClock() # Seconds from a clock the system time does not move 
+probe  = None         # Answers the health probes, see HEALTH PROBE 
+stats  = Stats()      # Counters reported by TA:stats 
+
 # ==============================================================================
 # MAIN
 if __name__  ==  "__main__":
@@ -505,14 +4918,30 @@ if __name__  ==  "__main__":
    # --- Process command line arguments ----------------------------------------
    try: 
       arguments = getopt.getopt(sys.argv[1:]  , 
-                                "hvdp:a:lb:"  , 
+                                "hvdp:a:lb:w:em:z:sj:q:t:c:i:r:k:n:x:g:u:", 
                                 ['help'    ,
                                  'verbose' , 
                                  'debug'   , 
                                  'port='   , 
                                  'address=', 
                                  'logging' , 
-                                 'buffer=' ]  )   
+                                 'buffer=' , 
+                                 'workers=', 
+                                 'eventloop', 
+                                 'max-parallel=',
+                                 'log-size=',
+                                 'shell'   ,
+                                 'jobs='   ,
+                                 'job-queue=',
+                                 'timeout=',
+                                 'compress-threshold=',
+                                 'idle-timeout=',
+                                 'max-session=',
+                                 'keepalive=',
+                                 'processes=',
+                                 'capture-limit=',
+                                 'cache='  ,
+                                 'udp-port='] )   
    except:
       showError("Bad command line argument(s)")
       usage()
@@ -530,6 +4959,10 @@ if __name__  ==  "__main__":
    for arg in arguments[0]:
       if arg[0]== "-l" or arg[0] == "--logging":
          LOGGING = True         
+   # --- Check for a shell option
+   for arg in arguments[0]:
+      if arg[0]== "-s" or arg[0] == "--shell":
+         PERSISTENT_SHELL = True         
          
    # --- Check for a debug option
    for arg in arguments[0]:
@@ -582,9 +5015,259 @@ if __name__  ==  "__main__":
             showError(message)
             usage()
             sys.exit(6)  
+   # --- Check for a "--workers" or "-w" option 
+   for arg in arguments[0]:
+      if arg[0]== "-w" or arg[0]== "--workers":
+         try:
+            tryWorkers = int(arg[1])                 
+         except:
+            message = "Invalid workers specified \"%s\", workers must be an integer." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(7)        
+         if tryWorkers > 0:
+            WORKERS = tryWorkers
+         else:
+            message = "Invalid number of workers specified \"%s\", workers must be at least 1." %tryWorkers
+            showError(message)
+            usage()
+            sys.exit(7)  
+   # --- Check for an "--eventloop" or "-e" option 
+   for arg in arguments[0]:
+      if arg[0]== "-e" or arg[0]== "--eventloop":
+         if not hasattr(select, "poll"):
+            showError("The event loop needs poll(), which this system does not have.")
+            usage()
+            sys.exit(8)
+         EVENT_LOOP = True
+
+   # --- Check for a "--max-parallel" or "-m" option 
+   for arg in arguments[0]:
+      if arg[0]== "-m" or arg[0]== "--max-parallel":
+         try:
+            tryParallel = int(arg[1])                 
+         except:
+            message = "Invalid max parallel specified \"%s\", it must be an integer." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(9)        
+         if tryParallel > 0:
+            MAX_PARALLEL = tryParallel
+         else:
+            message = "Invalid max parallel specified \"%s\", it must be at least 1." %tryParallel
+            showError(message)
+            usage()
+            sys.exit(9)  
+
+   # --- Check for a "--log-size" or "-z" option 
+   for arg in arguments[0]:
+      if arg[0]== "-z" or arg[0]== "--log-size":
+         try:
+            tryLogSize = int(arg[1])                 
+         except:
+            message = "Invalid log size specified \"%s\", it must be an integer." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(10)        
+         if tryLogSize >= 0:
+            LOG_MAX_BYTES = tryLogSize * 1048576
+         else:
+            message = "Invalid log size specified \"%s\", it must be at least 0." %tryLogSize
+            showError(message)
+            usage()
+            sys.exit(10)  
+
+   # --- Check for a "--jobs" or "-j" option 
+   for arg in arguments[0]:
+      if arg[0]== "-j" or arg[0]== "--jobs":
+         try:
+            tryJobs = int(arg[1])                 
+         except:
+            message = "Invalid jobs specified \"%s\", it must be an integer." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(11)        
+         if tryJobs > 0:
+            JOB_WORKERS = tryJobs
+         else:
+            message = "Invalid jobs specified \"%s\", it must be at least 1." %tryJobs
+            showError(message)
+            usage()
+            sys.exit(11)  
+
+   # --- Check for a "--job-queue" or "-q" option 
+   for arg in arguments[0]:
+      if arg[0]== "-q" or arg[0]== "--job-queue":
+         if arg[1].strip().lower() in JOB_QUEUES:
+            JOB_QUEUE = arg[1].strip().lower()
+         else:
+            message = "Invalid job queue specified \"%s\", it must be fifo or priority." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(12)  
+
+   # --- Check for a "--timeout" or "-t" option 
+   for arg in arguments[0]:
+      if arg[0]== "-t" or arg[0]== "--timeout":
+         try:
+            tryTimeout = float(arg[1])                 
+         except:
+            message = "Invalid timeout specified \"%s\", it must be a number." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(13)        
+         if tryTimeout >= 0:
+            OS_TIMEOUT = tryTimeout
+         else:
+            message = "Invalid timeout specified \"%s\", it must be at least 0." %tryTimeout
+            showError(message)
+            usage()
+            sys.exit(13)  
+
+   # --- Check for a "--compress-threshold" or "-c" option 
+   for arg in arguments[0]:
+      if arg[0]== "-c" or arg[0]== "--compress-threshold":
+         try:
+            tryThreshold = int(arg[1])                 
+         except:
+            message = "Invalid compress threshold specified \"%s\", it must be an integer." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(14)        
+         if tryThreshold >= 0:
+            COMPRESS_THRESHOLD = tryThreshold
+         else:
+            message = "Invalid compress threshold specified \"%s\", it must be at least 0." %tryThreshold
+            showError(message)
+            usage()
+            sys.exit(14)  
+
+   # --- Check for an "--idle-timeout" or "-i" option 
+   for arg in arguments[0]:
+      if arg[0]== "-i" or arg[0]== "--idle-timeout":
+         try:
+            tryIdle = float(arg[1])                 
+         except:
+            message = "Invalid idle timeout specified \"%s\", it must be a number." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(15)        
+         if tryIdle >= 0:
+            IDLE_TIMEOUT = tryIdle
+         else:
+            message = "Invalid idle timeout specified \"%s\", it must be at least 0." %tryIdle
+            showError(message)
+            usage()
+            sys.exit(15)  
+
+   # --- Check for a "--max-session" or "-r" option 
+   for arg in arguments[0]:
+      if arg[0]== "-r" or arg[0]== "--max-session":
+         try:
+            tryLifetime = float(arg[1])                 
+         except:
+            message = "Invalid max session specified \"%s\", it must be a number." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(16)        
+         if tryLifetime >= 0:
+            SESSION_LIFETIME = tryLifetime
+         else:
+            message = "Invalid max session specified \"%s\", it must be at least 0." %tryLifetime
+            showError(message)
+            usage()
+            sys.exit(16)  
+
+   # --- Check for a "--keepalive" or "-k" option 
+   for arg in arguments[0]:
+      if arg[0]== "-k" or arg[0]== "--keepalive":
+         try:
+            tryKeepalive = int(arg[1])                 
+         except:
+            message = "Invalid keepalive specified \"%s\", it must be an integer." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(17)        
+         if tryKeepalive >= 0:
+            KEEPALIVE_IDLE = tryKeepalive
+         else:
+            message = "Invalid keepalive specified \"%s\", it must be at least 0." %tryKeepalive
+            showError(message)
+            usage()
+            sys.exit(17)  
+
+   # --- Check for a "--processes" or "-n" option 
+   for arg in arguments[0]:
+      if arg[0]== "-n" or arg[0]== "--processes":
+         try:
+            tryProcesses = int(arg[1])                 
+         except:
+            message = "Invalid processes specified \"%s\", it must be an integer." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(18)        
+         if tryProcesses < 1:
+            message = "Invalid processes specified \"%s\", it must be at least 1." %tryProcesses
+            showError(message)
+            usage()
+            sys.exit(18)  
+         if tryProcesses > 1 and (not hasattr(os, "fork") or REUSE_PORT is None):
+            showError("Worker processes need fork() and SO_REUSEPORT, which this system does not have.")
+            usage()
+            sys.exit(18)
+         PROCESSES = tryProcesses
+
+   # --- Check for a "--capture-limit" or "-x" option 
+   for arg in arguments[0]:
+      if arg[0]== "-x" or arg[0]== "--capture-limit":
+         try:
+            tryCapture = int(arg[1])                 
+         except:
+            message = "Invalid capture limit specified \"%s\", it must be an integer." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(19)        
+         if tryCapture >= 0:
+            CAPTURE_LIMIT = tryCapture
+         else:
+            message = "Invalid capture limit specified \"%s\", it must be at least 0." %tryCapture
+            showError(message)
+            usage()
+            sys.exit(19)  
+
+   # --- Check for a "--cache" or "-g" option 
+   for arg in arguments[0]:
+      if arg[0]== "-g" or arg[0]== "--cache":
+         try:
+            cache.load(arg[1])
+         except IOError as e:
+            showError("Unable to read the cache file \"%s\" - %s" %(arg[1], e.strerror))
+            sys.exit(20)        
+         except ValueError as e:
+            showError("Bad cache file, %s" %str(e))
+            sys.exit(20)        
+         CACHE_FILE = arg[1]
+
+   # --- Check for a "--udp-port" or "-u" option 
+   for arg in arguments[0]:
+      if arg[0]== "-u" or arg[0]== "--udp-port":
+         try:
+            tryUdpPort = int(arg[1])                 
+         except:
+            message = "Invalid UDP port specified \"%s\", it must be an integer." %arg[1]
+            showError(message)
+            usage()
+            sys.exit(21)        
+         if tryUdpPort == 0 or (tryUdpPort < 65535 and tryUdpPort > 1024):
+            UDP_PORT = tryUdpPort
+         else:
+            message = "Invalid UDP port specified \"%s\", it must be 0 or between 1025 and 65534." %tryUdpPort
+            showError(message)
+            usage()
+            sys.exit(21)  
 
    # --- Initialize the Log file 
-   log = Logger(LOG_FILE)   
+   log = Logger(LOG_FILE, LOG_MAX_BYTES)   
    # --- Display operating parameters         
    if DEBUG:
       print "--------------- PARAMETERS ---------------"
@@ -596,6 +5279,22 @@ if __name__  ==  "__main__":
       print "Program configured for port      %s" %PORT
       print "Program logging                  %s" %LOGGING
       print "Program Buffer                   %s" %BUF_SIZE
+      print "Program session workers          %s" %WORKERS
+      print "Program event loop               %s" %EVENT_LOOP
+      print "Program max parallel commands    %s" %MAX_PARALLEL
+      print "Program log file size (bytes)    %s" %LOG_MAX_BYTES
+      print "Program session shells           %s" %PERSISTENT_SHELL
+      print "Program OS command timeout       %s" %OS_TIMEOUT
+      print "Program job workers              %s" %JOB_WORKERS
+      print "Program job queue                %s" %JOB_QUEUE
+      print "Program compress threshold       %s" %COMPRESS_THRESHOLD
+      print "Program idle timeout             %s" %IDLE_TIMEOUT
+      print "Program max session              %s" %SESSION_LIFETIME
+      print "Program keepalive                %s" %KEEPALIVE_IDLE
+      print "Program worker processes         %s" %PROCESSES
+      print "Program capture limit            %s" %CAPTURE_LIMIT
+      print "Program cache file               %s" %CACHE_FILE
+      print "Program health probe UDP port    %s" %UDP_PORT
       pause()
 
    # --- Program opens ---------------------------------------------------------
@@ -608,180 +5307,49 @@ if __name__  ==  "__main__":
       message = "Starting listener on %s:%d" %(HOST,PORT)
       if VERBOSE: showMessage(message)
       if LOGGING: log.logit(message)
-      listenerSocket = (HOST, PORT)            
-      tcpSocket  = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-   
       try:
-         tcpSocket.bind(listenerSocket)
-         tcpSocket.listen(5)
+         if PROCESSES > 1:
+            # The supervisor only holds the port, a listening socket here 
+            # would be handed connections that no worker accepts 
+            tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
+            tcpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tcpSocket.setsockopt(socket.SOL_SOCKET, REUSE_PORT, 1)
+            closeOnExec(tcpSocket.fileno())
+            tcpSocket.bind((HOST, PORT))
+         else:
+            tcpSocket = openListener()
          if VERBOSE: showMessage("Listener started!")
-      except socketError, e:
+      except socket.error, e:
          message = "Test Agent unable to bind to %s:%s - " %(HOST, str(PORT))
          message += "%s" %str(e[1])
          showError(message)
          if LOGGING:
-            logit(message)         
+            log.logit(message, ERROR)         
          exit(6) # Exit with 6 for "Unable to bind test_agent to host:port"
+      # --- Health probe, answered beside the listener (see HEALTH PROBE) 
+      if UDP_PORT:
+         try:
+            probe = HealthProbe((HOST, UDP_PORT))
+         except socket.error as e:
+            message = "Unable to bind the health probe to %s:%d (UDP) - %s" %(HOST, UDP_PORT, str(e))
+            showError(message)
+            if LOGGING: log.logit(message, ERROR)
+            tcpSocket.close()
+            log.close()
+            exit(22)
+         probe.start()
+         message = "Answering health probes on %s:%d (UDP)" %(HOST, UDP_PORT)
+         if VERBOSE: showMessage(message)
+         if LOGGING: log.logit(message)
 
    
    
       # --------------------------------------------------------- Listener Loop 
-      # Listener loop starts here. 
+      # Listener loop starts here, in this process or in each of the worker 
+      # processes (see serveListener() and serveProcesses()).
       #   
-      listenerRunning = True
-      while listenerRunning:
-         message = "Waiting for a connection ..."
-         if VERBOSE: showMessage(message)
-         if LOGGING: log.logit(message)                        
-         connection, remoteAddr = tcpSocket.accept()
-         message = "Connection from: %s" %str(remoteAddr)
-         if VERBOSE: showMessage(message)
-         if LOGGING: log.logit(message)                        
-         sessionActive = True         
-         while sessionActive:
-            
-            data = connection.recv(BUF_SIZE)
-            data = data.strip()
-            message = "Message from %s: %s" % (str(remoteAddr), data)
-            if VERBOSE: showMessage(message)
-            if LOGGING: log.logit(message)
-               
-            # --- Check message from client and see if it is in form:
-            #     DIRECTIVE:COMMAND
-            messageParts = data.split(':', 1)
-            if len(messageParts) != 2:
-               response = build_TA_Response(98, "Invalid message")
-               if VERBOSE: showMessage("Sending: %s" %str(response))
-               if LOGGING: log.logit("Sending: %s" %str(response))
-               connection.send(str(response))
-            else:
-               # --- Parse out and clean up the directive and command 
-               directive = messageParts[FIRST]
-               directive = directive.strip()
-               directive = directive.upper()
-               command   = messageParts[LAST]
-               command   = command.strip()
-               # --- Process directives and commands
-               
-               
-               if directive == "TA":
-                  #
-                  #    *** **************************** ***
-                  #    *** TA DIRECTIVES PROCESSED HERE ***
-                  #    *** **************************** ***
-                  # 
-                  # ------------------------------------------------- TA:VERSION
-                  if command == "version":
-                     response = build_TA_Response(0, "VERSION %s" %VERSION)
-                     if VERBOSE: showMessage("Sending: %s" %str(response))
-                     if LOGGING: log.logit("Sending: %s" %str(response))
-                     connection.send(str(response))
-                  # ----------------------------------------------------- TA:BYE                      
-                  elif command == "bye" or command == "quit" or command == "exit": 
-                     response = build_TA_Response(0, "CLOSING CONNECTION")
-                     if VERBOSE: showMessage("Sending: %s" %str(response))
-                     if LOGGING: log.logit("Sending: %s" %str(response))
-                     connection.send(str(response))
-                     time.sleep(closeSocketPause)
-                     connection.close()
-                     sessionActive = False # Flag end of session
-                  # ------------------------------------------------ TA:SHUTDOWN   
-                  elif command == "shutdown" or command == "SHUTDOWN": 
-                     response = build_TA_Response(0, "SHUTTING DOWN AGENT")
-                     if VERBOSE: showMessage("Sending: %s" %str(response))
-                     if LOGGING: log.logit("Sending: %s" %str(response))
-                     connection.send(str(response))
-                     time.sleep(closeSocketPause)
-                     connection.close()
-                     sessionActive   = False # Flag end of session
-                     listenerRunning = False # Flag end of listener Loop  
-                  # ------------------------------------------------- TA:GETNAME
-                  elif command == "getname" or command == "GETNAME":
-                     if VERBOSE: showMessage("sending name: %s" %AGENT_NAME)
-                     connection.send("[0, \"%s\"]" %AGENT_NAME)  
-                  elif command.find("setname") > -1:
-                     if command.find('=') > -1:
-                        parts = command.split('=')
-                        if len(parts) != 2:
-                           connection.send("[2, \"Bad TA:setname - must have a name after the \'=\' operator\"]")
-                        else:
-                           agentName = parts[LAST]
-                           agentName = agentName.strip()
-                           AGENT_NAME = agentName
-                           if VERBOSE: showMessage("Agent Name set to \"%s\"" %AGENT_NAME)
-                           connection.send("[0, \"Agent Name set to \'%s\'\"]" %AGENT_NAME)      
-                     else:
-                        connection.send("[1, \"TA:setname requires an assignment using \'=\'\"]")
-                     pass              
-                  # --------------------------------------------- TA:GETUSERNAME 
-                  elif command == "getusername" or command == "GETUSERNAME":
-                     if VERBOSE:
-                        showMessage("Sending \"%s\"" %USER  )
-                     connection.send("[0, \"%s\"]" %USER)   
-                  # ----------------------------------------------- TA:LOCALTIME 
-                  elif command == "localtime" or command == "LOCALTIME":
-                     timestamp = now()
-                     response = build_TA_Response(0, timestamp)
-                     if VERBOSE: showMessage("Sending: %s" %str(response))
-                     if LOGGING: log.logit("Sending: %s" %str(response))
-                     connection.send(str(response))
-                  # ----------------------------------------------- TA:LOCALTIME 
-                  elif command == "help" or command == "HELP":
-                     message = "Valid TA Commands are: version, localtime, bye, shutdown, help"
-                     response = build_TA_Response(0, message)
-                     if VERBOSE: showMessage("Sending: %s" %str(response))
-                     if LOGGING: log.logit("Sending: %s" %str(response))
-                     connection.send(str(response))
-                  # --------------------------------------------- TA:BAD COMMAND
-                  else:
-                     message = "Unknown TA Command \"%s\"" %command
-                     response = build_TA_Response(97, message)
-                     if VERBOSE: showMessage("Sending: %s" %str(response))
-                     if LOGGING: log.logit("Sending: %s" %str(response))
-                     connection.send(str(response))
-                                                   
-               elif directive =="OS":
-                  #
-                  #    *** **************************** ***
-                  #    *** OS DIRECTIVES PROCESSED HERE ***
-                  #    *** **************************** ***
-                  # 
-                  # ------------------------------------------------- OS:COMMAND
-                  if VERBOSE: showMessage("OS Command \"%s\"" % command)
-                  c = Command(command)
-                  c.run()
-                  results = c.returnResults()
-                  response = build_OS_Response(0                     , 
-                                               ""                    , 
-                                               results["command"]    , 
-                                               results["output"]     , 
-                                               results["error"]      , 
-                                               results["returnCode"] )
-                  if VERBOSE: showMessage("Sending: %s" %str(response))
-                  if LOGGING: log.logit("Sending: %s" %str(response))
-                  connection.send(str(response))
-                      
-               elif directive == "HELP" or directive == "help":
-                  #
-                  #    *** ****************************** ***
-                  #    *** HELP DIRECTIVES PROCESSED HERE ***
-                  #    *** ****************************** ***
-                  # 
-                  message = "[0, \"%s\"]" %helpMessage       
-                  response = build_TA_Response(0, helpMessage)
-                  if VERBOSE: showMessage("Sending: %s" %str(response))
-                  if LOGGING: log.logit("Sending: %s" %str(response))
-                  connection.send(message)       
-               
-               
-               else:
-                  #
-                  #    *** ********************************* ***
-                  #    *** UNKNOWN DIRECTIVES PROCESSED HERE ***
-                  #    *** ********************************* ***
-                  # 
-                  if VERBOSE: showMessage("Sending Unknown Directive")
-                  connection.send("[200, \"UNKNOWN DIRECTIVE: %s\"]" %directive)
+      if PROCESSES > 1: serveProcesses(tcpSocket, PROCESSES)
+      else:             serveListener(tcpSocket)
       
       # --------------------------------------------------- End of Listener Loop 
       #
@@ -806,8 +5374,10 @@ if __name__  ==  "__main__":
    message = "Closing the listener socket..."
    if VERBOSE: showMessage(message)
    if LOGGING: log.logit(message)      
-   time.sleep(closeSocketPause)
    tcpSocket.close()
+   if probe is not None: probe.close()
+   jobs.stop()               # Jobs still running are killed 
+   closer.wait(CLOSE_LINGER) # Let the last sessions close cleanly
    message = "Closed listener socket"
    if VERBOSE: showMessage(message)
    if LOGGING: log.logit(message)
@@ -817,6 +5387,7 @@ if __name__  ==  "__main__":
    message = "%s terminated with exit code %d" %(ME, EXIT_SUCCESS)
    if LOGGING: log.logit(message)
    if VERBOSE: showMessage(message)
+   log.close() # Write out the log entries still queued
    exit(EXIT_SUCCESS)
 
 else:
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+# Agent Bench - Measures an Agent (see agent.py) under load from many clients
+
+"""
+Starts agent.py on the loopback address and drives it with a number of
+client threads for a set time (see the usage function). Each client works
+through the chosen mix of requests in turn:
+
+   version  - TA:version on the session of the client
+   small    - OS command with a few bytes of output
+   large    - OS command with --large bytes of output
+   churn    - A new connection for one TA:version and TA:bye
+
+The clients use framed sessions (TA:framing=on) in the --encoding chosen,
+except churn which talks to the Agent the way client.py does. Latencies are
+from sending a request to having read the whole reply.
+
+The report gives, for each request type and for all of them, the requests
+made, the failures, requests per second and the 50th, 95th and 99th
+percentile and longest latency, then the CPU seconds used by the Agent and
+by the OS commands it ran and the resident memory of the Agent, from /proc.
+Everything, along with the TA:stats reply of the Agent at the end of the
+run, is also written to the --output file as JSON, so runs can be compared
+as the Agent changes:
+
+   agent_bench.py -c 16 -d 30 -o before.json
+   agent_bench.py -c 16 -d 30 -o after.json -A "-e"
+"""
+
+# ==============================================================================
+# STANDARD LIBRARY IMPORTS
+import sys
+import os
+import time
+import getopt
+import json
+import socket
+import subprocess
+import threading
+
+# ==============================================================================
+# DICTIONARY
+VERSION       = "1.0.0"                    # Version of the bench
+FIRST         = 0                          # first element in a list
+LAST          = -1                         # last element in a list
+ME            = os.path.split(sys.argv[FIRST])[LAST]        # Name of this file
+MY_PATH       = os.path.dirname(os.path.realpath(__file__)) # Path for this file
+AGENT         = os.path.join(MY_PATH, "agent.py")           # The Agent to measure
+EXIT_SUCCESS  = 0                          # Exit code
+ADDRESS       = "127.0.0.1"                # The Agent is run on loopback
+PORT          = 1101                       # Port for the Agent
+CLIENTS       = 8                          # Client threads
+DURATION      = 10.0                       # Seconds the clients run for
+MIXES         = ("version", "small", "large", "churn")  # Request types
+ENCODINGS     = ("repr", "json", "binary") # Reply encodings (TA:encoding)
+ENCODING      = "repr"                     # Reply encoding of the clients
+LARGE_BYTES   = 1048576 # 1M               # Output of the large OS command
+SMALL_COMMAND = "echo hello"               # The small OS command
+LARGE_COMMAND = "head -c %d /dev/zero | tr '\\0' x"  # The large OS command
+OUTPUT_FILE   = "agent_bench.json"         # Results file
+BUFFER        = 14336 # 14k                # Receive size for unframed replies
+START_TIMEOUT = 10.0                       # Seconds for the Agent to start listening
+STOP_TIMEOUT  = 10.0                       # Seconds for the Agent to shut down
+REQUEST_TIMEOUT = 10.0                     # Seconds before a request has failed
+SAMPLE_INTERVAL = 0.25                     # Seconds between samples of the Agent
+PERCENTILES   = (50, 95, 99)               # Latency percentiles reported
+CLOCK_TICKS   = os.sysconf("SC_CLK_TCK")   # Units of the CPU times in /proc
+PAGE_SIZE     = os.sysconf("SC_PAGE_SIZE") # Units of the memory sizes in /proc
+
+sys.path.insert(FIRST, MY_PATH)
+from client import sendFramed, recvFramed  # Framing helpers of the client
+
+# ==============================================================================
+# FUNCTIONS
+
+# ---------------------------------------------------------------------- usage()
+def usage():
+   """usage() - Prints the usage message on stdout. """
+   print "\n\n%s, Version %s, Measures an Agent under load.  " %(ME,VERSION)
+   print "\nUSAGE: %s [OPTIONS]                                    " %ME
+   print "                                                         "
+   print "OPTIONS:                                                 "
+   print "   -h --help        Display this message.                "
+   print "   -p --port=       Port for the Agent, default: %d " %PORT
+   print "   -c --clients=    Client threads, default: %d " %CLIENTS
+   print "   -d --duration=   Seconds the clients run for, default: %.0f " %DURATION
+   print "   -m --mix=        Comma separated request types the clients "
+   print "                    take turns at, from: %s " %", ".join(MIXES)
+   print "                    default: all of them                 "
+   print "   -l --large=      Bytes of output of the large OS command, "
+   print "                    default: %d " %LARGE_BYTES
+   print "   -e --encoding=   Reply encoding of the clients: %s, " %", ".join(ENCODINGS)
+   print "                    default: %s " %ENCODING
+   print "   -A --agent-args= More command line options for the Agent, "
+   print "                    for example \"-e\" or \"-w 16\"      "
+   print "   -o --output=     JSON results file, default: %s " %OUTPUT_FILE
+   print "                                                         "
+   print "EXIT CODES:                                              "
+   print "    0 - Successful completion of the program.            "
+   print "    2 - Bad command line arguments.                      "
+   print "    3 - The Agent did not start or could not be reached. "
+   print "    4 - Unable to write the results file.                "
+   print "                                                         "
+
+# ------------------------------------------------------------------ connect()
+def connect(port, encoding):
+   """connect(port, encoding) Returns a framed session with the Agent that
+      gets its replies in the encoding given. """
+   tcpSocket = socket.create_connection((ADDRESS, port), REQUEST_TIMEOUT)
+   tcpSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+   tcpSocket.sendall("TA:framing=on")
+   tcpSocket.recv(BUFFER)
+   sendFramed(tcpSocket, "TA:encoding=%s" %encoding)
+   recvFramed(tcpSocket)
+   return tcpSocket
+
+# -------------------------------------------------------------------- churn()
+def churn(port):
+   """churn(port) Connects, gets the version of the Agent and says bye. """
+   tcpSocket = socket.create_connection((ADDRESS, port), REQUEST_TIMEOUT)
+   try:
+      tcpSocket.sendall("TA:version")
+      if not tcpSocket.recv(BUFFER): raise EOFError("Connection closed by the Agent")
+      tcpSocket.sendall("TA:bye")
+      while tcpSocket.recv(BUFFER): pass  # Until the Agent closes the session
+   finally:
+      tcpSocket.close()
+
+# ------------------------------------------------------------ clientWorker()
+def clientWorker(number, port, mix, encoding, largeBytes, deadline, results):
+   """clientWorker(...) Client thread body, makes requests from the mix,
+      starting at a different place in it for each client, until the
+      deadline. Appends (request type, seconds or None on failure) to
+      results. """
+   requests  = {"version" : "TA:version"                     ,
+                "small"   : "OS:%s" %SMALL_COMMAND           ,
+                "large"   : "OS:%s" %(LARGE_COMMAND %largeBytes)}
+   tcpSocket = None
+   latencies = []
+   turn      = number
+   while time.time() < deadline:
+      kind  = mix[turn % len(mix)]
+      turn += 1
+      start = time.time()
+      try:
+         if kind == "churn":
+            churn(port)
+         else:
+            if tcpSocket is None: tcpSocket = connect(port, encoding)
+            sendFramed(tcpSocket, requests[kind])
+            recvFramed(tcpSocket)
+         latencies.append((kind, time.time() - start))
+      except Exception:
+         latencies.append((kind, None))
+         if tcpSocket is not None: tcpSocket.close()
+         tcpSocket = None
+         time.sleep(0.01)  # Do not spin on an Agent that has gone
+   if tcpSocket is not None:
+      try:
+         sendFramed(tcpSocket, "TA:bye")
+         recvFramed(tcpSocket)
+      except Exception:
+         pass
+      tcpSocket.close()
+   results.extend(latencies)
+
+# -------------------------------------------------------------- readProc()
+def readProc(pid):
+   """readProc(pid) Returns the CPU seconds used by the process, the CPU
+      seconds used by the children it has waited for and its resident
+      memory in kilobytes, or None once the process has gone. """
+   try:
+      with open("/proc/%d/stat" %pid) as stat:
+         fields = stat.read().rsplit(")", 1)[LAST].split()
+      with open("/proc/%d/statm" %pid) as statm:
+         pages = int(statm.read().split()[1])
+   except (IOError, IndexError, ValueError):
+      return None
+   # Fields from the state on, see proc(5): utime is 14, the state 3
+   cpu      = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+   children = (int(fields[13]) + int(fields[14])) / float(CLOCK_TICKS)
+   return cpu, children, pages * PAGE_SIZE / 1024
+
+# -------------------------------------------------------------- percentile()
+def percentile(ordered, percent):
+   """percentile(list ordered, percent) Returns the nearest rank percentile
+      of a sorted list. """
+   if not ordered: return None
+   rank = int(round(percent / 100.0 * len(ordered) + 0.5)) - 1
+   return ordered[max(0, min(rank, len(ordered) - 1))]
+
+# --------------------------------------------------------------- summarize()
+def summarize(latencies, seconds):
+   """summarize(list latencies, seconds) Returns the counts, throughput and
+      latency percentiles in milliseconds of a list of latencies, failures
+      are None. """
+   ordered = sorted([latency for latency in latencies if latency is not None])
+   summary = {"requests"   : len(latencies)                      ,
+              "failures"   : len(latencies) - len(ordered)       ,
+              "throughput" : round(len(ordered) / seconds, 1)    }
+   for percent in PERCENTILES:
+      value = percentile(ordered, percent)
+      if value is not None: value = round(value * 1000, 3)
+      summary["p%d_ms" %percent] = value
+   if ordered: summary["max_ms"] = round(ordered[LAST] * 1000, 3)
+   else:       summary["max_ms"] = None
+   return summary
+
+# -------------------------------------------------------------- startAgent()
+def startAgent(port, agentArgs):
+   """startAgent(port, agentArgs) Starts the Agent and returns its process
+      once it is accepting connections, or None if it did not start. """
+   command = [sys.executable, AGENT, "-a", ADDRESS, "-p", str(port)] + agentArgs
+   devnull = open(os.devnull, "w")
+   agent   = subprocess.Popen(command, stdout = devnull, stderr = devnull)
+   deadline = time.time() + START_TIMEOUT
+   while time.time() < deadline:
+      if agent.poll() is not None: return None
+      try:
+         socket.create_connection((ADDRESS, port), 1).close()
+         return agent
+      except socket.error:
+         time.sleep(0.1)
+   agent.kill()
+   agent.wait()
+   return None
+
+# --------------------------------------------------------------- stopAgent()
+def stopAgent(agent, port):
+   """stopAgent(agent, port) Shuts the Agent down, by force if it has not
+      gone after STOP_TIMEOUT seconds. """
+   try:
+      tcpSocket = socket.create_connection((ADDRESS, port), STOP_TIMEOUT)
+      tcpSocket.sendall("TA:shutdown")
+      tcpSocket.recv(BUFFER)
+      tcpSocket.close()
+   except socket.error:
+      pass
+   deadline = time.time() + STOP_TIMEOUT
+   while agent.poll() is None and time.time() < deadline: time.sleep(0.1)
+   if agent.poll() is None:
+      agent.kill()
+      agent.wait()
+
+# ----------------------------------------------------------- getAgentStats()
+def getAgentStats(port):
+   """getAgentStats(port) Returns the AGENT_STATS of the Agent (TA:stats),
+      None if it does not have them. """
+   try:
+      tcpSocket = connect(port, "json")
+      sendFramed(tcpSocket, "TA:stats")
+      reply = json.loads(recvFramed(tcpSocket))
+      sendFramed(tcpSocket, "TA:bye")
+      recvFramed(tcpSocket)
+      tcpSocket.close()
+      return reply.get("AGENT_STATS")
+   except Exception:
+      return None
+
+# ------------------------------------------------------------------- bench()
+def bench(port, clients, duration, mix, encoding, largeBytes, agentArgs):
+   """bench(...) Runs the Agent under load and returns the results as a
+      dictionary, or None if the Agent did not start. """
+   agent = startAgent(port, agentArgs)
+   if agent is None: return None
+   samples  = []
+   stopping = threading.Event()
+   def sampler():
+      while not stopping.is_set():
+         sample = readProc(agent.pid)
+         if sample is not None: samples.append(sample)
+         stopping.wait(SAMPLE_INTERVAL)
+   monitor = threading.Thread(target = sampler)
+   monitor.daemon = True
+   try:
+      before   = readProc(agent.pid)
+      results  = []
+      threads  = []
+      monitor.start()
+      started  = time.time()
+      deadline = started + duration
+      for number in range(clients):
+         thread = threading.Thread(target = clientWorker,
+                                   args = (number, port, mix, encoding,
+                                           largeBytes, deadline, results))
+         thread.daemon = True
+         thread.start()
+         threads.append(thread)
+      for thread in threads: thread.join()
+      seconds = time.time() - started
+      stopping.set()
+      monitor.join()
+      after      = readProc(agent.pid)
+      agentStats = getAgentStats(port)
+   finally:
+      stopAgent(agent, port)
+   report = {"bench"   : {"version"    : VERSION                      ,
+                          "started"    : time.strftime("%Y-%m-%d %H:%M:%S",
+                                                       time.localtime(started)),
+                          "clients"    : clients                      ,
+                          "duration"   : round(seconds, 3)            ,
+                          "mix"        : list(mix)                    ,
+                          "encoding"   : encoding                     ,
+                          "largeBytes" : largeBytes                   ,
+                          "agentArgs"  : agentArgs                    },
+             "results" : {},
+             "agent"   : {"cpuSeconds"      : None ,
+                          "childCpuSeconds" : None ,
+                          "cpuPercent"      : None ,
+                          "rssPeakKB"       : None ,
+                          "rssEndKB"        : None ,
+                          "stats"           : agentStats}}
+   for kind in mix:
+      report["results"][kind] = summarize([latency for k, latency in results if k == kind], seconds)
+   report["results"]["all"] = summarize([latency for k, latency in results], seconds)
+   if before is not None and after is not None:
+      report["agent"]["cpuSeconds"]      = round(after[FIRST] - before[FIRST], 3)
+      report["agent"]["childCpuSeconds"] = round(after[1] - before[1], 3)
+      report["agent"]["cpuPercent"]      = round((after[FIRST] - before[FIRST]) * 100 / seconds, 1)
+   if samples:
+      report["agent"]["rssPeakKB"] = max([sample[LAST] for sample in samples])
+      report["agent"]["rssEndKB"]  = samples[LAST][LAST]
+   return report
+
+# ------------------------------------------------------------- showReport()
+def showReport(report):
+   """showReport(dict report) Prints the results of a run on stdout. """
+   print "%-8s %9s %9s %10s %9s %9s %9s %9s" %("REQUEST", "COUNT", "FAILED",
+         "PER SEC", "P50 MS", "P95 MS", "P99 MS", "MAX MS")
+   kinds = report["bench"]["mix"] + ["all"]
+   for kind in kinds:
+      summary = report["results"][kind]
+      values  = [summary[name] for name in ("p50_ms", "p95_ms", "p99_ms", "max_ms")]
+      print "%-8s %9d %9d %10.1f %9s %9s %9s %9s" %((kind, summary["requests"],
+            summary["failures"], summary["throughput"]) +
+            tuple([("%.3f" %value if value is not None else "-") for value in values]))
+   agent = report["agent"]
+   print ""
+   print "AGENT CPU: %s s (%s%%), OS COMMANDS CPU: %s s, RSS PEAK: %s KB, RSS END: %s KB" \
+         %(agent["cpuSeconds"], agent["cpuPercent"], agent["childCpuSeconds"],
+           agent["rssPeakKB"], agent["rssEndKB"])
+
+# ----------------------------------------------------------------------- main()
+def main():
+   """main() Runs the bench as directed by the command line. """
+   port       = PORT
+   clients    = CLIENTS
+   duration   = DURATION
+   mix        = list(MIXES)
+   encoding   = ENCODING
+   largeBytes = LARGE_BYTES
+   agentArgs  = []
+   output     = OUTPUT_FILE
+   try:
+      arguments = getopt.getopt(sys.argv[1:], "hp:c:d:m:l:e:A:o:",
+                                ['help', 'port=', 'clients=', 'duration=',
+                                 'mix=', 'large=', 'encoding=', 'agent-args=',
+                                 'output='])
+   except:
+      usage()
+      return 2
+   try:
+      for arg in arguments[FIRST]:
+         if arg[0] == "-h" or arg[0] == "--help":
+            usage()
+            return EXIT_SUCCESS
+         elif arg[0] == "-p" or arg[0] == "--port":       port       = int(arg[1])
+         elif arg[0] == "-c" or arg[0] == "--clients":    clients    = int(arg[1])
+         elif arg[0] == "-d" or arg[0] == "--duration":   duration   = float(arg[1])
+         elif arg[0] == "-l" or arg[0] == "--large":      largeBytes = int(arg[1])
+         elif arg[0] == "-A" or arg[0] == "--agent-args": agentArgs  = arg[1].split()
+         elif arg[0] == "-o" or arg[0] == "--output":     output     = arg[1]
+         elif arg[0] == "-e" or arg[0] == "--encoding":   encoding   = arg[1].lower()
+         elif arg[0] == "-m" or arg[0] == "--mix":
+            mix = [kind.strip().lower() for kind in arg[1].split(",") if kind.strip()]
+   except ValueError:
+      usage()
+      return 2
+   if clients < 1 or duration <= 0 or largeBytes < 0 or not mix or \
+      encoding not in ENCODINGS or [kind for kind in mix if kind not in MIXES]:
+      usage()
+      return 2
+   print "Running %d clients for %.0f seconds, mix: %s" %(clients, duration, ", ".join(mix))
+   report = bench(port, clients, duration, mix, encoding, largeBytes, agentArgs)
+   if report is None:
+      sys.stderr.write("\n\nERROR -- The Agent did not start on %s:%d\n\n" %(ADDRESS, port))
+      return 3
+   showReport(report)
+   try:
+      with open(output, "w") as results:
+         json.dump(report, results, indent = 3, sort_keys = True)
+   except IOError as e:
+      sys.stderr.write("\n\nERROR -- Unable to write %s - %s\n\n" %(output, str(e)))
+      return 4
+   print "Results written to %s" %output
+   return EXIT_SUCCESS
+
+# ==============================================================================
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,669 @@
+#!/usr/bin/env python
+
+# Agent Replay - Records sessions with an Agent (see agent.py) and plays them back
+
+"""
+Records the sessions of clients with a real Agent and serves them again
+from a stand-in Agent, so client scripts and tools like fanout.py can be
+tested and loaded on one box without the lab (see the usage function).
+
+To record, the clients connect to this script instead of the Agent. Every
+byte is passed on both ways untouched:
+
+   agent_replay.py -r 192.168.1.129:1100 -l 1102 -f lab.rec
+
+Each message of a session is written to the --file with its replies and
+the seconds each reply took, one line a message, as the text of a Python
+dictionary:
+
+   {'session': 1, 'at': 0.502113, 'request': 'OS:uname -a',
+    'replies': [(0.004301, {'AGENT_RETURN_CODE': 0, 'OS_STDOUT': 'Linux', ...})]}
+
+Sessions are recorded framed or not, in any encoding and compressed or not,
+as are pipelined messages and OS-STREAM. FILE and SUB do not have one reply
+per message, once a session sends one of them the rest of the session is
+passed on without being recorded.
+
+To replay, the script is the stand-in Agent:
+
+   agent_replay.py -f lab.rec -l 1102          - At the recorded pace
+   agent_replay.py -f lab.rec -l 1102 -s 0     - As fast as it can
+
+The stand-in answers TA:framing, encoding, compress, bye and shutdown
+itself, and any other message with the replies recorded for it, encoded for
+the session. A message recorded more than once gets each recording in
+turn. A reply is sent the recorded seconds divided by --speed after the
+message came in, --speed=0 sends it at once. A message that is not in the
+recording gets an AGENT_RETURN_CODE of 298. The stand-in serves any number
+of sessions at once, a thread each, and never compresses its replies.
+
+The stand-in runs inside test scripts as well:
+
+   sys.path.insert(0, "bin")
+   from agent_replay import FakeAgent, readRecording
+   from client import getPool
+   agent = FakeAgent(readRecording("lab.rec"), speed = 0)
+   pool  = getPool("127.0.0.1", agent.start())
+   print pool.request("OS:uname -a")
+   agent.stop()
+"""
+
+# ==============================================================================
+# STANDARD LIBRARY IMPORTS
+import sys
+import os
+import time
+import getopt
+import socket
+import struct
+import signal
+import errno
+import threading
+import zlib
+import ast
+from collections import deque
+
+# ==============================================================================
+# DICTIONARY
+VERSION       = "1.0.0"                    # Version of the replay
+FIRST         = 0                          # first element in a list
+LAST          = -1                         # last element in a list
+ME            = os.path.split(sys.argv[FIRST])[LAST]        # Name of this file
+MY_PATH       = os.path.dirname(os.path.realpath(__file__)) # Path for this file
+EXIT_SUCCESS  = 0                          # Exit code
+LISTEN_ADDRESS = "127.0.0.1"               # Address clients connect to
+LISTEN_PORT   = 1102                       # Port clients connect to
+RECORD_FILE   = "agent_replay.rec"         # The recording
+SPEED         = 1.0                        # Replay pace, 1 as recorded, 0 no delays
+UNRECORDED    = ("FILE", "SUB")            # Directives that end the recording of a session
+MISS_CODE     = 298                        # AGENT_RETURN_CODE of a message not in the recording
+ENCODINGS     = ("repr", "json", "binary") # Reply encodings (TA:encoding)
+STOP_POLL     = 1.0                        # Seconds between checks for Ctrl-C
+
+sys.path.insert(FIRST, MY_PATH)
+from client import FRAME_HEADER, FRAME_COMPRESSED, BUFFER, AGENT_PORT, \
+                   AGENT_RETURN_CODE, AGENT_MESSAGE, decodeReply, decodeRepr, \
+                   encodeReply
+
+# ==============================================================================
+# CLASSES
+
+# ============================================================ RecordedSession()
+class RecordedSession:
+   """
+   RecordedSession() --> RecordedSession Object
+      A session of a client with the Agent passed on by the Recorder. The
+      messages of the client and the replies of the Agent are followed, to
+      know where each one ends and how the session is set up, and written
+      to the recording.
+      Members:
+         recorder
+         number
+         client
+         agent
+         framed
+         encoding
+         recording
+         pending
+         lock
+      Methods:
+         __init__()
+         run()
+         _fromClient()
+         _fromAgent()
+         _request()
+         _reply()
+         _stopRecording()
+   """
+   #--------------------------------------------------- RecordedSession.__init__()
+   def __init__(self, recorder, number, client, agent):
+      """ Creates an instance of an object of type RecordedSession. """
+      self.recorder  = recorder           # The Recorder writing the recording
+      self.number    = number             # Session number in the recording
+      self.client    = client             # \_ The two sockets
+      self.agent     = agent              # /
+      self.framed    = False              # TA:framing of the session
+      self.encoding  = "repr"             # TA:encoding of the session
+      self.recording = True               # False once FILE or SUB is sent
+      self.pending   = deque()            # Messages waiting for replies, in order
+      self.lock      = threading.Lock()   # Guards the above
+
+   # -------------------------------------------------------- RecordedSession.run()
+   def run(self):
+      """ Passes the session on both ways until either end closes it. """
+      replies = threading.Thread(target = self._fromAgent)
+      replies.daemon = True
+      replies.start()
+      try:
+         self._fromClient()
+      finally:
+         replies.join()
+         self.client.close()
+         self.agent.close()
+
+   # ------------------------------------------------ RecordedSession._fromClient()
+   def _fromClient(self):
+      """ Passes on the messages of the client. """
+      buffer = ""
+      while True:
+         try:
+            data = self.client.recv(BUFFER)
+         except socket.error:
+            data = ""
+         if not data: break
+         with self.lock:
+            buffer += data
+            messages, buffer = splitMessages(buffer, self.framed)
+            for message in messages: self._request(message)
+         try:
+            self.agent.sendall(data)
+         except socket.error:
+            break
+      try:
+         self.agent.shutdown(socket.SHUT_WR)   # The Agent ends the session
+      except socket.error:
+         pass
+
+   # ------------------------------------------------- RecordedSession._fromAgent()
+   def _fromAgent(self):
+      """ Passes on the replies of the Agent. The state of the session is
+          brought up to date before a reply is passed on, the client sends
+          nothing that depends on it before it has the reply. """
+      buffer = ""
+      while True:
+         try:
+            data = self.agent.recv(BUFFER)
+         except socket.error:
+            data = ""
+         if not data: break
+         with self.lock:
+            buffer += data
+            if self.framed:
+               replies, buffer = splitMessages(buffer, True)
+               for reply in replies: self._reply(reply)
+            elif not self.recording or not self.pending:
+               buffer = ""
+            else:
+               try:   # An unframed reply ends where it can be read whole
+                  decodeRepr(buffer)
+               except (SyntaxError, ValueError):
+                  pass
+               else:
+                  self._reply(buffer)
+                  buffer = ""
+         try:
+            self.client.sendall(data)
+         except socket.error:
+            break
+      try:
+         self.client.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+         pass
+
+   # --------------------------------------------------- RecordedSession._request()
+   def _request(self, message):
+      """ Notes a message of the client, with the lock held. """
+      if not self.recording: return
+      directive = message.split(":", 1)[FIRST].split(";")[FIRST].strip().upper()
+      if directive in UNRECORDED:
+         self._stopRecording()
+         return
+      if not self.framed: self.pending.clear() # One at a time, one not answered is left out
+      self.pending.append({"request"   : message.strip() ,
+                           "directive" : directive       ,
+                           "sent"      : time.time()     ,
+                           "replies"   : []              })
+
+   # ----------------------------------------------------- RecordedSession._reply()
+   def _reply(self, data):
+      """ Adds a reply of the Agent to the message it answers and writes the
+          message out once it has all of its replies, with the lock held. """
+      if not self.recording or not self.pending: return
+      exchange = self.pending[FIRST]
+      try:
+         response = decodeReply(data, self.encoding)
+      except (SyntaxError, ValueError, IndexError, KeyError, struct.error):
+         self._stopRecording()
+         return
+      exchange["replies"].append((round(time.time() - exchange["sent"], 6), response))
+      worked = isinstance(response, dict) and response.get(AGENT_RETURN_CODE) == 0
+      if worked and exchange["directive"] == "TA":
+         name, sep, setting = exchange["request"].split(":", 1)[LAST].partition("=")
+         name    = name.strip().lower()
+         setting = setting.strip().lower()
+         if name == "framing":    self.framed   = (setting == "on")
+         elif name == "encoding": self.encoding = setting
+      if worked and exchange["directive"] == "OS-STREAM" and response.get(AGENT_MESSAGE) == "STREAM":
+         return   # More output to come
+      self.pending.popleft()
+      self.recorder.write(self.number, exchange)
+
+   # --------------------------------------------- RecordedSession._stopRecording()
+   def _stopRecording(self):
+      """ Passes the rest of the session on without recording it. """
+      self.recording = False
+      self.pending.clear()
+      self.recorder.notice("Session %d is no longer recorded, it sent FILE or SUB "
+                           "or a reply could not be read" %self.number)
+# === End of class RecordedSession =====
+
+# =================================================================== Recorder()
+class Recorder:
+   """
+   Recorder() --> Recorder Object
+      Passes client sessions on to an Agent and writes them to a recording.
+      Members:
+         agentAddress
+         agentPort
+         output
+         lock
+         started
+         sessions
+         recorded
+      Methods:
+         __init__()
+         serve()
+         write()
+         notice()
+   """
+   #---------------------------------------------------------- Recorder.__init__()
+   def __init__(self, agentAddress, agentPort, output):
+      """ Creates an instance of an object of type Recorder, output is the
+          open recording file. """
+      self.agentAddress = agentAddress       # \_ The Agent recorded
+      self.agentPort    = agentPort          # /
+      self.output       = output             # The recording file
+      self.lock         = threading.Lock()   # Guards the file and counters
+      self.started      = time.time()        # Time the recording started
+      self.sessions     = 0                  # Sessions so far
+      self.recorded     = 0                  # Messages written
+
+   # ------------------------------------------------------------- Recorder.serve()
+   def serve(self, tcpSocket):
+      """ Accepts clients and passes each session on to the Agent in a
+          thread of its own, until interrupted. """
+      while True:
+         try:
+            client, remoteAddr = tcpSocket.accept()
+         except socket.error as e:
+            if e[FIRST] == errno.EINTR: continue
+            raise
+         try:
+            agent = socket.create_connection((self.agentAddress, self.agentPort))
+         except socket.error as e:
+            self.notice("Unable to reach the Agent at %s:%d - %s"
+                        %(self.agentAddress, self.agentPort, str(e)))
+            client.close()
+            continue
+         for end in (client, agent): end.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+         with self.lock:
+            self.sessions += 1
+            number = self.sessions
+         self.notice("Session %d from %s" %(number, str(remoteAddr)))
+         thread = threading.Thread(target = RecordedSession(self, number, client, agent).run)
+         thread.daemon = True
+         thread.start()
+
+   # ------------------------------------------------------------- Recorder.write()
+   def write(self, number, exchange):
+      """ Writes a message of a session and its replies to the recording. """
+      record = {"session" : number                                   ,
+                "at"      : round(exchange["sent"] - self.started, 6) ,
+                "request" : exchange["request"]                      ,
+                "replies" : exchange["replies"]                      }
+      with self.lock:
+         if self.output.closed: return   # Stopped, the session was still going
+         self.output.write(repr(record) + "\n")
+         self.output.flush()
+         self.recorded += 1
+
+   # ------------------------------------------------------------ Recorder.notice()
+   def notice(self, message):
+      """ Prints a notice on stdout. """
+      with self.lock:
+         print message
+         sys.stdout.flush()
+# === End of class Recorder =====
+
+# ================================================================== FakeAgent()
+class FakeAgent:
+   """
+   FakeAgent() --> FakeAgent Object
+      A stand-in Agent that answers with the replies of a recording, see
+      readRecording().
+      Members:
+         recording
+         speed
+         address
+         port
+         tcpSocket
+         thread
+         sessions
+         turns
+         lock
+         stopped
+         served
+         missed
+      Methods:
+         __init__()
+         start()
+         stop()
+         _serve()
+         _session()
+         _answer()
+         _send()
+         _replies()
+   """
+   #--------------------------------------------------------- FakeAgent.__init__()
+   def __init__(self, recording, speed = SPEED, address = LISTEN_ADDRESS, port = 0):
+      """ Creates an instance of an object of type FakeAgent. Port 0 listens
+          on a free port, start() returns it. """
+      self.recording = recording            # Message --> list of recorded replies
+      self.speed     = speed                # Replay pace, 0 no delays
+      self.address   = address              # \_ Listened on
+      self.port      = port                 # /
+      self.tcpSocket = None                 # The listener
+      self.thread    = None                 # Accepts the clients
+      self.sessions  = {}                   # Open connection --> its thread
+      self.turns     = {}                   # Message --> times it has been answered
+      self.lock      = threading.Lock()     # Guards sessions, turns and the counters
+      self.stopped   = threading.Event()    # Set by stop() and TA:shutdown
+      self.served    = 0                    # Messages answered from the recording
+      self.missed    = 0                    # Messages not in the recording
+
+   # ------------------------------------------------------------ FakeAgent.start()
+   def start(self):
+      """ Starts listening and serving in the background and returns the
+          port. Raises socket.error if the port cannot be listened on. """
+      self.tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.tcpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self.tcpSocket.bind((self.address, self.port))
+      self.tcpSocket.listen(128)
+      self.port = self.tcpSocket.getsockname()[1]
+      self.thread = threading.Thread(target = self._serve)
+      self.thread.daemon = True
+      self.thread.start()
+      return self.port
+
+   # ------------------------------------------------------------- FakeAgent.stop()
+   def stop(self):
+      """ Stops listening and ends the sessions still open. """
+      self.stopped.set()
+      try:
+         self.tcpSocket.shutdown(socket.SHUT_RDWR)   # Wakes the accept()
+      except socket.error:
+         pass
+      self.tcpSocket.close()
+      self.thread.join(STOP_POLL)
+      with self.lock:
+         sessions = self.sessions.items()
+      for connection, thread in sessions:
+         try:
+            connection.shutdown(socket.SHUT_RDWR)    # Wakes the recv()
+         except socket.error:
+            pass
+         if thread is not threading.current_thread(): thread.join(STOP_POLL)
+
+   # ----------------------------------------------------------- FakeAgent._serve()
+   def _serve(self):
+      """ Accepts clients and serves each in a thread of its own. """
+      while not self.stopped.is_set():
+         try:
+            connection, remoteAddr = self.tcpSocket.accept()
+         except socket.error:
+            if self.stopped.is_set(): return
+            continue
+         connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+         thread = threading.Thread(target = self._session, args = (connection,))
+         thread.daemon = True
+         with self.lock:
+            self.sessions[connection] = thread
+         thread.start()
+
+   # --------------------------------------------------------- FakeAgent._session()
+   def _session(self, connection):
+      """ Serves one client until it says bye or goes. """
+      session = {"connection" : connection, "framed" : False, "encoding" : "repr"}
+      buffer  = ""
+      try:
+         while not self.stopped.is_set():
+            data = connection.recv(BUFFER)
+            if not data: break
+            buffer += data
+            messages, buffer = splitMessages(buffer, session["framed"])
+            for message in messages:
+               if not self._answer(session, message, time.time()): return
+      except socket.error:
+         pass
+      finally:
+         with self.lock:
+            self.sessions.pop(connection, None)
+         connection.close()
+
+   # ---------------------------------------------------------- FakeAgent._answer()
+   def _answer(self, session, message, received):
+      """ Answers one message, returns False once the session is over. """
+      directive, sep, command = message.partition(":")
+      directive = directive.split(";")[FIRST].strip().upper()
+      name, sep, setting = command.strip().partition("=")
+      name    = name.strip().lower()
+      setting = setting.strip().lower()
+      if directive == "TA" and name in ("bye", "quit", "exit"):
+         self._send(session, {AGENT_RETURN_CODE : 0, AGENT_MESSAGE : "CLOSING CONNECTION"})
+         return False
+      if directive == "TA" and name == "shutdown":
+         self._send(session, {AGENT_RETURN_CODE : 0, AGENT_MESSAGE : "SHUTTING DOWN AGENT"})
+         self.stop()
+         return False
+      if directive == "TA" and name == "framing":
+         if setting not in ("on", "off"):
+            self._send(session, {AGENT_RETURN_CODE : 3, AGENT_MESSAGE : "TA:framing must be set to on or off"})
+         else:
+            self._send(session, {AGENT_RETURN_CODE : 0, AGENT_MESSAGE : "FRAMING %s" %setting.upper()})
+            session["framed"] = (setting == "on")
+         return True
+      if directive == "TA" and name == "encoding":
+         if setting not in ENCODINGS or (setting == "binary" and not session["framed"]):
+            self._send(session, {AGENT_RETURN_CODE : 4, AGENT_MESSAGE : "TA:encoding must be set to one of %s"
+                                 " (binary on a framed session)" %", ".join(ENCODINGS)})
+         else:
+            self._send(session, {AGENT_RETURN_CODE : 0, AGENT_MESSAGE : "ENCODING %s" %setting.upper()})
+            session["encoding"] = setting
+         return True
+      if directive == "TA" and name == "compress":
+         if not session["framed"]:
+            self._send(session, {AGENT_RETURN_CODE : 6, AGENT_MESSAGE : "TA:compress needs a framed session"})
+         else:
+            self._send(session, {AGENT_RETURN_CODE : 0, AGENT_MESSAGE : "COMPRESS %s" %setting.upper()})
+         return True
+      replies = self._replies(message.strip())
+      if replies is None:
+         self._send(session, {AGENT_RETURN_CODE : MISS_CODE,
+                              AGENT_MESSAGE     : "NOT IN THE RECORDING: %s" %message.strip()})
+         return True
+      for delay, response in replies:
+         if self.speed > 0:
+            wait = received + delay / self.speed - time.time()
+            if wait > 0: time.sleep(wait)
+         self._send(session, response)
+      return True
+
+   # ------------------------------------------------------------ FakeAgent._send()
+   def _send(self, session, response):
+      """ Sends a reply encoded and framed for the session. """
+      reply = encodeReply(response, session["encoding"])
+      if session["framed"]: reply = FRAME_HEADER.pack(len(reply)) + reply
+      session["connection"].sendall(reply)
+
+   # --------------------------------------------------------- FakeAgent._replies()
+   def _replies(self, message):
+      """ Returns the next recorded replies of a message, None if it is not
+          in the recording. """
+      with self.lock:
+         recorded = self.recording.get(message)
+         if not recorded:
+            self.missed += 1
+            return None
+         turn = self.turns.get(message, 0)
+         self.turns[message] = turn + 1
+         self.served += 1
+      return recorded[turn % len(recorded)]
+# === End of class FakeAgent =====
+
+# ==============================================================================
+# FUNCTIONS
+
+# ---------------------------------------------------------------------- usage()
+def usage():
+   """usage() - Prints the usage message on stdout. """
+   print "\n\n%s, Version %s, Records and replays Agent sessions.  " %(ME,VERSION)
+   print "\nUSAGE: %s [OPTIONS]                                    " %ME
+   print "                                                         "
+   print "OPTIONS:                                                 "
+   print "   -h --help        Display this message.                "
+   print "   -r --record=     Record the sessions of clients with the Agent "
+   print "                    at ADDRESS[:PORT], default port: %d " %AGENT_PORT
+   print "                    Without it the recording is replayed. "
+   print "   -f --file=       The recording, default: %s " %RECORD_FILE
+   print "   -a --address=    Address clients connect to, default: %s " %LISTEN_ADDRESS
+   print "   -l --listen=     Port clients connect to, default: %d " %LISTEN_PORT
+   print "   -s --speed=      Replay pace, 1 as recorded, 2 twice as fast, "
+   print "                    0 no delays, default: %g " %SPEED
+   print "                                                         "
+   print "EXIT CODES:                                              "
+   print "    0 - Successful completion of the program.            "
+   print "    2 - Bad command line arguments.                      "
+   print "    3 - Unable to listen on the port.                    "
+   print "    4 - Unable to read or write the recording.           "
+   print "                                                         "
+
+# ------------------------------------------------------------ splitMessages()
+def splitMessages(buffer, framed):
+   """splitMessages(str buffer, bool framed) Returns the whole messages at
+      the start of the data received and the rest of it. Framed messages
+      are uncompressed, unframed data is one message. """
+   if not framed:
+      if buffer: return [buffer], ""
+      return [], ""
+   messages = []
+   offset   = 0
+   while len(buffer) - offset >= FRAME_HEADER.size:
+      length = FRAME_HEADER.unpack_from(buffer, offset)[FIRST]
+      size   = length & ~FRAME_COMPRESSED
+      start  = offset + FRAME_HEADER.size
+      if len(buffer) - start < size: break
+      message = buffer[start:start + size]
+      if length & FRAME_COMPRESSED: message = zlib.decompress(message)
+      messages.append(message)
+      offset = start + size
+   return messages, buffer[offset:]
+
+# ------------------------------------------------------------ readRecording()
+def readRecording(path):
+   """readRecording(path) Returns a recording as a dictionary of the
+      replies recorded for each message, a list of lists of (seconds,
+      reply), in the order they were recorded. Raises IOError if the file
+      cannot be read and ValueError for a bad line. """
+   recording = {}
+   with open(path) as recordFile:
+      for number, line in enumerate(recordFile):
+         if not line.strip(): continue
+         try:
+            record = ast.literal_eval(line.strip())
+            recording.setdefault(record["request"], []).append(
+               [(float(delay), response) for delay, response in record["replies"]])
+         except (SyntaxError, ValueError, KeyError, TypeError):
+            raise ValueError("line %d of %s is not a recorded message" %(number + 1, path))
+   return recording
+
+# ---------------------------------------------------------------- interrupt()
+def interrupt(signum, frame):
+   """interrupt(signum, frame) SIGTERM handler, stops the program as Ctrl-C
+      does. """
+   raise KeyboardInterrupt()
+
+# ----------------------------------------------------------------------- main()
+def main():
+   """main() Records or replays as directed by the command line. """
+   record  = None
+   path    = RECORD_FILE
+   address = LISTEN_ADDRESS
+   port    = LISTEN_PORT
+   speed   = SPEED
+   try:
+      arguments = getopt.getopt(sys.argv[1:], "hr:f:a:l:s:",
+                                ['help', 'record=', 'file=', 'address=',
+                                 'listen=', 'speed='])
+   except:
+      usage()
+      return 2
+   try:
+      for arg in arguments[FIRST]:
+         if arg[0] == "-h" or arg[0] == "--help":
+            usage()
+            return EXIT_SUCCESS
+         elif arg[0] == "-r" or arg[0] == "--record":  record  = arg[1]
+         elif arg[0] == "-f" or arg[0] == "--file":    path    = arg[1]
+         elif arg[0] == "-a" or arg[0] == "--address": address = arg[1]
+         elif arg[0] == "-l" or arg[0] == "--listen":  port    = int(arg[1])
+         elif arg[0] == "-s" or arg[0] == "--speed":   speed   = float(arg[1])
+      if record is not None:
+         agentAddress, sep, agentPort = record.rpartition(":")
+         if sep: agentPort = int(agentPort)
+         else:   agentAddress, agentPort = agentPort, AGENT_PORT
+   except ValueError:
+      usage()
+      return 2
+   if speed < 0 or arguments[LAST]:
+      usage()
+      return 2
+   signal.signal(signal.SIGTERM, interrupt)
+   # ------------------------------------------------------------------ REPLAY
+   if record is None:
+      try:
+         agent = FakeAgent(readRecording(path), speed, address, port)
+      except (IOError, ValueError) as e:
+         sys.stderr.write("\n\nERROR -- Unable to read the recording %s - %s\n\n" %(path, str(e)))
+         return 4
+      try:
+         agent.start()
+      except socket.error as e:
+         sys.stderr.write("\n\nERROR -- Unable to listen on %s:%d - %s\n\n" %(address, port, str(e)))
+         return 3
+      print "Replaying %d messages of %s on %s:%d" %(len(agent.recording), path, address, agent.port)
+      try:
+         while not agent.stopped.wait(STOP_POLL): pass
+      except KeyboardInterrupt:
+         agent.stop()
+      print "Answered %d messages, %d were not in the recording" %(agent.served, agent.missed)
+      return EXIT_SUCCESS
+   # ------------------------------------------------------------------ RECORD
+   tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+   try:
+      tcpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      tcpSocket.bind((address, port))
+      tcpSocket.listen(128)
+   except socket.error as e:
+      sys.stderr.write("\n\nERROR -- Unable to listen on %s:%d - %s\n\n" %(address, port, str(e)))
+      return 3
+   try:
+      output = open(path, "w")
+   except IOError as e:
+      sys.stderr.write("\n\nERROR -- Unable to write the recording %s - %s\n\n" %(path, str(e)))
+      return 4
+   recorder = Recorder(agentAddress, agentPort, output)
+   print "Recording the Agent at %s:%d to %s, clients connect to %s:%d" \
+         %(agentAddress, agentPort, path, address, port)
+   try:
+      recorder.serve(tcpSocket)
+   except KeyboardInterrupt:
+      pass
+   finally:
+      tcpSocket.close()
+      with recorder.lock: output.close()
+   print "Recorded %d messages of %d sessions" %(recorder.recorded, recorder.sessions)
+   return EXIT_SUCCESS
+
+# ==============================================================================
+if __name__ == "__main__":
+   sys.exit(main())
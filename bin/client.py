@@ -1,19 +1,836 @@
 #!/usr/bin/env python
+
+# Agent Client - Sends commands to an Agent (see agent.py) over TCP/IP
+
+"""
+This is both a script and a library. Run as a script it connects to an
+Agent, gets the version of the Agent, runs a command and ends the session
+(see the usage function). Imported as a library it gives other scripts the
+helpers needed to talk to an Agent:
+
+   sendFramed(tcpSocket, message)  - Sends a framed message (TA:framing=on)
+   recvFramed(tcpSocket)           - Receives a framed reply, decompressed
+                                     if the Agent compressed it (TA:compress)
+   decodeReply(reply, encoding)    - Turns a reply into a Python dictionary
+   encodeReply(response, encoding) - Encodes a dictionary as the Agent would
+   getFile(tcpSocket, remotePath, localPath, ...) - Copies a file from the Agent
+   putFile(tcpSocket, localPath, remotePath, ...) - Copies a file to the Agent
+   readSpill(tcpSocket, spillId, output, ...)     - Reads spilled output (SPILL)
+   AgentConnection(address, port, ...) - A framed session with pipelining
+   AgentPool(address, port, size, ...) - Reused sessions to one Agent
+   getPool(address, port, ...)         - The AgentPool of an Agent address
+   probeAgents(agents, ...)            - PINGs the health probe of many Agents
+
+decodeReply() understands the three reply encodings of the Agent
+(TA:encoding=repr, json or binary). For the repr encoding the replies that
+the Agent sends as a list, like [0, "NO_NAME"], are returned as a dictionary
+of AGENT_RETURN_CODE and AGENT_MESSAGE as well.
+
+An AgentConnection sets up framing and the encoding of a session. Its
+request() sends a message and returns the reply as a dictionary. submit()
+only sends the message and returns a Reply, so many messages can be on the
+way at once. Reply.result() reads the replies of the session up to its own,
+in order, and any thread may wait on any Reply. A connection that breaks
+fails the replies still due and connects again on the next message.
+
+An AgentPool keeps up to "size" sessions to one Agent and hands them out in
+turn, so scripts stop paying a TCP handshake and teardown for every few
+commands. A session that has been idle is checked before it is used again.
+A request whose reused session turns out to have been closed by the Agent
+(--idle-timeout) is sent again once on a new session. map() spreads a list
+of messages over the sessions of the pool, pipelined, and returns the
+replies in order. A pool holds its sessions open, an Agent that serves
+one session at a time (without --workers or --eventloop) serves no one
+else meanwhile.
+
+probeAgents() sweeps the health probes (agent.py --udp-port) of a list of
+Agents from a single UDP socket, without opening a session to any of them,
+and returns the reply and round trip time of each. The PING token of a
+probe is the index of the Agent in the list, which matches the replies,
+in whatever order they come, to the Agents. Probes are sent again to the
+Agents that have not answered, UDP may lose a datagram.
+
+Only directives with one reply per message go through a connection, that
+is TA, OS, BATCH, JOB, SYS, SPILL and CACHE. OS-STREAM, FILE and SUB use the
+socket of a connection (AgentConnection.socket) and the helpers above. The
+Agent tools are Python 2, which has no asyncio, so submit() and Reply are
+the non-blocking API.
+
+Example:
+
+   from client import getPool
+   pool = getPool("192.168.1.129", 1100)
+   print pool.request("OS:uname -a")["OS_STDOUT"]
+   for reply in pool.map(["OS:uptime", "SYS:load", "TA:getname"]): print reply
+   with pool.connection() as connection:
+      replies = [connection.submit("OS:df -h %s" %path) for path in paths]
+      for reply in replies: print reply.result()["OS_STDOUT"]
+   pool.close()
+
+Or with the helpers alone:
+
+   import socket
+   from client import sendFramed, recvFramed, decodeReply
+   tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+   tcpSocket.connect(("192.168.1.129", 1100))
+   tcpSocket.send("TA:framing=on")
+   print tcpSocket.recv(14336)
+   sendFramed(tcpSocket, "TA:encoding=binary")
+   print recvFramed(tcpSocket)
+   sendFramed(tcpSocket, "OS:uname -a")
+   print decodeReply(recvFramed(tcpSocket), "binary")["OS_STDOUT"]
+"""
+
+# ==============================================================================
+# STANDARD LIBRARY IMPORTS
+import sys
+import os
+import time
+import getopt
+import struct
+import json
+import ast
+import hashlib
+import zlib
+import select
+import threading
+from collections import deque
+from contextlib import contextmanager
 from socket import socket                  # The Socket library
 from socket import AF_INET, SOCK_STREAM    # Specific constants from socket
-from sys    import exit                    # Import the exit function 
-AGENT_IP    = "192.168.1.129"              # The Agent IP Address
-AGENT_PORT  = 1100                         # The Agent Port number 
-BUFFER      = 14336 # 14k                  # The size of the TCP Buffer
-tcpSocket = socket(AF_INET, SOCK_STREAM)   # Create an object of type socket
-tcpSocket.connect((AGENT_IP,AGENT_PORT))   # Establish a connection
-tcpSocket.send("TA:version")               # Send the TA:version command 
-response = tcpSocket.recv(BUFFER)          # Get the response from the agent
-print response                             # Print the response
-tcpSocket.send("OS:/home/test/automation/bin/testmaster.py")   # Send the TA:version command 
-response = tcpSocket.recv(BUFFER)          # Get the response from the agent
-print response
-tcpSocket.send("TA:bye")                   # End the session with the agent 
-response = tcpSocket.recv(BUFFER)          # Get the closing notice 
-print response                             # Print the closing response 
-exit(0)          
+from socket import SOCK_DGRAM
+from socket import IPPROTO_TCP, TCP_NODELAY
+from socket import error as SocketError
+
+# ==============================================================================
+# DICTIONARY
+VERSION       = "1.1.0"                    # Version of the client
+FIRST         = 0                          # first element in a list
+LAST          = -1                         # last element in a list
+ME            = os.path.split(sys.argv[FIRST])[LAST]        # Name of this file
+EXIT_SUCCESS  = 0                          # Exit code
+AGENT_IP      = "192.168.1.129"            # The Agent IP Address
+AGENT_PORT    = 1100                       # The Agent Port number
+BUFFER        = 14336 # 14k                # The size of the TCP Buffer
+COMMAND       = "/home/test/automation/bin/testmaster.py" # OS command to run
+FRAME_HEADER  = struct.Struct("!I")        # Length header of a framed message
+FRAME_COMPRESSED = 0x80000000              # Length header bit of a compressed frame
+MEASURE_REPEAT = 200                       # Replies decoded per encoding
+FILE_CHUNK    = 262144 # 256k              # Bytes of a file sent in one frame
+SPILL_CHUNK   = 1048576 # 1M               # Bytes of spilled output read at a time
+POOL_SIZE     = 4                          # Most sessions an AgentPool holds
+POOL_ENCODING = "binary"                   # Reply encoding of pooled sessions
+PROBE_TIMEOUT = 1.0                        # Seconds probeAgents() waits for replies
+PROBE_TRIES   = 2                          # Probes sent to an Agent that does not answer
+PROBE_BUF_SIZE = 2048                      # Largest health probe reply read
+AGENT_RETURN_CODE = "AGENT_RETURN_CODE"    # \
+AGENT_MESSAGE     = "AGENT_MESSAGE"        #  > -- Response key names
+BINARY_KEYS   = ["AGENT_RETURN_CODE", "AGENT_MESSAGE", "OS_COMMAND",
+                 "OS_STDOUT", "OS_STDERR", "OS_RETURNCODE", "OS_STREAM",
+                 "OS_DATA", "BATCH_RESULTS", "JOB_ID", "JOB_STATE",
+                 "JOB_LIST", "AGENT_STATS", "FILE_PATH", "FILE_SIZE",
+                 "FILE_OFFSET", "FILE_CHECKSUM", "SYS_DATA", "SUB_ID", "SUB_SEQ",
+                 "SUB_TIME", "SUB_LIST", "OS_SPILL", "SPILL_ID", "SPILL_SIZE",
+                 "SPILL_OFFSET", "SPILL_LIST", "CACHE_AGE", "CACHE_LIST",
+                 "CACHE_HITS", "CACHE_MISSES", "PING_DATA",
+                 "PING_TOKEN"]             # Same order as in agent.py
+BINARY_KEY_INDEX = dict([(key, index) for index, key in enumerate(BINARY_KEYS)])
+_unpackI      = struct.Struct("!I").unpack_from  # \
+_unpacki      = struct.Struct("!i").unpack_from  #  \_ Used by decodeBinary()
+_unpackq      = struct.Struct("!q").unpack_from  #  /
+_unpackd      = struct.Struct("!d").unpack_from  # /
+_pools        = {}                         # \_ The AgentPool of each Agent,
+_poolsLock    = threading.Lock()           # /  see getPool()
+
+# ==============================================================================
+# CLASSES
+
+# ====================================================================== Reply()
+class Reply:
+   """
+   Reply() --> Reply Object
+      The reply to a message sent with AgentConnection.submit(), filled in
+      once it has been read from the session.
+      Members:
+         connection
+         message
+         response
+         error
+         ready
+      Methods:
+         __init__()
+         done()
+         result()
+   """
+   #-------------------------------------------------------------- Reply.__init__()
+   def __init__(self, connection, message):
+      """ Creates an instance of an object of type Reply. """
+      self.connection = connection   # The AgentConnection the message went on
+      self.message    = message      # The message sent
+      self.response   = None         # The reply as a dictionary
+      self.error      = None         # Why no reply came, the session broke
+      self.ready      = False        # The reply, or error, is in
+
+   # ------------------------------------------------------------------ Reply.done()
+   def done(self):
+      """ Returns True once the reply has been read. """
+      return self.ready
+
+   # ---------------------------------------------------------------- Reply.result()
+   def result(self):
+      """ Returns the reply as a dictionary, reading the replies of the
+          session before it first. Raises the error that broke the session
+          if it broke before the reply came. """
+      while not self.ready: self.connection._readReply()
+      if self.error is not None: raise self.error
+      return self.response
+# === End of class Reply =====
+
+# ============================================================ AgentConnection()
+class AgentConnection:
+   """
+   AgentConnection() --> AgentConnection Object
+      A framed session with an Agent. Messages may be sent without waiting
+      for the replies of the ones before them, the Agent answers them in
+      order.
+      Members:
+         address
+         port
+         encoding
+         timeout
+         compress
+         socket
+         pending
+         sendLock
+         recvLock
+         lastUsed
+      Methods:
+         __init__()
+         connect()
+         submit()
+         request()
+         pipeline()
+         idle()
+         close()
+         _readReply()
+         _fail()
+   """
+   #---------------------------------------------------- AgentConnection.__init__()
+   def __init__(self, address = AGENT_IP, port = AGENT_PORT, encoding = POOL_ENCODING,
+                timeout = None, compress = False):
+      """ Creates an instance of an object of type AgentConnection and
+          connects to the Agent. timeout is the seconds to wait for the
+          Agent, None waits for ever. With compress the Agent compresses
+          large replies (TA:compress). """
+      self.address  = address             # \_ Of the Agent
+      self.port     = port                # /
+      self.encoding = encoding            # Of the replies, see decodeReply()
+      self.timeout  = timeout             # Seconds to wait for the Agent
+      self.compress = compress            # Ask for compressed replies
+      self.socket   = None                # None while not connected
+      self.pending  = deque()             # Replies due, in the order sent
+      self.sendLock = threading.Lock()    # \_ Keep the messages and replies
+      self.recvLock = threading.Lock()    # /  of threads from mixing
+      self.lastUsed = time.time()         # Time of the last message
+      self.connect()
+
+   # ----------------------------------------------------- AgentConnection.connect()
+   def connect(self):
+      """ Opens the session and sets framing and the encoding. """
+      tcpSocket = socket(AF_INET, SOCK_STREAM)
+      try:
+         tcpSocket.settimeout(self.timeout)
+         tcpSocket.connect((self.address, self.port))
+         tcpSocket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+         tcpSocket.sendall("TA:framing=on")
+         _checkSetup(decodeRepr(tcpSocket.recv(BUFFER)))
+         sendFramed(tcpSocket, "TA:encoding=%s" %self.encoding)
+         _checkSetup(decodeRepr(recvFramed(tcpSocket)))    # Sent before the change
+         if self.compress:
+            sendFramed(tcpSocket, "TA:compress=on")
+            _checkSetup(decodeReply(recvFramed(tcpSocket), self.encoding))
+      except:
+         tcpSocket.close()
+         raise
+      self.socket   = tcpSocket
+      self.lastUsed = time.time()
+
+   # ------------------------------------------------------ AgentConnection.submit()
+   def submit(self, message):
+      """ Sends a message and returns its Reply without waiting for it. A
+          broken session is connected again first. """
+      with self.sendLock:
+         if self.socket is None: self.connect()
+         reply = Reply(self, message)
+         self.pending.append(reply)   # Before it is sent, the reply may come back at once
+         try:
+            sendFramed(self.socket, message)
+         except SocketError as e:
+            self._fail(e)
+         self.lastUsed = time.time()
+      return reply
+
+   # ----------------------------------------------------- AgentConnection.request()
+   def request(self, message):
+      """ Sends a message and returns the reply as a dictionary. """
+      return self.submit(message).result()
+
+   # ---------------------------------------------------- AgentConnection.pipeline()
+   def pipeline(self, messages):
+      """ Sends all of the messages and then returns their replies, in
+          order, as a list of dictionaries. """
+      return [reply.result() for reply in [self.submit(message) for message in messages]]
+
+   # -------------------------------------------------------- AgentConnection.idle()
+   def idle(self):
+      """ Returns True if the session is open with no replies due and the
+          Agent has not closed it, so it can be handed to someone else. """
+      if self.socket is None or self.pending: return False
+      try:
+         readable = select.select([self.socket], [], [], 0)[FIRST]
+      except (SocketError, select.error, ValueError):
+         return False
+      return not readable   # Nothing is due, so it can only be the Agent closing
+
+   # ------------------------------------------------------- AgentConnection.close()
+   def close(self):
+      """ Ends the session, with TA:bye if it is idle. """
+      if self.socket is None: return
+      if self.idle():
+         try:
+            self.request("TA:bye")
+         except Exception:
+            pass   # The session broke, _fail() has closed it
+      if self.socket is not None: self.socket.close()
+      self.socket = None
+
+   # -------------------------------------------------- AgentConnection._readReply()
+   def _readReply(self):
+      """ Reads the next reply of the session into the Reply it belongs to.
+          A reply that cannot be read or decoded breaks the session, the
+          replies after it could not be told apart from the rest of it. """
+      with self.recvLock:
+         if not self.pending or self.socket is None: return   # Another thread read it
+         try:
+            response = decodeReply(recvFramed(self.socket), self.encoding)
+         except Exception as e:   # Socket, framing, zlib or decoding errors
+            self._fail(e)
+            return
+         reply = self.pending.popleft()
+         reply.response = response
+         reply.ready    = True
+
+   # ------------------------------------------------------- AgentConnection._fail()
+   def _fail(self, error):
+      """ Closes a broken session, the replies still due get the error. """
+      if self.socket is not None: self.socket.close()
+      self.socket = None
+      while self.pending:
+         reply = self.pending.popleft()
+         reply.error = error
+         reply.ready = True
+# === End of class AgentConnection =====
+
+# ================================================================== AgentPool()
+class AgentPool:
+   """
+   AgentPool() --> AgentPool Object
+      Up to "size" sessions with one Agent, reused from one request to the
+      next. See getPool() for the pool of an Agent address.
+      Members:
+         address
+         port
+         options
+         idle
+         lock
+         slots
+      Methods:
+         __init__()
+         acquire()
+         release()
+         connection()
+         request()
+         map()
+         close()
+   """
+   #---------------------------------------------------------- AgentPool.__init__()
+   def __init__(self, address = AGENT_IP, port = AGENT_PORT, size = POOL_SIZE, **options):
+      """ Creates an instance of an object of type AgentPool, options are
+          given to each AgentConnection (encoding, timeout, compress). No
+          session is opened until one is needed. """
+      self.address = address                          # \_ Of the Agent
+      self.port    = port                             # /
+      self.size    = size                             # Most sessions at once
+      self.options = options                          # For each AgentConnection
+      self.idle    = []                               # Sessions not in use, last used last
+      self.lock    = threading.Lock()                 # Guards idle
+      self.slots   = threading.BoundedSemaphore(size) # Sessions that may be opened or used
+
+   # ----------------------------------------------------------- AgentPool.acquire()
+   def acquire(self, wait = True):
+      """ Returns a session for the caller alone, waiting while "size" are
+          in use, or (None, False) then if wait is False. The second value 
+          is True for a session that was reused. Give it back with 
+          release(). """
+      if not self.slots.acquire(wait): return None, False
+      try:
+         while True:
+            with self.lock:
+               if not self.idle: break
+               connection = self.idle.pop()
+            if connection.idle(): return connection, True
+            connection.close()
+         return AgentConnection(self.address, self.port, **self.options), False
+      except:
+         self.slots.release()
+         raise
+
+   # ----------------------------------------------------------- AgentPool.release()
+   def release(self, connection):
+      """ Gives back a session taken with acquire(). """
+      try:
+         if connection.socket is None or connection.pending: 
+            connection.close()
+         else:
+            with self.lock: self.idle.append(connection)
+      finally:
+         self.slots.release()
+
+   # -------------------------------------------------------- AgentPool.connection()
+   @contextmanager
+   def connection(self):
+      """ with pool.connection() as connection: - A session of the pool for
+          the block, to pipeline messages on. """
+      connection, reused = self.acquire()
+      try:
+         yield connection
+      finally:
+         self.release(connection)
+
+   # ----------------------------------------------------------- AgentPool.request()
+   def request(self, message, retry = True):
+      """ Sends a message on a session of the pool and returns the reply as
+          a dictionary. If the Agent had closed a reused session and no
+          reply came the message is sent once more on a new session, unless
+          retry is False. """
+      connection, reused = self.acquire()
+      try:
+         try:
+            return connection.request(message)
+         except (SocketError, EOFError):
+            if not (reused and retry): raise
+            connection.connect()
+            return connection.request(message)
+      finally:
+         self.release(connection)
+
+   # --------------------------------------------------------------- AgentPool.map()
+   def map(self, messages):
+      """ Sends the messages over up to "size" sessions of the pool, each one
+          pipelined, and returns the replies in the order of the messages. """
+      messages    = list(messages)
+      connections = []
+      try:
+         if messages: connections.append(self.acquire()[FIRST])
+         # Only the sessions that are free as well, two maps waiting on each 
+         # other's sessions would wait for ever 
+         while len(connections) < min(self.size, len(messages)):
+            connection = self.acquire(False)[FIRST]
+            if connection is None: break
+            connections.append(connection)
+         replies = [connections[i % len(connections)].submit(message) 
+                    for i, message in enumerate(messages)]
+         return [reply.result() for reply in replies]
+      finally:
+         for connection in connections: self.release(connection)
+
+   # ------------------------------------------------------------- AgentPool.close()
+   def close(self):
+      """ Ends the sessions not in use. """
+      with self.lock:
+         idle, self.idle = self.idle, []
+      for connection in idle: connection.close()
+# === End of class AgentPool =====
+
+# ==============================================================================
+# FUNCTIONS
+
+# ---------------------------------------------------------------------- usage()
+def usage():
+   """usage() - Prints the usage message on stdout. """
+   print "\n\n%s, Version %s, This is a client for the Remote Agent.  " %(ME,VERSION)
+   print "\nUSAGE: %s [OPTIONS]                                    " %ME
+   print "                                                         "
+   print "OPTIONS:                                                 "
+   print "   -h --help      Display this message.                  "
+   print "   -a --address=  The address of the Agent, default: %s " %AGENT_IP
+   print "   -p --port=     The port of the Agent, default: %d " %AGENT_PORT
+   print "   -c --command=  The OS command to run, default: %s " %COMMAND
+   print "   -m --measure   Compare the size and decode time of the reply "
+   print "                  encodings for the command instead.      "
+   print "                                                         "
+   print "EXIT CODES:                                              "
+   print "    0 - Successful completion of the program.            "
+   print "    2 - Bad command line arguments.                      "
+   print "    3 - Unable to talk to the Agent.                     "
+   print "                                                         "
+
+# -------------------------------------------------------------------- getPool()
+def getPool(address = AGENT_IP, port = AGENT_PORT, **options):
+   """getPool(address, port, size, encoding, timeout, compress) Returns the
+      AgentPool of an Agent address, made the first time it is asked for.
+      The options are used only then. """
+   with _poolsLock:
+      pool = _pools.get((address, port))
+      if pool is None:
+         pool = _pools[(address, port)] = AgentPool(address, port, **options)
+   return pool
+
+def _checkSetup(response):
+   """ Raises IOError if the Agent refused to set up a session. """
+   if response[AGENT_RETURN_CODE] != 0:
+      raise IOError("Unable to set up the session - %s" %response[AGENT_MESSAGE])
+
+# ----------------------------------------------------------------- sendFramed()
+def sendFramed(tcpSocket, message, compress = False):
+   """sendFramed(tcpSocket, str message, bool compress) Sends one framed
+      message, compressed with zlib if compress is set. """
+   if compress:
+      message = zlib.compress(message)
+      tcpSocket.sendall(FRAME_HEADER.pack(len(message) | FRAME_COMPRESSED) + message)
+   else:
+      tcpSocket.sendall(FRAME_HEADER.pack(len(message)) + message)
+
+# ----------------------------------------------------------------- recvFramed()
+def recvFramed(tcpSocket):
+   """recvFramed(tcpSocket) Returns the next framed reply as a string. """
+   length = FRAME_HEADER.unpack(_recvAll(tcpSocket, FRAME_HEADER.size))[FIRST]
+   if length & FRAME_COMPRESSED:
+      return zlib.decompress(_recvAll(tcpSocket, length & ~FRAME_COMPRESSED))
+   return _recvAll(tcpSocket, length)
+
+def _recvAll(tcpSocket, length):
+   """ Receives exactly length bytes. """
+   chunks = []
+   while length > 0:
+      chunk = tcpSocket.recv(min(length, 262144))
+      if not chunk: raise EOFError("Connection closed by the Agent")
+      chunks.append(chunk)
+      length -= len(chunk)
+   return "".join(chunks)
+
+# ---------------------------------------------------------------- decodeReply()
+def decodeReply(reply, encoding = "repr"):
+   """decodeReply(str reply, str encoding) Returns the reply of the Agent
+      as a dictionary. encoding is the encoding set with TA:encoding. """
+   if encoding == "binary": return decodeBinary(reply)
+   if encoding == "json":   return json.loads(reply)
+   return decodeRepr(reply)
+
+# ----------------------------------------------------------------- decodeRepr()
+def decodeRepr(reply):
+   """decodeRepr(str reply) Decodes a reply in the repr encoding. Replies
+      sent as a list are returned as a dictionary too. """
+   response = ast.literal_eval(reply.strip())
+   if isinstance(response, list):
+      response = {AGENT_RETURN_CODE : response[FIRST],
+                  AGENT_MESSAGE     : response[LAST] }
+   return response
+
+# --------------------------------------------------------------- decodeBinary()
+def decodeBinary(reply):
+   """decodeBinary(str reply) Decodes a reply in the binary encoding, see
+      encodeBinary() in agent.py for the format. """
+   return _decodeBinary(reply, 0)[FIRST]
+
+def _decodeBinary(data, offset):
+   """ Returns the value starting at offset and the offset after it. """
+   tag     = data[offset]
+   offset += 1
+   if tag == "k": return BINARY_KEYS[ord(data[offset])], offset + 1
+   if tag == "b": return ord(data[offset]), offset + 1
+   if tag == "s":
+      end = offset + 4 + _unpackI(data, offset)[FIRST]
+      return data[offset + 4:end], end
+   if tag == "d":
+      result = {}
+      count  = _unpackI(data, offset)[FIRST]
+      offset += 4
+      for i in xrange(count):
+         key, offset         = _decodeBinary(data, offset)
+         result[key], offset = _decodeBinary(data, offset)
+      return result, offset
+   if tag == "l":
+      result = []
+      count  = _unpackI(data, offset)[FIRST]
+      offset += 4
+      for i in xrange(count):
+         item, offset = _decodeBinary(data, offset)
+         result.append(item)
+      return result, offset
+   if tag == "i": return _unpacki(data, offset)[FIRST], offset + 4
+   if tag == "q": return _unpackq(data, offset)[FIRST], offset + 8
+   if tag == "f": return _unpackd(data, offset)[FIRST], offset + 8
+   if tag == "N": return None, offset
+   if tag == "T": return True, offset
+   if tag == "F": return False, offset
+   raise ValueError("Bad binary reply, unknown tag %r at %d" %(tag, offset - 1))
+
+# ---------------------------------------------------------------- encodeReply()
+def encodeReply(response, encoding = "repr"):
+   """encodeReply(dict response, str encoding) Returns a reply dictionary
+      encoded the way the Agent sends it, the reverse of decodeReply(). Used
+      by stand-ins for the Agent, see agent_replay.py. """
+   if encoding == "binary": return encodeBinary(response)
+   if encoding == "json":   return json.dumps(response, separators = (',', ':'))
+   return str(response)
+
+# --------------------------------------------------------------- encodeBinary()
+def encodeBinary(value):
+   """encodeBinary(value) Returns the binary encoding of a value, the same
+      as encodeBinary() in agent.py. """
+   chunks = []
+   _encodeBinary(value, chunks)
+   return "".join(chunks)
+
+def _encodeBinary(value, chunks):
+   """ Appends the binary encoding of value to the list chunks. """
+   if value is None:              chunks.append("N")
+   elif value is True:            chunks.append("T")
+   elif value is False:           chunks.append("F")
+   elif isinstance(value, (int, long)):
+      if 0 <= value < 256:        chunks.append("b" + chr(value))
+      elif -2**31 <= value < 2**31: chunks.append("i" + struct.pack("!i", value))
+      else:                       chunks.append("q" + struct.pack("!q", value))
+   elif isinstance(value, float): chunks.append("f" + struct.pack("!d", value))
+   elif isinstance(value, basestring):
+      if isinstance(value, unicode): value = value.encode("utf-8")
+      if value in BINARY_KEY_INDEX:
+         chunks.append("k" + chr(BINARY_KEY_INDEX[value]))
+      else:
+         chunks.append("s" + struct.pack("!I", len(value)) + value)
+   elif isinstance(value, (list, tuple)):
+      chunks.append("l" + struct.pack("!I", len(value)))
+      for item in value: _encodeBinary(item, chunks)
+   elif isinstance(value, dict):
+      chunks.append("d" + struct.pack("!I", len(value)))
+      for key in value:
+         _encodeBinary(key, chunks)
+         _encodeBinary(value[key], chunks)
+   else:
+      _encodeBinary(str(value), chunks)
+
+# -------------------------------------------------------------------- getFile()
+def getFile(tcpSocket, remotePath, localPath, encoding = "repr",
+            resume = False, checksum = None):
+   """getFile(tcpSocket, remotePath, localPath, encoding, resume, checksum)
+      Copies a file from the Agent with FILE:get on a framed session and
+      returns the FILE END reply. With resume a local file that is already
+      there is taken as the start of the copy. With checksum, such as
+      "sha256", the local file is checked against the FILE_CHECKSUM of the
+      Agent and IOError is raised if they differ. """
+   offset = 0
+   if resume and os.path.exists(localPath): offset = os.path.getsize(localPath)
+   options = ";offset=%d" %offset
+   if checksum: options += ";checksum=%s" %checksum
+   sendFramed(tcpSocket, "FILE%s:get=%s" %(options, remotePath))
+   reply = decodeReply(recvFramed(tcpSocket), encoding)
+   if reply[AGENT_RETURN_CODE] != 0: return reply
+   localFile = open(localPath, "r+b" if offset else "wb")
+   try:
+      localFile.truncate(offset)
+      localFile.seek(offset)
+      remaining = reply["FILE_SIZE"] - reply["FILE_OFFSET"]
+      while remaining > 0:
+         data = recvFramed(tcpSocket)
+         localFile.write(data)
+         remaining -= len(data)
+   finally:
+      localFile.close()
+   reply = decodeReply(recvFramed(tcpSocket), encoding)
+   if checksum and reply[AGENT_RETURN_CODE] == 0:
+      _checkFile(localPath, checksum, reply["FILE_CHECKSUM"])
+   return reply
+
+# -------------------------------------------------------------------- putFile()
+def putFile(tcpSocket, localPath, remotePath, encoding = "repr",
+            resume = False, checksum = None, compress = False):
+   """putFile(tcpSocket, localPath, remotePath, encoding, resume, checksum,
+      compress) Copies a file to the Agent with FILE:put on a framed session
+      and returns the FILE RECEIVED reply, or the reply that refused the
+      copy. With resume the copy starts at the size of the file on the
+      Agent (FILE:stat). checksum is as for getFile(). With compress the
+      file is sent compressed. """
+   offset = 0
+   if resume:
+      sendFramed(tcpSocket, "FILE:stat=%s" %remotePath)
+      reply = decodeReply(recvFramed(tcpSocket), encoding)
+      if reply[AGENT_RETURN_CODE] == 0: offset = reply["FILE_SIZE"]
+   localFile = open(localPath, "rb")
+   try:
+      size    = os.fstat(localFile.fileno()).st_size - offset
+      options = ";offset=%d;size=%d" %(offset, max(size, 0))
+      if checksum: options += ";checksum=%s" %checksum
+      sendFramed(tcpSocket, "FILE%s:put=%s" %(options, remotePath))
+      reply = decodeReply(recvFramed(tcpSocket), encoding)
+      if reply[AGENT_RETURN_CODE] != 0: return reply
+      localFile.seek(offset)
+      while size > 0:
+         data = localFile.read(min(size, FILE_CHUNK))
+         if not data: data = "\0" * size  # The file has shrunk, keep the session in step
+         sendFramed(tcpSocket, data, compress)
+         size -= len(data)
+   finally:
+      localFile.close()
+   reply = decodeReply(recvFramed(tcpSocket), encoding)
+   if checksum and reply[AGENT_RETURN_CODE] == 0:
+      _checkFile(localPath, checksum, reply["FILE_CHECKSUM"])
+   return reply
+
+# ------------------------------------------------------------------ readSpill()
+def readSpill(tcpSocket, spillId, output, encoding = "repr",
+              chunk = SPILL_CHUNK, drop = True):
+   """readSpill(tcpSocket, spillId, output, encoding, chunk, drop) Reads the
+      spilled output of a command (the SPILL_ID in the OS_SPILL of its
+      reply) with SPILL:read, chunk bytes at a time, and writes it to the
+      file object output. With drop the spill is deleted from the Agent
+      once read. Returns the number of bytes read, raises IOError if the
+      Agent refuses a read. """
+   offset = 0
+   while True:
+      sendFramed(tcpSocket, "SPILL;offset=%d;size=%d:read=%d" %(offset, chunk, spillId))
+      reply = decodeReply(recvFramed(tcpSocket), encoding)
+      if reply[AGENT_RETURN_CODE] != 0:
+         raise IOError("Unable to read spill %d - %s" %(spillId, reply[AGENT_MESSAGE]))
+      output.write(reply["OS_DATA"])
+      offset += len(reply["OS_DATA"])
+      if not reply["OS_DATA"] or offset >= reply["SPILL_SIZE"]: break
+   if drop:
+      sendFramed(tcpSocket, "SPILL:drop=%d" %spillId)
+      recvFramed(tcpSocket)
+   return offset
+
+def _checkFile(localPath, algorithm, expected):
+   """ Raises IOError if the checksum of the local file is not expected. """
+   digest    = hashlib.new(algorithm)
+   localFile = open(localPath, "rb")
+   try:
+      for data in iter(lambda: localFile.read(FILE_CHUNK), ""): digest.update(data)
+   finally:
+      localFile.close()
+   if digest.hexdigest() != expected:
+      raise IOError("Checksum of %s is %s, the Agent has %s" %(localPath, digest.hexdigest(), expected))
+
+# ---------------------------------------------------------------- probeAgents()
+def probeAgents(agents, timeout = PROBE_TIMEOUT, tries = PROBE_TRIES):
+   """probeAgents(list agents, timeout, tries) Sends a PING to the health
+      probe of each (address, port) in agents, all from one UDP socket, and
+      returns a list of (reply, seconds) in the same order, (None, None)
+      for the Agents that did not answer within timeout seconds. The
+      timeout is shared by "tries" rounds, each round probes again the
+      Agents that have not answered yet. """
+   udpSocket = socket(AF_INET, SOCK_DGRAM)
+   results   = [(None, None)] * len(agents)
+   sent      = {}                          # Index --> time of its last probe
+   waiting   = len(agents)                 # Agents that have not answered
+   try:
+      for attempt in range(tries):
+         deadline = time.time() + float(timeout) / tries
+         for index, agent in enumerate(agents):
+            if results[index][FIRST] is not None: continue
+            try:
+               udpSocket.sendto("PING;encoding=binary:%d" %index, agent)
+               sent[index] = time.time()
+            except SocketError:
+               pass # Cannot be resolved or reached, it does not answer
+         while waiting:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([udpSocket], [], [], remaining)[FIRST]: break
+            try:
+               data, remoteAddr = udpSocket.recvfrom(PROBE_BUF_SIZE)
+               reply = decodeBinary(data)
+               index = int(reply["PING_TOKEN"])
+            except (SocketError, struct.error, ValueError, KeyError, IndexError, TypeError):
+               continue # Not the reply to one of our probes
+            if index in sent and results[index][FIRST] is None:
+               results[index] = (reply, time.time() - sent[index])
+               waiting -= 1
+         if not waiting: break
+   finally:
+      udpSocket.close()
+   return results
+
+# ----------------------------------------------------------- measureEncodings()
+def measureEncodings(address, port, command, repeat = MEASURE_REPEAT):
+   """measureEncodings(address, port, command, repeat) Runs the OS command
+      on the Agent "repeat" times in each reply encoding and returns a list
+      of (encoding, bytes per reply, decode seconds per reply). """
+   results = []
+   for encoding in ("repr", "json", "binary"):
+      tcpSocket = socket(AF_INET, SOCK_STREAM)
+      tcpSocket.connect((address, port))
+      tcpSocket.send("TA:framing=on")
+      tcpSocket.recv(BUFFER)
+      sendFramed(tcpSocket, "TA:encoding=%s" %encoding)
+      recvFramed(tcpSocket)
+      replyBytes = 0
+      decodeTime = 0.0
+      for i in range(repeat):
+         sendFramed(tcpSocket, "OS:%s" %command)
+         reply = recvFramed(tcpSocket)
+         start = time.clock()
+         decodeReply(reply, encoding)
+         decodeTime += time.clock() - start
+         replyBytes += len(reply)
+      sendFramed(tcpSocket, "TA:bye")
+      recvFramed(tcpSocket)
+      tcpSocket.close()
+      results.append((encoding, replyBytes / repeat, decodeTime / repeat))
+   return results
+
+# ----------------------------------------------------------------------- main()
+def main():
+   """main() Runs a command on the Agent as directed by the command line. """
+   address = AGENT_IP
+   port    = AGENT_PORT
+   command = COMMAND
+   measure = False
+   try:
+      arguments = getopt.getopt(sys.argv[1:], "ha:p:c:m",
+                                ['help', 'address=', 'port=', 'command=',
+                                 'measure'])
+   except:
+      usage()
+      return 2
+   for arg in arguments[FIRST]:
+      if arg[0] == "-h" or arg[0] == "--help":
+         usage()
+         return EXIT_SUCCESS
+      elif arg[0] == "-a" or arg[0] == "--address": address = arg[1]
+      elif arg[0] == "-c" or arg[0] == "--command": command = arg[1]
+      elif arg[0] == "-m" or arg[0] == "--measure": measure = True
+      elif arg[0] == "-p" or arg[0] == "--port":
+         try:
+            port = int(arg[1])
+         except:
+            usage()
+            return 2
+   try:
+      if measure:
+         print "%-8s %14s %18s" %("ENCODING", "BYTES/REPLY", "DECODE USEC/REPLY")
+         for encoding, replyBytes, decodeTime in measureEncodings(address, port, command):
+            print "%-8s %14d %18.1f" %(encoding, replyBytes, decodeTime * 1000000)
+         return EXIT_SUCCESS
+      connection = AgentConnection(address, port, "repr") # Connect, framed
+      print connection.request("TA:version")     # Get the version of the agent
+      print connection.request("OS:%s" %command) # Run the OS command
+      connection.close()                         # End the session with the agent
+   except Exception as e:
+      sys.stderr.write("\n\nERROR -- Unable to talk to the Agent at %s:%d - %s\n\n"
+                       %(address, port, str(e)))
+      return 3
+   return EXIT_SUCCESS
+
+# ==============================================================================
+if __name__ == "__main__":
+   sys.exit(main())
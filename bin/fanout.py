@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+# Agent Fan-out - Sends one message to a fleet of Agents (see agent.py) at once
+
+"""
+Reads an inventory of Agents and sends each of them the same TA, OS, BATCH
+or SYS message, up to --concurrency of them at a time (see the usage
+function). The inventory has one Agent a line, its address with an
+optional port and an optional name, blank lines and lines starting with #
+are left out:
+
+   # address[:port]     name
+   192.168.1.129               lab-01
+   192.168.1.130:1101          lab-02
+   lab-03.example.com
+
+Each Agent gets --timeout seconds, from connecting to having read its
+reply. OS messages without a timeout option are given the same timeout on
+the Agent (OS;timeout=N:...), so a stuck command is killed there and the
+output it made is still reported.
+
+The result of each Agent is printed as it comes in, with its output unless
+--quiet, then a summary table of every Agent in the order of the inventory
+and the count of each status:
+
+   ok       - AGENT_RETURN_CODE and OS_RETURNCODE, if any, of 0
+   failed   - A reply with a non-zero AGENT_RETURN_CODE or OS_RETURNCODE
+   timeout  - No reply in time, or the Agent killed the command (221)
+   error    - The Agent could not be reached or the session broke
+
+With --output the results, replies and all, are written as CSV or JSON,
+chosen by --format or else by the extension of the file:
+
+   fanout.py -i lab.hosts -c 64 -t 10 -o uname.csv "OS:uname -a"
+"""
+
+# ==============================================================================
+# STANDARD LIBRARY IMPORTS
+import sys
+import os
+import time
+import getopt
+import json
+import csv
+import socket
+import threading
+import Queue
+
+# ==============================================================================
+# DICTIONARY
+VERSION       = "1.0.0"                    # Version of the fan-out
+FIRST         = 0                          # first element in a list
+LAST          = -1                         # last element in a list
+ME            = os.path.split(sys.argv[FIRST])[LAST]        # Name of this file
+MY_PATH       = os.path.dirname(os.path.realpath(__file__)) # Path for this file
+EXIT_SUCCESS  = 0                          # Exit code
+CONCURRENCY   = 32                         # Agents talked to at once
+TIMEOUT       = 30.0                       # Seconds each Agent gets
+AGENT_GRACE   = 2.0                        # Extra seconds for the reply of an OS command the Agent timed out
+ENCODING      = "binary"                   # Reply encoding of the sessions
+FORMATS       = ("csv", "json")            # Output file formats
+DIRECTIVES    = ("TA", "OS", "BATCH", "SYS")  # Directives that may be sent, one reply each
+STATUSES      = ("ok", "failed", "timeout", "error")  # Results of an Agent
+TIMEOUT_CODE  = 221                        # AGENT_RETURN_CODE of a command the Agent timed out
+CSV_FIELDS    = ["host", "port", "name", "status", "agent_return_code",
+                 "os_return_code", "elapsed_ms", "message", "stdout", "stderr",
+                 "error"]                  # Columns of the CSV output
+
+sys.path.insert(FIRST, MY_PATH)
+from client import AgentConnection, AGENT_PORT, AGENT_RETURN_CODE, AGENT_MESSAGE
+
+# ==============================================================================
+# FUNCTIONS
+
+# ---------------------------------------------------------------------- usage()
+def usage():
+   """usage() - Prints the usage message on stdout. """
+   print "\n\n%s, Version %s, Sends a message to many Agents at once.  " %(ME,VERSION)
+   print "\nUSAGE: %s [OPTIONS] MESSAGE                            " %ME
+   print "                                                         "
+   print "   MESSAGE is a %s message, such as \"OS:uname -a\" " %", ".join(DIRECTIVES)
+   print "                                                         "
+   print "OPTIONS:                                                 "
+   print "   -h --help        Display this message.                "
+   print "   -i --inventory=  File of Agents, address[:port] [name] a line, "
+   print "                    - for stdin                          "
+   print "   -p --port=       Port of the Agents without one, default: %d " %AGENT_PORT
+   print "   -c --concurrency= Agents talked to at once, default: %d " %CONCURRENCY
+   print "   -t --timeout=    Seconds each Agent gets, default: %.0f " %TIMEOUT
+   print "   -q --quiet       Print the status of each Agent without its output "
+   print "   -o --output=     Write the results to this file       "
+   print "   -f --format=     Format of the output file: %s, " %", ".join(FORMATS)
+   print "                    default: from the extension of the file "
+   print "                                                         "
+   print "EXIT CODES:                                              "
+   print "    0 - Every Agent replied ok.                          "
+   print "    1 - Not every Agent replied ok.                      "
+   print "    2 - Bad command line arguments.                      "
+   print "    3 - Unable to read the inventory, or a bad line in it. "
+   print "    4 - Unable to write the output file.                 "
+   print "                                                         "
+
+# ------------------------------------------------------------ readInventory()
+def readInventory(inventory, port):
+   """readInventory(file inventory, port) Returns the Agents of an inventory
+      as a list of (host, port, name). Raises ValueError for a bad line. """
+   agents = []
+   for number, line in enumerate(inventory):
+      line = line.strip()
+      if not line or line.startswith("#"): continue
+      fields = line.split()
+      if len(fields) > 2: raise ValueError("line %d has more than an address and a name" %(number + 1))
+      host, sep, agentPort = fields[FIRST].rpartition(":")
+      if not sep: host, agentPort = agentPort, port
+      try:
+         agentPort = int(agentPort)
+      except ValueError:
+         raise ValueError("line %d has a bad port \"%s\"" %(number + 1, agentPort))
+      if len(fields) > 1: name = fields[LAST]
+      else:               name = host
+      agents.append((host, agentPort, name))
+   return agents
+
+# ----------------------------------------------------------------- agentTimeout()
+def agentTimeout(message, timeout):
+   """agentTimeout(str message, timeout) Returns the message with a timeout
+      option for the Agent if it is an OS message without one. """
+   head, sep, command = message.partition(":")
+   parts = [part.strip().lower() for part in head.split(";")]
+   if parts[FIRST] != "os" or [part for part in parts[1:] if part.startswith("timeout")]:
+      return message
+   return "%s;timeout=%g:%s" %(head, timeout, command)
+
+# ------------------------------------------------------------------- query()
+def query(agent, message, timeout):
+   """query(agent, message, timeout) Sends the message to one Agent and
+      returns its result as a dictionary. """
+   host, port, name = agent
+   result = {"host" : host, "port" : port, "name" : name, "reply" : None, "error" : None}
+   started = time.time()
+   try:
+      socketTimeout = timeout
+      if message != agentTimeout(message, timeout): socketTimeout += AGENT_GRACE
+      connection = AgentConnection(host, port, ENCODING, socketTimeout)
+      try:
+         result["reply"] = connection.request(agentTimeout(message, timeout))
+      finally:
+         connection.close()
+   except socket.timeout:
+      result["error"] = "No reply within %g seconds" %timeout
+   except (socket.error, EOFError, IOError, ValueError) as e:
+      result["error"] = str(e) or e.__class__.__name__
+   except Exception as e:   # Not an Agent on that port, or a reply that cannot be read
+      result["error"] = "%s - %s" %(e.__class__.__name__, str(e))
+   result["elapsed"] = time.time() - started
+   result["status"]  = status(result)
+   return result
+
+# ------------------------------------------------------------------ status()
+def status(result):
+   """status(dict result) Returns the status of the result of an Agent, one
+      of STATUSES. """
+   reply = result["reply"]
+   if reply is None:
+      if result["error"].startswith("No reply"): return "timeout"
+      return "error"
+   if reply.get(AGENT_RETURN_CODE) == TIMEOUT_CODE: return "timeout"
+   if reply.get(AGENT_RETURN_CODE) != 0 or reply.get("OS_RETURNCODE", 0) != 0: return "failed"
+   return "ok"
+
+# ------------------------------------------------------------ queryWorker()
+def queryWorker(agents, message, timeout, results):
+   """queryWorker(...) Worker thread body, queries the Agents handed to it
+      until given None and puts their (index, result) on the results
+      queue. """
+   while True:
+      item = agents.get()
+      if item is None: return
+      index, agent = item
+      results.put((index, query(agent, message, timeout)))
+
+# ------------------------------------------------------------------- fanOut()
+def fanOut(agents, message, concurrency, timeout, report):
+   """fanOut(...) Queries every Agent, up to concurrency at once, calls
+      report(result) for each result as it comes in and returns the
+      results in the order of the agents. """
+   work    = Queue.Queue()
+   results = Queue.Queue()
+   for item in enumerate(agents): work.put(item)
+   threads = []
+   for i in range(min(concurrency, len(agents))):
+      work.put(None)
+      thread = threading.Thread(target = queryWorker, args = (work, message, timeout, results))
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+   ordered = [None] * len(agents)
+   for i in range(len(agents)):
+      index, result = results.get()
+      ordered[index] = result
+      report(result)
+   for thread in threads: thread.join()
+   return ordered
+
+# ----------------------------------------------------------------- showResult()
+def showResult(result, quiet):
+   """showResult(dict result, bool quiet) Prints the result of an Agent as
+      it comes in, its output lines are prefixed with its name. """
+   reply = result["reply"] or {}
+   print "[%-7s] %s (%s:%d) %.1f ms %s" %(result["status"], result["name"], result["host"],
+         result["port"], result["elapsed"] * 1000, result["error"] or reply.get(AGENT_MESSAGE, ""))
+   if quiet or not reply: return
+   for key in ("OS_STDOUT", "OS_STDERR"):
+      for line in (reply.get(key) or "").splitlines(): print "%s: %s" %(result["name"], line)
+   for key in sorted(reply):
+      if key not in ("OS_STDOUT", "OS_STDERR", "OS_COMMAND", "OS_RETURNCODE",
+                     AGENT_RETURN_CODE, AGENT_MESSAGE):
+         print "%s: %s = %s" %(result["name"], key, reply[key])
+   sys.stdout.flush()
+
+# ---------------------------------------------------------------- showSummary()
+def showSummary(results, seconds):
+   """showSummary(list results, seconds) Prints the summary table. """
+   width = max([len(result["name"]) for result in results] + [5])
+   print ""
+   print "%-*s %-8s %6s %6s %10s" %(width, "AGENT", "STATUS", "AGENT", "OS", "MS")
+   for result in results:
+      reply = result["reply"] or {}
+      print "%-*s %-8s %6s %6s %10.1f" %(width, result["name"], result["status"],
+            reply.get(AGENT_RETURN_CODE, "-"), reply.get("OS_RETURNCODE", "-"),
+            result["elapsed"] * 1000)
+   counts = ", ".join(["%s %d" %(name, len([result for result in results if result["status"] == name]))
+                       for name in STATUSES])
+   print ""
+   print "%d AGENTS IN %.1f SECONDS: %s" %(len(results), seconds, counts)
+
+# -------------------------------------------------------------- writeResults()
+def writeResults(results, path, outputFormat, message):
+   """writeResults(list results, path, outputFormat, message) Writes the
+      results as CSV or JSON. Raises IOError if the file cannot be written. """
+   with open(path, "wb" if outputFormat == "csv" else "w") as output:
+      if outputFormat == "json":
+         json.dump({"message" : message, "results" : [dict(result, elapsed_ms = round(result["elapsed"] * 1000, 3))
+                                                      for result in results]},
+                   output, indent = 3, sort_keys = True)
+         return
+      writer = csv.DictWriter(output, CSV_FIELDS)
+      writer.writeheader()
+      for result in results:
+         reply = result["reply"] or {}
+         writer.writerow({"host"              : result["host"]                      ,
+                          "port"              : result["port"]                      ,
+                          "name"              : result["name"]                      ,
+                          "status"            : result["status"]                    ,
+                          "agent_return_code" : reply.get(AGENT_RETURN_CODE, "")    ,
+                          "os_return_code"    : reply.get("OS_RETURNCODE", "")      ,
+                          "elapsed_ms"        : round(result["elapsed"] * 1000, 3)  ,
+                          "message"           : reply.get(AGENT_MESSAGE, "")        ,
+                          "stdout"            : reply.get("OS_STDOUT", "")          ,
+                          "stderr"            : reply.get("OS_STDERR", "")          ,
+                          "error"             : result["error"] or ""               })
+
+# ----------------------------------------------------------------------- main()
+def main():
+   """main() Sends the message to the inventory as directed by the command
+      line. """
+   inventoryPath = None
+   port          = AGENT_PORT
+   concurrency   = CONCURRENCY
+   timeout       = TIMEOUT
+   quiet         = False
+   output        = None
+   outputFormat  = None
+   try:
+      arguments = getopt.getopt(sys.argv[1:], "hi:p:c:t:qo:f:",
+                                ['help', 'inventory=', 'port=', 'concurrency=',
+                                 'timeout=', 'quiet', 'output=', 'format='])
+   except:
+      usage()
+      return 2
+   try:
+      for arg in arguments[FIRST]:
+         if arg[0] == "-h" or arg[0] == "--help":
+            usage()
+            return EXIT_SUCCESS
+         elif arg[0] == "-i" or arg[0] == "--inventory":   inventoryPath = arg[1]
+         elif arg[0] == "-p" or arg[0] == "--port":        port          = int(arg[1])
+         elif arg[0] == "-c" or arg[0] == "--concurrency": concurrency   = int(arg[1])
+         elif arg[0] == "-t" or arg[0] == "--timeout":     timeout       = float(arg[1])
+         elif arg[0] == "-q" or arg[0] == "--quiet":       quiet         = True
+         elif arg[0] == "-o" or arg[0] == "--output":      output        = arg[1]
+         elif arg[0] == "-f" or arg[0] == "--format":      outputFormat  = arg[1].lower()
+   except ValueError:
+      usage()
+      return 2
+   if output and outputFormat is None:
+      outputFormat = os.path.splitext(output)[LAST].lstrip(".").lower()
+   if len(arguments[LAST]) != 1 or inventoryPath is None or concurrency < 1 or timeout <= 0 or \
+      (output and outputFormat not in FORMATS) or \
+      arguments[LAST][FIRST].split(":", 1)[FIRST].split(";")[FIRST].strip().upper() not in DIRECTIVES:
+      usage()
+      return 2
+   message = arguments[LAST][FIRST]
+   try:
+      if inventoryPath == "-":
+         agents = readInventory(sys.stdin, port)
+      else:
+         with open(inventoryPath) as inventory: agents = readInventory(inventory, port)
+   except (IOError, ValueError) as e:
+      sys.stderr.write("\n\nERROR -- Unable to read the inventory %s - %s\n\n" %(inventoryPath, str(e)))
+      return 3
+   started = time.time()
+   results = fanOut(agents, message, concurrency, timeout, lambda result: showResult(result, quiet))
+   showSummary(results, time.time() - started)
+   if output:
+      try:
+         writeResults(results, output, outputFormat, message)
+      except IOError as e:
+         sys.stderr.write("\n\nERROR -- Unable to write %s - %s\n\n" %(output, str(e)))
+         return 4
+      print "Results written to %s" %output
+   if [result for result in results if result["status"] != "ok"]: return 1
+   return EXIT_SUCCESS
+
+# ==============================================================================
+if __name__ == "__main__":
+   sys.exit(main())